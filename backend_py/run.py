@@ -24,6 +24,7 @@ async def lifespan(app: FastAPI):
     server.serve()
     yield
     print("Shutting down server...")
+    await server.shutdown()
 
 
 # FastAPI application
@@ -5,16 +5,18 @@ API endpoints for camera device management and streaming config
 Handles listing connected devices, updating stream settings (resolution / fps), setting UVC controls, and dealing with Leader/Follower for stereo cameras
 """
 
-from fastapi import APIRouter, Depends, Request
+from fastapi import APIRouter, Depends, Request, HTTPException, Query
+from fastapi.responses import StreamingResponse
 from ..services import DeviceManager, StreamInfoModel, DeviceNicknameModel, UVCControlModel, DeviceDescriptorModel, DeviceLeaderModel
 import logging
 
 from typing import List, cast
 
-from ..services.cameras.pydantic_schemas import StreamInfoModel, DeviceNicknameModel, UVCControlModel, DeviceLeaderModel, DeviceModel, AddFollowerPayload, SimpleRequestStatusModel
-from ..services.cameras.exceptions import DeviceNotFoundException
+from ..services.cameras.pydantic_schemas import StreamInfoModel, DeviceNicknameModel, UVCControlModel, DeviceLeaderModel, DeviceModel, AddFollowerPayload, SimpleRequestStatusModel, EncoderBenchmarkModel, StreamStatsModel, SnapshotRequestModel, SnapshotFrameModel, StreamRestartStatsModel, EngineInfoModel, BandwidthPlanModel, InstantRecordingModel, KeyframeRequestModel, TetherBudgetPlanModel, AdaptiveBitrateStatusModel, DiagnosticsRequestModel, PipelineDiagnosticsModel, StreamResourceModel, TimelapseRequestModel, TimelapseStatusModel
+from ..services.cameras.exceptions import DeviceNotFoundException, BandwidthExceededException
 from ..services.cameras.pydantic_schemas import DeviceType
 from ..services.cameras.shd import SHDDevice
+from ..services.cameras.preview import mjpeg_preview, PREVIEW_BOUNDARY
 camera_router = APIRouter(tags=['cameras'])
 
 
@@ -26,10 +28,14 @@ def get_devices(request: Request) -> List[DeviceModel]:
 
 
 @camera_router.post('/devices/configure_stream', summary='Configure a stream')
-async def configure_stream(request: Request, stream_info: StreamInfoModel):
+def configure_stream(request: Request, stream_info: StreamInfoModel):
     device_manager: DeviceManager = request.app.state.device_manager
 
-    device_manager.configure_device_stream(stream_info)
+    try:
+        device_manager.configure_device_stream(stream_info)
+    except BandwidthExceededException as e:
+        raise HTTPException(status_code=409, detail={
+                            "message": str(e), "suggestions": e.suggestions})
 
     for device in device_manager.devices:
         if device.bus_info == stream_info.bus_info:
@@ -45,6 +51,26 @@ async def configure_stream(request: Request, stream_info: StreamInfoModel):
     return {}
 
 
+@camera_router.post('/devices/configure_secondary_stream', summary='Configure a second stream from another node of the camera')
+def configure_secondary_stream(request: Request, stream_info: StreamInfoModel) -> SimpleRequestStatusModel:
+    device_manager: DeviceManager = request.app.state.device_manager
+
+    try:
+        success = device_manager.configure_device_secondary_stream(stream_info)
+    except BandwidthExceededException as e:
+        raise HTTPException(status_code=409, detail={
+                            "message": str(e), "suggestions": e.suggestions})
+
+    return SimpleRequestStatusModel(success=success)
+
+
+@camera_router.post('/devices/bandwidth/plan_secondary', summary='Estimate the USB bandwidth with a secondary stream configuration, without applying it')
+def plan_secondary_bandwidth(request: Request, stream_info: StreamInfoModel) -> BandwidthPlanModel:
+    device_manager: DeviceManager = request.app.state.device_manager
+
+    return device_manager.get_bandwidth_plan(stream_info, secondary=True)
+
+
 @camera_router.post('/devices/set_nickname', summary='Set a device nickname')
 def set_nickname(request: Request, device_nickname: DeviceNicknameModel):
     device_manager: DeviceManager = request.app.state.device_manager
@@ -95,5 +121,234 @@ def restart_stream(request: Request, device_descriptor: DeviceDescriptorModel):
             device_descriptor.bus_info)
     except DeviceNotFoundException:
         return SimpleRequestStatusModel(success=False)
+    device_manager.supervisor.reset(device_descriptor.bus_info)
     dev.start_stream()
     return SimpleRequestStatusModel(success=True)
+
+
+@camera_router.get('/devices/bandwidth', summary='Get the estimated USB bandwidth of the enabled streams')
+def get_bandwidth_plan(request: Request) -> BandwidthPlanModel:
+    device_manager: DeviceManager = request.app.state.device_manager
+
+    return device_manager.get_bandwidth_plan()
+
+
+@camera_router.post('/devices/bandwidth/plan', summary='Estimate the USB bandwidth with a stream configuration, without applying it')
+def plan_bandwidth(request: Request, stream_info: StreamInfoModel) -> BandwidthPlanModel:
+    device_manager: DeviceManager = request.app.state.device_manager
+
+    return device_manager.get_bandwidth_plan(stream_info)
+
+
+@camera_router.get('/devices/tether_budget', summary='Get the bitrates of the streams sent over the tether, as allocated by the budget')
+def get_tether_budget(request: Request) -> TetherBudgetPlanModel:
+    device_manager: DeviceManager = request.app.state.device_manager
+
+    return device_manager.get_tether_budget()
+
+
+@camera_router.get('/devices/adaptive_bitrate', summary='Get the bitrate and reported loss of the streams adapted to their receivers')
+def get_adaptive_bitrate_status(request: Request) -> List[AdaptiveBitrateStatusModel]:
+    device_manager: DeviceManager = request.app.state.device_manager
+
+    return device_manager.get_adaptive_bitrate_status()
+
+
+@camera_router.get('/devices/resources', summary='Get the CPU, memory and disk writes of every running stream')
+def get_stream_resources(request: Request) -> List[StreamResourceModel]:
+    device_manager: DeviceManager = request.app.state.device_manager
+
+    return device_manager.get_stream_resources()
+
+
+@camera_router.get('/devices/engines', summary='Get the stream engines and their capabilities')
+def get_engines(request: Request) -> List[EngineInfoModel]:
+    device_manager: DeviceManager = request.app.state.device_manager
+
+    return device_manager.get_engines()
+
+
+@camera_router.get('/devices/encoders', summary='Get software H.264 encoder benchmarks')
+def get_encoder_benchmarks(request: Request) -> List[EncoderBenchmarkModel]:
+    device_manager: DeviceManager = request.app.state.device_manager
+
+    return device_manager.get_encoder_benchmarks()
+
+
+@camera_router.get('/devices/stream_stats', summary='Get the live stats of all running streams')
+def get_stream_stats(request: Request) -> List[StreamStatsModel]:
+    device_manager: DeviceManager = request.app.state.device_manager
+
+    return device_manager.get_stream_stats()
+
+
+@camera_router.get('/devices/restart_stats', summary='Get the automatic stream restart stats')
+def get_restart_stats(request: Request) -> List[StreamRestartStatsModel]:
+    device_manager: DeviceManager = request.app.state.device_manager
+
+    return device_manager.get_restart_stats()
+
+
+@camera_router.get('/devices/{bus_info}/stream_stats', summary='Get the live stats of a stream')
+def get_device_stream_stats(request: Request, bus_info: str) -> StreamStatsModel:
+    device_manager: DeviceManager = request.app.state.device_manager
+
+    stats = device_manager.stream_stats.get(bus_info)
+    if not stats:
+        raise HTTPException(status_code=404, detail="Stream not running")
+    return stats
+
+
+@camera_router.get('/devices/{bus_info}/preview.mjpeg', summary='Low-latency MJPEG preview of a device')
+def get_device_preview(request: Request, bus_info: str, max_fps: float = Query(15, gt=0, le=60), low_res: bool = False):
+    device_manager: DeviceManager = request.app.state.device_manager
+
+    try:
+        dev = device_manager._find_device_with_bus_info(bus_info)
+    except DeviceNotFoundException:
+        raise HTTPException(status_code=404, detail="Device not found")
+
+    if not dev.get_frame_tap(low_res):
+        raise HTTPException(
+            status_code=409, detail="Preview is unavailable while the device streams without MJPEG")
+
+    return StreamingResponse(
+        mjpeg_preview(lambda: dev.get_frame_tap(low_res), max_fps),
+        media_type=f"multipart/x-mixed-replace; boundary={PREVIEW_BOUNDARY}",
+        headers={"Cache-Control": "no-cache, no-store"},
+    )
+
+
+@camera_router.post('/devices/{bus_info}/snapshot', summary='Capture stills from a device without interrupting its stream')
+def take_snapshot(request: Request, bus_info: str, snapshot_request: SnapshotRequestModel = SnapshotRequestModel()) -> List[SnapshotFrameModel]:
+    device_manager: DeviceManager = request.app.state.device_manager
+
+    try:
+        dev = device_manager._find_device_with_bus_info(bus_info)
+    except DeviceNotFoundException:
+        raise HTTPException(status_code=404, detail="Device not found")
+
+    snapshots = dev.take_snapshot(snapshot_request.count)
+    if not snapshots:
+        raise HTTPException(
+            status_code=409, detail="No frames available from this device")
+    return snapshots
+
+
+@camera_router.post('/devices/{bus_info}/request_keyframe', summary='Ask the encoder of a running stream for a keyframe')
+def request_keyframe(request: Request, bus_info: str, secondary: bool = False) -> KeyframeRequestModel:
+    device_manager: DeviceManager = request.app.state.device_manager
+
+    try:
+        result = device_manager.request_keyframe(bus_info, secondary)
+    except DeviceNotFoundException:
+        raise HTTPException(status_code=404, detail="Device not found")
+
+    if not result:
+        raise HTTPException(status_code=409, detail="The stream is not running")
+    if not result.method:
+        raise HTTPException(
+            status_code=409, detail="The stream's encoder cannot be asked for a keyframe")
+    return result
+
+
+@camera_router.post('/devices/{bus_info}/diagnostics/start', summary='Trace the pipeline of a running stream for a while')
+def start_diagnostics(request: Request, bus_info: str, diagnostics_request: DiagnosticsRequestModel) -> PipelineDiagnosticsModel:
+    device_manager: DeviceManager = request.app.state.device_manager
+
+    try:
+        diagnostics = device_manager.start_diagnostics(
+            bus_info, diagnostics_request)
+    except DeviceNotFoundException:
+        raise HTTPException(status_code=404, detail="Device not found")
+
+    if not diagnostics:
+        raise HTTPException(
+            status_code=409, detail="The stream is not running, or its engine cannot be traced")
+    return diagnostics
+
+
+@camera_router.get('/devices/{bus_info}/diagnostics', summary='Get the running or last pipeline diagnostics of a device')
+def get_diagnostics(request: Request, bus_info: str) -> PipelineDiagnosticsModel:
+    device_manager: DeviceManager = request.app.state.device_manager
+
+    try:
+        diagnostics = device_manager.get_diagnostics(bus_info)
+    except DeviceNotFoundException:
+        raise HTTPException(status_code=404, detail="Device not found")
+
+    if not diagnostics:
+        raise HTTPException(status_code=404, detail="No diagnostics")
+    return diagnostics
+
+
+@camera_router.post('/devices/{bus_info}/recording/start', summary='Record a running stream from its next keyframe, without restarting it')
+def start_recording(request: Request, bus_info: str, secondary: bool = False) -> InstantRecordingModel:
+    device_manager: DeviceManager = request.app.state.device_manager
+
+    try:
+        recording = device_manager.start_recording(bus_info, secondary)
+    except DeviceNotFoundException:
+        raise HTTPException(status_code=404, detail="Device not found")
+
+    if not recording:
+        raise HTTPException(
+            status_code=409, detail="The stream is not running, or is not set up for instant recordings (recording.instant)")
+    return recording
+
+
+@camera_router.post('/devices/{bus_info}/recording/stop', summary='Stop the instant recording of a stream')
+def stop_recording(request: Request, bus_info: str, secondary: bool = False) -> InstantRecordingModel:
+    device_manager: DeviceManager = request.app.state.device_manager
+
+    try:
+        recording = device_manager.stop_recording(bus_info, secondary)
+    except DeviceNotFoundException:
+        raise HTTPException(status_code=404, detail="Device not found")
+
+    if not recording:
+        raise HTTPException(status_code=404, detail="No recording")
+    return recording
+
+
+@camera_router.post('/devices/{bus_info}/timelapse/start', summary='Capture a still from the MJPEG node every interval')
+def start_timelapse(request: Request, bus_info: str, timelapse_request: TimelapseRequestModel) -> TimelapseStatusModel:
+    device_manager: DeviceManager = request.app.state.device_manager
+
+    try:
+        status = device_manager.start_timelapse(bus_info, timelapse_request)
+    except DeviceNotFoundException:
+        raise HTTPException(status_code=404, detail="Device not found")
+
+    if not status:
+        raise HTTPException(
+            status_code=409, detail="The device has no MJPEG node at this resolution")
+    return status
+
+
+@camera_router.post('/devices/{bus_info}/timelapse/stop', summary='Stop the timelapse of a device')
+def stop_timelapse(request: Request, bus_info: str) -> TimelapseStatusModel:
+    device_manager: DeviceManager = request.app.state.device_manager
+
+    try:
+        status = device_manager.stop_timelapse(bus_info)
+    except DeviceNotFoundException:
+        raise HTTPException(status_code=404, detail="Device not found")
+
+    if not status:
+        raise HTTPException(status_code=404, detail="No timelapse")
+    return status
+
+
+@camera_router.get('/devices/{bus_info}/timelapse', summary='Get the status of the timelapse of a device')
+def get_timelapse(request: Request, bus_info: str) -> TimelapseStatusModel:
+    device_manager: DeviceManager = request.app.state.device_manager
+
+    try:
+        dev = device_manager._find_device_with_bus_info(bus_info)
+    except DeviceNotFoundException:
+        raise HTTPException(status_code=404, detail="Device not found")
+
+    if not dev.timelapse:
+        raise HTTPException(status_code=404, detail="No timelapse")
+    return dev.timelapse.status()
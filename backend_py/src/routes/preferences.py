@@ -7,7 +7,7 @@ Handles getting and setting preferences
 
 from fastapi import APIRouter, Depends, Request
 from typing import Dict
-from ..services import PreferencesManager, SavedPreferencesModel
+from ..services import PreferencesManager, SavedPreferencesModel, SchedulingManager, DeviceManager
 
 preferences_router = APIRouter(tags=['preferences'])
 
@@ -21,7 +21,16 @@ def get_preferences(request: Request) -> SavedPreferencesModel:
 def set_preferences(request: Request, preferences: SavedPreferencesModel):
     preferences_manager: PreferencesManager = request.app.state.preferences_manager
 
-    preferences_manager.save(preferences)
+    # Clients post the sections they know of, e.g. the preferences page only sends the default stream
+    preferences_manager.update(preferences)
+
+    # Engines pick up their policy on the next stream start, the API is re-pinned right away
+    scheduling_manager: SchedulingManager = request.app.state.scheduling_manager
+    scheduling_manager.apply_api_policy()
+
+    # The tether budget may have changed
+    device_manager: DeviceManager = request.app.state.device_manager
+    device_manager.tether_budget.request_rebalance()
 
     return {}
 
@@ -14,11 +14,13 @@ from .services import *
 from .routes import *
 from .logging import LogHandler
 from .schemas import FeatureSupport
+from .shutdown import ShutdownCoordinator
 
 from fastapi import FastAPI
 import socketio
 
 import logging
+import asyncio
 import datetime
 
 
@@ -69,9 +71,29 @@ class Server:
         self.settings_manager = SettingsManager(settings_path)
         self.preferences_manager = PreferencesManager(settings_path)
 
+        # Software H.264 encoder selection, benchmarks are cached next to the settings
+        self.encoder_registry = H264EncoderRegistry(settings_path)
+
+        # CPU affinity and priorities, configured in the preferences
+        self.scheduling_manager = SchedulingManager(
+            lambda: self.preferences_manager.get_preferences().scheduling)
+
+        # USB bandwidth admission control, configured in the preferences
+        self.bandwidth_planner = BandwidthPlanner(
+            lambda: self.preferences_manager.get_preferences().bandwidth)
+
+        # Bitrates of the cameras within the uplink of the tether, configured in the preferences
+        self.tether_budget = TetherBudgetManager(
+            lambda: self.preferences_manager.get_preferences().tether)
+
+        # Bitrates adapted to the receivers' loss reports, configured in the preferences
+        self.adaptive_bitrate = AdaptiveBitrateController(
+            lambda: self.preferences_manager.get_preferences().adaptive_bitrate)
+
         # Device Manager
         self.device_manager = DeviceManager(
-            settings_manager=self.settings_manager, sio=self.sio, use_serial=self.feature_support.serial
+            settings_manager=self.settings_manager, sio=self.sio, use_serial=self.feature_support.serial, encoder_registry=self.encoder_registry, scheduler=self.scheduling_manager,
+            bandwidth_planner=self.bandwidth_planner, tether_budget=self.tether_budget, adaptive_bitrate=self.adaptive_bitrate
         )
 
         # Lights
@@ -129,6 +151,7 @@ class Server:
         self.app.state.light_manager = self.light_manager
         self.app.state.settings_manager = self.settings_manager
         self.app.state.preferences_manager = self.preferences_manager
+        self.app.state.scheduling_manager = self.scheduling_manager
         self.app.state.system_manager = self.system_manager
         self.app.state.ttyd_manager = (
             self.ttyd_manager if self.feature_support.ttyd else None
@@ -176,14 +199,32 @@ class Server:
         else:
             self.server_logger.info("Running without TTYD")
 
-    def shutdown(self):
+        # After everything above started its threads, so they stay off the stream engines' CPUs
+        self.scheduling_manager.apply_api_policy()
+
+    async def shutdown(self):
         self.server_logger.info("Shutting down")
 
-        self.light_manager.cleanup()
-        self.device_manager.stop_monitoring()
+        loop = asyncio.get_running_loop()
+        coordinator = ShutdownCoordinator()
+
+        coordinator.add_step("lights", self.light_manager.cleanup)
+
+        # Every stream (and recording EOS) stops at the same time
+        for (bus_info, wait) in self.device_manager.stop_monitoring().items():
+            coordinator.add_step(
+                f"stream {bus_info}", wait, lambda bus_info=bus_info: self.device_manager.kill_stream(bus_info))
+
+        coordinator.add_step("settings", self.settings_manager.stop)
 
         if self.feature_support.ttyd:
-            self.ttyd_manager.kill()
+            coordinator.add_step("ttyd", self.ttyd_manager.kill)
 
         if self.feature_support.wifi:
-            self.wifi_manager.stop_scanning()
+            # The wifi manager runs on the event loop, which is free while the coordinator runs
+            scanning_stopped = asyncio.run_coroutine_threadsafe(
+                self.wifi_manager.stop_scanning(), loop)
+            coordinator.add_step(
+                "wifi", scanning_stopped.result, scanning_stopped.cancel)
+
+        return await asyncio.to_thread(coordinator.run)
@@ -9,3 +9,10 @@ from .settings import *
 from .shd import *
 from .stream_runner import *
 from .exceptions import *
+
+from .stream_engines.encoders import H264EncoderRegistry
+from .stream_engines.scheduling import SchedulingManager
+from .bandwidth_planner import BandwidthPlanner
+from .tether_budget import TetherBudgetManager
+from .adaptive_bitrate import AdaptiveBitrateController
+from .resource_usage import ResourceMonitor
@@ -0,0 +1,326 @@
+"""
+adaptive_bitrate.py
+
+Adapts the bitrate of H.264 streams sent over UDP to the loss their receivers report
+Receivers send RTCP receiver reports (e.g. an rtpbin with its RTCP sent to the feedback port), or for receivers without
+RTCP such as the synchronized protocol's, a JSON datagram {"ssrc": <ssrc>, "fraction_lost": <0..1>}. Reports are matched
+to streams by the SSRC of their RTP packets.
+
+The loop is additive increase, multiplicative decrease: the bitrate drops by a quarter on loss, and grows slowly while
+the link is clean. Between the two thresholds it holds, and every change waits for reports made after the previous one,
+so the camera is not reconfigured on every report.
+"""
+
+import json
+import logging
+import socket
+import struct
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from .device import Device
+from .pydantic_schemas import (
+    AdaptiveBitrateModel, AdaptiveBitrateStatusModel, StreamEncodeTypeEnum, StreamTypeEnum,
+)
+
+RTCP_SR = 200
+RTCP_RR = 201
+RTCP_REPORT_BLOCK_LENGTH = 24
+# RTP clock rate of H.264, the unit of the reported jitter
+H264_CLOCK_RATE = 90000
+
+
+@dataclass
+class ReceiverReport:
+    """
+    Attributes:
+        reporter       SSRC of the receiver, or its address for JSON feedback
+        ssrc           SSRC of the stream reported on
+        fraction_lost  fraction of the packets lost since the receiver's previous report
+        jitter         interarrival jitter in RTP clock units, None if unknown
+    """
+    reporter: str
+    ssrc: int
+    fraction_lost: float
+    jitter: Optional[int] = None
+    received_at: float = field(default_factory=time.monotonic)
+
+
+def parse_rtcp(data: bytes) -> List[ReceiverReport]:
+    """
+    Get the report blocks of the sender and receiver reports of a compound RTCP packet
+    """
+    reports: List[ReceiverReport] = []
+    offset = 0
+    while offset + 8 <= len(data):
+        (first, packet_type, length) = struct.unpack_from("!BBH", data, offset)
+        if first >> 6 != 2:
+            break
+        end = offset + (length + 1) * 4
+        if end > len(data):
+            break
+        count = first & 0x1F
+        (reporter,) = struct.unpack_from("!I", data, offset + 4)
+        blocks = None
+        if packet_type == RTCP_RR:
+            blocks = offset + 8
+        elif packet_type == RTCP_SR:
+            # NTP timestamp, RTP timestamp, packet and octet counts
+            blocks = offset + 28
+        if blocks is not None:
+            for i in range(count):
+                block = blocks + i * RTCP_REPORT_BLOCK_LENGTH
+                if block + RTCP_REPORT_BLOCK_LENGTH > end:
+                    break
+                (ssrc, fraction_lost) = struct.unpack_from("!IB", data, block)
+                (jitter,) = struct.unpack_from("!I", data, block + 12)
+                reports.append(ReceiverReport(
+                    reporter=f"{reporter:08x}", ssrc=ssrc, fraction_lost=fraction_lost / 256, jitter=jitter))
+        offset = end
+    return reports
+
+
+def parse_feedback(data: bytes, address: Tuple[str, int]) -> List[ReceiverReport]:
+    """
+    Get the reports of a feedback datagram, RTCP or JSON
+    """
+    if len(data) > 0 and data[:1] == b"{":
+        try:
+            feedback = json.loads(data)
+            return [ReceiverReport(reporter=f"{address[0]}:{address[1]}", ssrc=int(feedback["ssrc"]),
+                                   fraction_lost=min(max(float(feedback["fraction_lost"]), 0), 1))]
+        except (ValueError, KeyError, TypeError):
+            return []
+    return parse_rtcp(data)
+
+
+class FeedbackListener:
+    """
+    Receives the reports of every receiver on one UDP port, keeping the recent ones by SSRC
+    """
+
+    RECV_SIZE = 2048
+
+    def __init__(self, port: int, window: float) -> None:
+        self.port = port
+        self.window = window
+        self.logger = logging.getLogger("dwe_os_2.cameras.FeedbackListener")
+
+        self._lock = threading.Lock()
+        self._reports: Dict[int, Deque[ReceiverReport]] = {}
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(("0.0.0.0", port))
+        self._closed = False
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def close(self):
+        self._closed = True
+        self._socket.close()
+
+    def recent(self, ssrc: int) -> List[ReceiverReport]:
+        """
+        Reports on a stream received within the window
+        """
+        now = time.monotonic()
+        with self._lock:
+            reports = self._reports.get(ssrc)
+            if not reports:
+                return []
+            while reports and now - reports[0].received_at > self.window:
+                reports.popleft()
+            return list(reports)
+
+    def _run(self):
+        while not self._closed:
+            try:
+                (data, address) = self._socket.recvfrom(self.RECV_SIZE)
+            except OSError:
+                break
+            reports = parse_feedback(data, address)
+            with self._lock:
+                for report in reports:
+                    self._reports.setdefault(report.ssrc, deque(maxlen=64)).append(report)
+
+
+@dataclass
+class _StreamState:
+    bitrate: float
+    # Time of the last change, reports from before it do not reflect the current bitrate
+    changed_at: float = 0
+    # Time of the last report above the increase threshold
+    lossy_at: float = 0
+
+
+class AdaptiveBitrateController:
+    """
+    Adjusts the bitrate of every adaptable stream from its receivers' reports, stepped about once per second
+    """
+
+    # Reports older than this are ignored, RTCP receivers report about every 5 seconds
+    REPORT_WINDOW = 6
+    # Loss above which the bitrate is decreased, and below which it may increase
+    DECREASE_LOSS = 0.05
+    INCREASE_LOSS = 0.01
+    DECREASE_FACTOR = 0.75
+    # Increase step, the larger of the two
+    INCREASE_MBPS = 0.5
+    INCREASE_RATIO = 0.05
+    # Time without loss (and since the last change) before increasing
+    INCREASE_AFTER = 10
+    # Shortest time between changes, software H.264 restarts its stream on every change
+    MIN_INTERVAL = 3
+    SOFTWARE_MIN_INTERVAL = 30
+    # Changes smaller than the 0.1 Mbps step of the bitrate controls are not applied
+    MIN_CHANGE_MBPS = 0.1
+
+    def __init__(self, get_settings: Callable[[], AdaptiveBitrateModel] = AdaptiveBitrateModel) -> None:
+        self._get_settings = get_settings
+        self.logger = logging.getLogger(
+            "dwe_os_2.cameras.AdaptiveBitrateController")
+
+        self._listener: Optional[FeedbackListener] = None
+        # By (bus_info, secondary)
+        self._states: Dict[Tuple[str, bool], _StreamState] = {}
+        self._status: List[AdaptiveBitrateStatusModel] = []
+
+    @property
+    def settings(self) -> AdaptiveBitrateModel:
+        return self._get_settings()
+
+    def close(self):
+        if self._listener:
+            self._listener.close()
+            self._listener = None
+
+    def controlled_streams(self, devices: List[Device]) -> Set[Tuple[str, bool]]:
+        """
+        Streams whose bitrate is set by this controller, by (bus_info, secondary)
+        """
+        if not self.settings.enabled:
+            return set()
+        return {(device.bus_info, secondary) for (device, secondary) in self._adaptable(devices)}
+
+    def get_status(self) -> List[AdaptiveBitrateStatusModel]:
+        return self._status
+
+    def step(self, devices: List[Device], get_ceiling: Callable[[str, bool], Optional[float]] = lambda *_: None) -> List[AdaptiveBitrateStatusModel]:
+        """
+        Apply the reports received since the last step, returns the streams whose bitrate changed
+        get_ceiling returns the tether budget's allocation of a stream, if any
+        """
+        settings = self.settings
+        if not settings.enabled:
+            self.close()
+            self._states.clear()
+            self._status = []
+            return []
+        if not self._listener or self._listener.port != settings.feedback_port:
+            self.close()
+            try:
+                self._listener = FeedbackListener(
+                    settings.feedback_port, self.REPORT_WINDOW)
+            except OSError as e:
+                self.logger.error(
+                    f"Unable to receive feedback on port {settings.feedback_port}: {e}")
+                return []
+
+        now = time.monotonic()
+        changed: List[AdaptiveBitrateStatusModel] = []
+        status: List[AdaptiveBitrateStatusModel] = []
+        adaptable = self._adaptable(devices)
+        for (device, secondary) in adaptable:
+            stream = device.secondary_stream if secondary else device.stream
+            key = (device.bus_info, secondary)
+            state = self._states.get(key)
+            if state is None:
+                # Read once, the camera's controls are not polled
+                current = device.get_stream_bitrate(secondary)
+                if current is None:
+                    continue
+                state = _StreamState(bitrate=current, changed_at=now)
+                self._states[key] = state
+
+            ceiling = settings.max_mbps
+            allocation = get_ceiling(device.bus_info, secondary)
+            if allocation is not None:
+                ceiling = min(ceiling, allocation)
+            ceiling = max(ceiling, settings.min_mbps)
+
+            reports = self._listener.recent(stream.ssrc)
+            # The latest report of each receiver
+            latest: Dict[str, ReceiverReport] = {}
+            for report in reports:
+                latest[report.reporter] = report
+            fresh = [report for report in reports if report.received_at > state.changed_at]
+            loss = max((report.fraction_lost for report in fresh), default=None)
+            if loss is not None and loss > self.INCREASE_LOSS:
+                state.lossy_at = now
+
+            min_interval = self.SOFTWARE_MIN_INTERVAL if stream.encode_type == StreamEncodeTypeEnum.SOFTWARE_H264 else self.MIN_INTERVAL
+            target = state.bitrate
+            # A lowered ceiling waits for the interval too, every tether rebalance would restart software streams
+            if now - state.changed_at < min_interval:
+                pass
+            elif state.bitrate > ceiling:
+                target = ceiling
+            elif loss is not None:
+                if loss >= self.DECREASE_LOSS:
+                    target = max(state.bitrate *
+                                 self.DECREASE_FACTOR, settings.min_mbps)
+                elif loss <= self.INCREASE_LOSS and now - max(state.changed_at, state.lossy_at) >= self.INCREASE_AFTER:
+                    target = min(state.bitrate + max(self.INCREASE_MBPS, state.bitrate * self.INCREASE_RATIO), ceiling)
+            # Rounded to the 0.1 Mbps step of the bitrate controls
+            target = round(target, 1)
+
+            adapted = abs(target - state.bitrate) >= self.MIN_CHANGE_MBPS
+            if adapted:
+                self.logger.info(
+                    f"{device.bus_info}: {'Secondary stream' if secondary else 'Stream'} bitrate {state.bitrate} -> {target} Mbps "
+                    f"(loss {'unknown' if loss is None else f'{loss:.1%}'})")
+                device.set_stream_bitrate(target, secondary)
+                state.bitrate = target
+                state.changed_at = now
+
+            jitters = [report.jitter for report in latest.values()
+                       if report.jitter is not None]
+            stream_status = AdaptiveBitrateStatusModel(
+                bus_info=device.bus_info,
+                secondary=secondary,
+                ssrc=stream.ssrc,
+                bitrate_mbps=state.bitrate,
+                ceiling_mbps=round(ceiling, 1),
+                fraction_lost=max((report.fraction_lost for report in latest.values()), default=None),
+                jitter_ms=round(max(jitters) * 1000 / H264_CLOCK_RATE, 1) if len(jitters) > 0 else None,
+                receivers=len(latest),
+            )
+            status.append(stream_status)
+            if adapted:
+                changed.append(stream_status)
+
+        # Forget the streams that stopped, they start over from their bitrate when they run again
+        keys = {(device.bus_info, secondary) for (device, secondary) in adaptable}
+        self._states = {key: state for (key, state) in self._states.items() if key in keys}
+        self._status = status
+        return changed
+
+    @staticmethod
+    def _adaptable(devices: List[Device]) -> List[Tuple[Device, bool]]:
+        """
+        Running H.264 streams sent over UDP (RTP) whose bitrate can be set
+        """
+        adaptable = []
+        for device in devices:
+            if getattr(device, "is_managed", False):
+                continue
+            for secondary in [False, True]:
+                stream = device.secondary_stream if secondary else device.stream
+                runner = device.secondary_stream_runner if secondary else device.stream_runner
+                if not stream or not stream.enabled or not runner.started or stream.stream_type != StreamTypeEnum.UDP:
+                    continue
+                if stream.encode_type in [StreamEncodeTypeEnum.H264, StreamEncodeTypeEnum.SOFTWARE_H264] and device.can_set_bitrate(stream.encode_type):
+                    adaptable.append((device, secondary))
+        return adaptable
@@ -0,0 +1,292 @@
+"""
+bandwidth_planner.py
+
+Admission control for the USB bandwidth of the configured streams
+Maps each device to the root hub and host controller it is connected to through sysfs, estimates the isochronous
+bandwidth of each stream from its format, resolution and fps, and flags configurations that oversubscribe a root hub
+(see docs/kernel-uvc-issue.md, the UVC driver and XHCI controllers misbehave well before the theoretical limit)
+Also picks the next cheaper configuration of a stream that failed for lack of bandwidth
+"""
+
+import os
+import re
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+from .device import Device
+from .pydantic_schemas import (
+    BandwidthModel, BandwidthPlanModel, UsbControllerPlanModel, UsbStreamAllocationModel,
+    StreamInfoModel, StreamEncodeTypeEnum, StreamFallbackModel, StreamFormatModel, FallbackStepEnum,
+    FormatSizeModel, IntervalModel,
+)
+
+SYSFS_VIDEO4LINUX = "/sys/class/video4linux"
+
+
+@dataclass
+class UsbTopology:
+    """
+    Where a device is connected
+
+    Attributes:
+        root_hub     name of the root hub (bus) the device is on, e.g. usb1
+        controller   host controller the root hub belongs to, e.g. 0000:01:00.0 or xhci-hcd.0
+        speed_mbps   signaling rate of the root hub, 480 for USB 2.0
+    """
+    root_hub: str
+    controller: str
+    speed_mbps: int = 480
+
+
+def find_usb_topology(device_path: str, bus_info: str) -> UsbTopology:
+    """
+    Find the root hub and host controller of a V4L2 device
+
+    Falls back to the controller named in the bus_info (usb-<controller>-<port>) when sysfs cannot be read
+    """
+    try:
+        # e.g. /sys/devices/platform/.../xhci-hcd.0/usb1/1-1/1-1.2/1-1.2:1.0
+        interface = os.path.realpath(
+            os.path.join(SYSFS_VIDEO4LINUX, os.path.basename(device_path), "device"))
+        parts = interface.split(os.sep)
+        index = max(i for (i, part) in enumerate(parts)
+                    if re.fullmatch(r"usb\d+", part))
+        root_hub = os.sep.join(parts[:index + 1])
+        with open(os.path.join(root_hub, "speed")) as f:
+            speed_mbps = int(float(f.read().strip()))
+        return UsbTopology(parts[index], parts[index - 1], speed_mbps)
+    except (OSError, ValueError):
+        controller = bus_info.removeprefix("usb-").rsplit("-", 1)[0]
+        return UsbTopology(controller, controller)
+
+
+class BandwidthPlanner:
+    """
+    Estimates the USB bandwidth of the enabled streams, per root hub
+
+    USB 2.0 cameras on a USB 3 controller share its high-speed root hub, so the root hub is the unit of the budget.
+    The budgets are configured in the preferences, since what a controller sustains depends on the hardware.
+    """
+
+    # Compressed size of an MJPEG frame, the UVC driver reserves bandwidth for close to the worst case
+    MJPEG_BITS_PER_PIXEL = 2.0
+    # Peaks over the configured H.264 bitrate (keyframes, variable bitrate)
+    H264_HEADROOM = 1.5
+    # Bitrate of H.264 devices without a bitrate option, in Mbps
+    DEFAULT_H264_MBPS = 10
+
+    def __init__(self, get_settings: Callable[[], BandwidthModel] = BandwidthModel) -> None:
+        self._get_settings = get_settings
+
+        # Topology by bus_info, devices do not move without being removed
+        self._topologies: Dict[str, UsbTopology] = {}
+
+    @property
+    def settings(self) -> BandwidthModel:
+        return self._get_settings()
+
+    def forget(self, bus_info: str):
+        self._topologies.pop(bus_info, None)
+
+    def estimate_mbps(self, device: Device, encode_type: StreamEncodeTypeEnum, width: int, height: int, fps: float) -> float:
+        """
+        Estimate the USB bandwidth of a stream in Mbps
+        """
+        if encode_type == StreamEncodeTypeEnum.H264:
+            # The bitrate option is in Mbps
+            bitrate = device.get_option("bitrate")
+            return float(bitrate or self.DEFAULT_H264_MBPS) * self.H264_HEADROOM
+        # Software H.264 is encoded from the MJPEG node
+        return width * height * fps * self.MJPEG_BITS_PER_PIXEL / 1_000_000
+
+    def plan(self, devices: List[Device], proposed: Optional[StreamInfoModel] = None, proposed_secondary: bool = False) -> BandwidthPlanModel:
+        """
+        Plan the bandwidth of the enabled streams, with the proposed stream configuration replacing its device's
+        main stream, or its secondary stream if proposed_secondary is set
+        """
+        settings = self.settings
+        allocations: Dict[str, List[UsbStreamAllocationModel]] = {}
+        topologies: Dict[str, UsbTopology] = {}
+        devices_by_bus_info = {device.bus_info: device for device in devices}
+
+        for device in devices:
+            for secondary in [False, True]:
+                if not secondary and getattr(device, "is_managed", False):
+                    # Streamed with its leader's format
+                    continue
+
+                if proposed and proposed.bus_info == device.bus_info and proposed_secondary == secondary:
+                    if not proposed.enabled:
+                        continue
+                    stream_format = proposed.stream_format
+                    (encode_type, width, height, interval) = (
+                        proposed.encode_type, stream_format.width, stream_format.height, stream_format.interval)
+                else:
+                    stream = device.secondary_stream if secondary else device.stream
+                    if not stream or not stream.enabled:
+                        continue
+                    (encode_type, width, height, interval) = (
+                        stream.encode_type, stream.width, stream.height, stream.interval)
+
+                # Followers stream the main stream's format along with their leader
+                group = [device] if secondary else [device] + [
+                    devices_by_bus_info[bus_info] for bus_info in getattr(device, "followers", []) if bus_info in devices_by_bus_info]
+                fps = interval.denominator / interval.numerator
+                for member in group:
+                    topology = self._topology(member)
+                    topologies[topology.root_hub] = topology
+                    allocations.setdefault(topology.root_hub, []).append(UsbStreamAllocationModel(
+                        bus_info=member.bus_info,
+                        secondary=secondary,
+                        encode_type=encode_type,
+                        width=width,
+                        height=height,
+                        fps=fps,
+                        mbps=round(self.estimate_mbps(
+                            member, encode_type, width, height, fps), 1),
+                    ))
+
+        controllers: List[UsbControllerPlanModel] = []
+        for (root_hub, streams) in allocations.items():
+            topology = topologies[root_hub]
+            budget = settings.usb2_budget_mbps if topology.speed_mbps <= 480 else settings.usb3_budget_mbps
+            allocated = sum(stream.mbps for stream in streams)
+            oversubscribed = allocated > budget
+            controllers.append(UsbControllerPlanModel(
+                root_hub=root_hub,
+                controller=topology.controller,
+                speed_mbps=topology.speed_mbps,
+                budget_mbps=budget,
+                allocated_mbps=round(allocated, 1),
+                oversubscribed=oversubscribed,
+                streams=streams,
+                suggestions=self._suggest(
+                    streams, budget, allocated, devices_by_bus_info) if oversubscribed else [],
+            ))
+
+        return BandwidthPlanModel(
+            admission=settings.admission,
+            accepted=not any(controller.oversubscribed for controller in controllers),
+            controllers=controllers,
+        )
+
+    def next_fallback(self, device: Device, error: Optional[str] = None) -> Optional[StreamFallbackModel]:
+        """
+        Get the first configuration in the fallback order that is cheaper than the device's stream, None if there is none
+        """
+        stream = device.stream
+        current = StreamFormatModel(
+            width=stream.width, height=stream.height, interval=stream.interval)
+        fps = stream.interval.denominator / stream.interval.numerator
+        # Software H.264 is encoded from the MJPEG node
+        source = "H264" if stream.encode_type == StreamEncodeTypeEnum.H264 else "MJPG"
+
+        for step in self.settings.fallback_order:
+            encode_type = stream.encode_type
+            target: Optional[StreamFormatModel] = None
+            match step:
+                case FallbackStepEnum.H264:
+                    if stream.encode_type == StreamEncodeTypeEnum.H264:
+                        continue
+                    encode_type = StreamEncodeTypeEnum.H264
+                    if self._find_size(device, "H264", stream.width, stream.height):
+                        target = current
+                case FallbackStepEnum.LOWER_FPS:
+                    size = self._find_size(
+                        device, source, stream.width, stream.height)
+                    lower = [interval for interval in (size.intervals if size else [])
+                             if interval.denominator / interval.numerator < fps]
+                    if len(lower) > 0:
+                        target = StreamFormatModel(width=stream.width, height=stream.height, interval=max(
+                            lower, key=lambda interval: interval.denominator / interval.numerator))
+                case FallbackStepEnum.LOWER_RESOLUTION:
+                    camera = device.find_camera_with_format(source)
+                    smaller = [size for size in (camera.formats[source] if camera else [])
+                               if size.width * size.height < stream.width * stream.height and len(size.intervals) > 0]
+                    if len(smaller) > 0:
+                        size = max(smaller, key=lambda size: size.width * size.height)
+                        target = StreamFormatModel(
+                            width=size.width, height=size.height, interval=self._closest_interval(size.intervals, fps))
+
+            if target is not None:
+                return StreamFallbackModel(
+                    bus_info=device.bus_info,
+                    step=step,
+                    error=error,
+                    from_encode_type=stream.encode_type,
+                    from_format=current,
+                    to_encode_type=encode_type,
+                    to_format=target,
+                )
+        return None
+
+    @staticmethod
+    def _find_size(device: Device, fmt: str, width: int, height: int) -> Optional[FormatSizeModel]:
+        camera = device.find_camera_with_format(fmt)
+        if not camera:
+            return None
+        for size in camera.formats[fmt]:
+            if (size.width, size.height) == (width, height):
+                return size
+        return None
+
+    @staticmethod
+    def _closest_interval(intervals: List[IntervalModel], fps: float) -> IntervalModel:
+        """
+        Get the highest frame rate up to fps, or the lowest one if they are all higher
+        """
+        rates = [(interval.denominator / interval.numerator, interval)
+                 for interval in intervals]
+        below = [rate for rate in rates if rate[0] <= fps]
+        if len(below) > 0:
+            return max(below, key=lambda rate: rate[0])[1]
+        return min(rates, key=lambda rate: rate[0])[1]
+
+    def _topology(self, device: Device) -> UsbTopology:
+        topology = self._topologies.get(device.bus_info)
+        if not topology:
+            topology = find_usb_topology(
+                device.cameras[0].path, device.bus_info)
+            self._topologies[device.bus_info] = topology
+        return topology
+
+    def _suggest(self, streams: List[UsbStreamAllocationModel], budget: float, allocated: float, devices: Dict[str, Device]) -> List[str]:
+        """
+        Suggest changes to single streams that would bring the root hub within its budget
+        """
+        suggestions: List[str] = []
+        excess = allocated - budget
+        for stream in sorted(streams, key=lambda stream: stream.mbps, reverse=True):
+            device = devices[stream.bus_info]
+            # The H.264 node of a device with a secondary stream is usually taken by the main stream
+            if not stream.secondary and stream.encode_type != StreamEncodeTypeEnum.H264 and device.find_camera_with_format("H264"):
+                h264_mbps = self.estimate_mbps(
+                    device, StreamEncodeTypeEnum.H264, stream.width, stream.height, stream.fps)
+                if stream.mbps - h264_mbps >= excess:
+                    suggestions.append(
+                        f"Stream {stream.bus_info} as H.264 (~{h264_mbps:.0f} Mbps instead of ~{stream.mbps:.0f} Mbps)")
+
+            if stream.encode_type == StreamEncodeTypeEnum.H264:
+                continue
+            # Highest supported frame rate at this resolution that fits
+            camera = device.find_camera_with_format("MJPG")
+            if not camera:
+                continue
+            for size in camera.formats["MJPG"]:
+                if (size.width, size.height) != (stream.width, stream.height):
+                    continue
+                rates = sorted((interval.denominator / interval.numerator
+                                for interval in size.intervals), reverse=True)
+                for fps in rates:
+                    if fps >= stream.fps:
+                        continue
+                    mbps = self.estimate_mbps(
+                        device, stream.encode_type, stream.width, stream.height, fps)
+                    if stream.mbps - mbps >= excess:
+                        suggestions.append(
+                            f"Lower {stream.bus_info} to {fps:g} fps (~{mbps:.0f} Mbps instead of ~{stream.mbps:.0f} Mbps)")
+                        break
+        if len(suggestions) == 0:
+            suggestions.append(
+                f"Disable a stream, or move a camera to another USB controller ({excess:.0f} Mbps over budget)")
+        return suggestions
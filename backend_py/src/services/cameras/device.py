@@ -23,6 +23,12 @@ from .stream_utils import fourcc2s
 from .enumeration import *
 from .camera_helper.camera_helper_loader import *
 from .stream_runner import Stream, StreamRunner
+from .stream_engines.frame_tap import FrameTap
+from .stream_engines.instant_recorder import InstantRecorder
+from .preview import V4L2PreviewSource
+from .snapshot import capture_snapshots
+from .timelapse import TimelapseCapture
+from .diagnostics import PipelineDiagnostics
 from .stream_utils import string_to_stream_encode_type
 from .pydantic_schemas import *
 from .saved_pydantic_schemas import *
@@ -88,6 +94,20 @@ class Camera:
     def has_format(self, pixformat: str) -> bool:
         return pixformat in self.formats.keys()
 
+    def force_key_frame(self) -> bool:
+        """
+        Ask the encoder of this node for a keyframe with the standard V4L2 control
+        Returns False if the driver does not support it (uvcvideo only maps it for UVC 1.5 encoding units)
+        """
+        control = v4l2.v4l2_control()
+        control.id = v4l2.V4L2_CID_MPEG_VIDEO_FORCE_KEY_FRAME
+        control.value = 1
+        try:
+            fcntl.ioctl(self._fd, v4l2.VIDIOC_S_CTRL, control)
+        except OSError:
+            return False
+        return True
+
     def _get_formats(self):
         self.formats: Dict[str, List[FormatSizeModel]] = {}
         for i in range(1000):
@@ -273,12 +293,30 @@ class Device(events.EventEmitter):
             return
         self.bus_info = device_info.bus_info
         self.nickname = ""
-        self.stream = Stream()
+        self.stream = Stream(bus_info=self.bus_info)
 
         # each device has a streamrunner, but not all of them are used if they are a follower (shd)
         self.stream_runner = StreamRunner(
             self.stream)
 
+        # Optional second stream from another node of the camera (e.g. full resolution H.264 plus a small MJPEG),
+        # so neither has to be decoded and re-encoded on the CPU
+        self.secondary_stream: Stream | None = None
+        self.secondary_stream_runner = StreamRunner()
+
+        # Captures the MJPEG node for the browser preview while the device is not streaming
+        self._preview_source: V4L2PreviewSource | None = None
+
+        # Interval capture of stills, kept after it finished for its status
+        self.timelapse: TimelapseCapture | None = None
+
+        # Last pipeline diagnostics session, kept after it finished for its results
+        self.diagnostics: PipelineDiagnostics | None = None
+
+        # Recorders of the last instant recordings, which outlive the engine that made them
+        self._recorder: InstantRecorder | None = None
+        self._secondary_recorder: InstantRecorder | None = None
+
         for camera in self.cameras:
             for encoding in camera.formats:
                 encode_type = string_to_stream_encode_type(encoding)
@@ -381,26 +419,26 @@ class Device(events.EventEmitter):
         interval: IntervalModel,
         stream_type: StreamTypeEnum,
         stream_endpoints: List[StreamEndpointModel] = [],
+        recording: RecordingOptionsModel | None = None,
+        engine: str | None = None,
+        latency_profile: LatencyProfileEnum = LatencyProfileEnum.BALANCED,
+        srt: SrtOptionsModel | None = None,
     ):
         self.logger.info(self._fmt_log("Configuring stream"))
 
-        camera: Camera = None
-        match encode_type:
-            case StreamEncodeTypeEnum.H264:
-                camera = self.find_camera_with_format("H264")
-            case StreamEncodeTypeEnum.MJPG:
-                camera = self.find_camera_with_format("MJPG")
-            case StreamEncodeTypeEnum.SOFTWARE_H264:
-                camera = self.find_camera_with_format("MJPG")
-            case _:
-                pass
-
+        camera = self._find_camera_for_encode_type(encode_type)
         if not camera:
             self.logger.warning(
                 "Attempting to select incompatible encoding type. This is undefined behavior."
             )
             return
 
+        if self.secondary_stream and self.secondary_stream.enabled and self.secondary_stream.device_path == camera.path:
+            # A node only streams once
+            self.logger.warning(self._fmt_log(
+                f"Stopping the secondary stream, {camera.path} is now used by the main stream"))
+            self.stop_secondary_stream()
+
         self.stream.device_path = camera.path
         self.stream.width = width
         self.stream.height = height
@@ -408,9 +446,16 @@ class Device(events.EventEmitter):
         self.stream.endpoints = stream_endpoints
         self.stream.encode_type = encode_type
         self.stream.stream_type = stream_type
+        if recording is not None:
+            self.stream.recording = recording
+        self.stream.engine = engine
+        self.stream.latency_profile = latency_profile
+        if srt is not None:
+            self.stream.srt = srt
 
         # Update the pwm frequency with the new fps
         self.emit("pwm_frequency", self.stream.interval.denominator)
+        self.emit("stream_configured", False)
 
     def add_control_from_option(
         self,
@@ -448,14 +493,100 @@ class Device(events.EventEmitter):
             )
             self.logger.error("Failed to add option to controls list.")
 
+    def _find_camera_for_encode_type(self, encode_type: StreamEncodeTypeEnum) -> Camera | None:
+        match encode_type:
+            case StreamEncodeTypeEnum.H264:
+                return self.find_camera_with_format("H264")
+            case StreamEncodeTypeEnum.MJPG:
+                return self.find_camera_with_format("MJPG")
+            case StreamEncodeTypeEnum.SOFTWARE_H264:
+                return self.find_camera_with_format("MJPG")
+            case _:
+                return None
+
+    def configure_secondary_stream(
+        self,
+        encode_type: StreamEncodeTypeEnum,
+        width: int,
+        height: int,
+        interval: IntervalModel,
+        stream_type: StreamTypeEnum,
+        stream_endpoints: List[StreamEndpointModel] = [],
+        recording: RecordingOptionsModel | None = None,
+        engine: str | None = None,
+        latency_profile: LatencyProfileEnum = LatencyProfileEnum.BALANCED,
+        srt: SrtOptionsModel | None = None,
+    ) -> bool:
+        """
+        Configure the secondary stream, which must use another node than the main stream
+        Returns False if the encoding has no node of its own
+        """
+        self.logger.info(self._fmt_log("Configuring secondary stream"))
+
+        camera = self._find_camera_for_encode_type(encode_type)
+        if not camera or camera.path == self.stream.device_path:
+            self.logger.warning(self._fmt_log(
+                f"No node other than the main stream's ({self.stream.device_path}) supports {encode_type.value}"))
+            return False
+
+        stream = self.secondary_stream or Stream(bus_info=self.bus_info)
+        stream.device_path = camera.path
+        stream.encode_type = encode_type
+        stream.width = width
+        stream.height = height
+        stream.interval = interval
+        stream.stream_type = stream_type
+        stream.endpoints = stream_endpoints
+        if recording is not None:
+            stream.recording = recording
+        stream.engine = engine
+        stream.latency_profile = latency_profile
+        if srt is not None:
+            stream.srt = srt
+        self.secondary_stream = stream
+        self.secondary_stream_runner.streams = [stream]
+        self.emit("stream_configured", True)
+        return True
+
+    @property
+    def stream_state(self) -> StreamStateEnum:
+        return self.stream_runner.state
+
+    @property
+    def secondary_stream_state(self) -> StreamStateEnum:
+        return self.secondary_stream_runner.state
+
     def start_stream(self):
-        self.stream.enabled = True
-        self.stream_runner.start()
+        if not self.stream.enabled:
+            self.stream.enabled = True
+            self.emit("stream_configured", False)
+        # The preview and timelapse captures would keep the node busy
+        self._close_preview_source()
+        self._release_timelapse()
+        self.stream_runner.start(self._wait_timelapse_released)
 
     def stop_stream(self):
-        self.stream.enabled = False
+        if self.stream.enabled:
+            self.stream.enabled = False
+            self.emit("stream_configured", False)
         self.stream_runner.stop()
 
+    def start_secondary_stream(self):
+        if not self.secondary_stream:
+            return
+        if not self.secondary_stream.enabled:
+            self.secondary_stream.enabled = True
+            self.emit("stream_configured", True)
+        self._close_preview_source()
+        self._release_timelapse()
+        self.secondary_stream_runner.start(self._wait_timelapse_released)
+
+    def stop_secondary_stream(self):
+        if self.secondary_stream and self.secondary_stream.enabled:
+            self.secondary_stream.enabled = False
+            self.emit("stream_configured", True)
+        self.secondary_stream_runner.stop()
+
     def load_settings(self, saved_device: SavedDeviceModel):
         self.logger.info(self._fmt_log("Loading device settings"))
 
@@ -472,13 +603,251 @@ class Device(events.EventEmitter):
             saved_device.stream.interval,
             saved_device.stream.stream_type,
             saved_device.stream.endpoints,
+            saved_device.stream.recording,
+            saved_device.stream.engine,
+            saved_device.stream.latency_profile,
+            saved_device.stream.srt,
         )
         self.stream.enabled = saved_device.stream.enabled
+        self.emit("stream_configured", False)
         self.nickname = saved_device.nickname
         if self.stream.enabled:
             self.start_stream()
 
+        secondary = saved_device.secondary_stream
+        if secondary and self.configure_secondary_stream(
+            secondary.encode_type,
+            secondary.width,
+            secondary.height,
+            secondary.interval,
+            secondary.stream_type,
+            secondary.endpoints,
+            secondary.recording,
+            secondary.engine,
+            secondary.latency_profile,
+            secondary.srt,
+        ) and secondary.enabled:
+            self.start_secondary_stream()
+
+    def get_frame_tap(self, low_res: bool = False) -> FrameTap | None:
+        """
+        Get a tap with the latest frames of this device, for previews and snapshots
+
+        Shares the frames of a running stream that captures MJPEG (the main one first), otherwise captures the MJPEG node directly.
+        low_res only applies in the latter case, since the frames of a running stream are not re-encoded.
+        """
+        tap = self.stream_runner.get_frame_tap() or self.secondary_stream_runner.get_frame_tap()
+        if tap:
+            return tap
+        if self.stream.enabled and not self.stream_runner.started:
+            # Starting up, do not grab the node from under the stream
+            return None
+
+        camera = self.find_camera_with_format("MJPG")
+        if not camera or any(stream and stream.enabled and camera.path == stream.device_path
+                             for stream in [self.stream, self.secondary_stream]):
+            return None
+
+        if low_res:
+            size = min(camera.formats["MJPG"],
+                       key=lambda size: size.width * size.height)
+            (width, height) = (size.width, size.height)
+            interval = size.intervals[0]
+        elif self.stream.device_path == camera.path:
+            (width, height) = (self.stream.width, self.stream.height)
+            interval = self.stream.interval
+        else:
+            size = camera.formats["MJPG"][0]
+            (width, height) = (size.width, size.height)
+            interval = size.intervals[0]
+        fps = interval.denominator // max(interval.numerator, 1)
+
+        source = self._preview_source
+        if source and (source.device_path, source.width, source.height) != (camera.path, width, height):
+            if source.tap.active:
+                # Keep serving the current viewers rather than fighting over the node
+                return source.tap
+            source.close()
+            source = None
+        if not source:
+            source = V4L2PreviewSource(camera.path, width, height, fps)
+            self._preview_source = source
+        return source.tap
+
+    def take_snapshot(self, count: int = 1) -> List[SnapshotFrameModel] | None:
+        """
+        Capture count consecutive full resolution stills, returns None if no frames are available
+        """
+        tap = self.get_frame_tap()
+        if not tap:
+            return None
+        self.logger.info(self._fmt_log(f"Capturing {count} snapshot(s)"))
+        return capture_snapshots(tap, self.bus_info, count)
+
+    def start_timelapse(self, request: TimelapseRequestModel) -> TimelapseStatusModel | None:
+        """
+        Start capturing a still from the MJPEG node every interval, returns None if the device has no such node or resolution
+        """
+        camera = self.find_camera_with_format("MJPG")
+        if not camera:
+            return None
+        if self.timelapse and self.timelapse.running:
+            return self.timelapse.status()
+
+        sizes = camera.formats["MJPG"]
+        if request.width and request.height:
+            (width, height) = (request.width, request.height)
+        elif self.stream.device_path == camera.path:
+            (width, height) = (self.stream.width, self.stream.height)
+        else:
+            (width, height) = (sizes[0].width, sizes[0].height)
+        size = next((size for size in sizes if (size.width, size.height) == (width, height)), None)
+        if not size:
+            return None
+        # Slowest framerate, so the node captures as little as possible while it is open
+        interval = max(size.intervals, key=lambda interval: interval.numerator / max(interval.denominator, 1))
+        fps = max(interval.denominator // max(interval.numerator, 1), 1)
+
+        self.logger.info(self._fmt_log(f"Starting timelapse every {request.interval_s} seconds"))
+        self.timelapse = TimelapseCapture(
+            self.bus_info, camera.path, width, height, fps, request, self._get_capture_tap,
+            lambda: not any(stream and stream.enabled and stream.device_path == camera.path
+                            for stream in [self.stream, self.secondary_stream]))
+        self.timelapse.start()
+        return self.timelapse.status()
+
+    def stop_timelapse(self) -> TimelapseStatusModel | None:
+        if not self.timelapse:
+            return None
+        self.logger.info(self._fmt_log("Stopping timelapse"))
+        self.timelapse.stop()
+        return self.timelapse.status()
+
+    def _get_capture_tap(self) -> FrameTap | None:
+        """
+        Get the tap of whatever already captures MJPEG frames of this device, without opening the node
+        """
+        tap = self.stream_runner.get_frame_tap() or self.secondary_stream_runner.get_frame_tap()
+        if tap:
+            return tap
+        if self._preview_source and self._preview_source.tap.active:
+            return self._preview_source.tap
+        return None
+
+    def start_recording(self, secondary: bool = False) -> InstantRecordingModel | None:
+        """
+        Record the running stream from its next keyframe, without restarting it
+        Returns None if the stream is not running, or cannot be recorded this way
+        """
+        runner = self.secondary_stream_runner if secondary else self.stream_runner
+        recorder = runner.get_recorder()
+        if not recorder:
+            return None
+        self.logger.info(self._fmt_log("Starting instant recording"))
+        try:
+            recording = recorder.start()
+        except RuntimeError:
+            return None
+        if secondary:
+            self._secondary_recorder = recorder
+        else:
+            self._recorder = recorder
+        return recording
+
+    def stop_recording(self, secondary: bool = False) -> InstantRecordingModel | None:
+        """
+        Stop the instant recording, returns None if there was none
+        A recording also stops with its stream, this then returns how it ended
+        """
+        recorder = self._secondary_recorder if secondary else self._recorder
+        if not recorder:
+            return None
+        self.logger.info(self._fmt_log("Stopping instant recording"))
+        return recorder.stop()
+
+    def start_diagnostics(self, request: DiagnosticsRequestModel,
+                          on_finish: Callable[[PipelineDiagnosticsModel], None] = lambda _: None) -> PipelineDiagnosticsModel | None:
+        """
+        Trace a running stream's pipeline for a while, restarting it traced and again untraced once done
+        Returns None if the stream is not running or its engine cannot be traced, and the running session if any
+        """
+        if self.diagnostics and self.diagnostics.running:
+            return self.diagnostics.status()
+        (stream, runner) = (self.secondary_stream, self.secondary_stream_runner) if request.secondary else (
+            self.stream, self.stream_runner)
+        if not stream or not stream.enabled or not runner.supports_diagnostics():
+            return None
+
+        restart = self.start_secondary_stream if request.secondary else self.start_stream
+        self.diagnostics = PipelineDiagnostics(
+            self.bus_info, stream, request, restart, runner.get_process_ids, on_finish)
+        self.diagnostics.start()
+        return self.diagnostics.status()
+
+    def get_diagnostics(self) -> PipelineDiagnosticsModel | None:
+        return self.diagnostics.status() if self.diagnostics else None
+
+    def request_keyframe(self, secondary: bool = False) -> KeyframeRequestModel | None:
+        """
+        Ask the encoder of a running stream for a keyframe, so a receiver that just joined can decode right away
+        Returns None if the stream is not running
+
+        Reconfigurations (endpoints included) restart the encoder, which starts with a keyframe anyway. Software
+        H.264 run by gst-launch cannot be sent an event, its receivers wait for the next keyframe of the GOP bounded
+        by the latency profile (key-int-max).
+        """
+        (stream, runner) = (self.secondary_stream, self.secondary_stream_runner) if secondary else (
+            self.stream, self.stream_runner)
+        if not stream or not runner.started:
+            return None
+
+        method = None
+        match stream.encode_type:
+            case StreamEncodeTypeEnum.H264:
+                camera = next(
+                    (camera for camera in self.cameras if camera.path == stream.device_path), None)
+                if camera:
+                    method = self._request_hardware_keyframe(camera)
+            case StreamEncodeTypeEnum.SOFTWARE_H264:
+                if runner.request_keyframe():
+                    method = KeyframeMethodEnum.FORCE_KEY_UNIT
+            case StreamEncodeTypeEnum.MJPG:
+                method = KeyframeMethodEnum.NOT_NEEDED
+
+        if method is None:
+            self.logger.debug(self._fmt_log(
+                f"The encoder of {stream.device_path} cannot be asked for a keyframe"))
+        return KeyframeRequestModel(bus_info=self.bus_info, secondary=secondary, method=method)
+
+    def _request_hardware_keyframe(self, camera: Camera) -> KeyframeMethodEnum | None:
+        """
+        Ask the camera's H.264 encoder for a keyframe, overridden by devices with their own extension unit controls
+        exploreHD has none: uvcvideo does not map the force key frame control, and its extension unit has no IDR command
+        """
+        if camera.force_key_frame():
+            return KeyframeMethodEnum.V4L2_CONTROL
+        return None
+
+    def _release_timelapse(self):
+        if self.timelapse:
+            self.timelapse.release()
+
+    def _wait_timelapse_released(self):
+        """
+        Called on the stream runner's worker thread, a shot in progress may still hold the node
+        """
+        timelapse = self.timelapse
+        if timelapse and not timelapse.wait_released(TimelapseCapture.RELEASE_TIMEOUT):
+            self.logger.warning(self._fmt_log(
+                "The timelapse still holds the node, starting the stream anyway"))
+
+    def _close_preview_source(self):
+        if self._preview_source:
+            self._preview_source.close()
+            self._preview_source = None
+
     def unconfigure_stream(self):
+        self.secondary_stream_runner.stop()
         self.stream_runner.stop()
         self.logger.info(self._fmt_log(f"Stream stopped"))
 
@@ -530,5 +899,51 @@ class Device(events.EventEmitter):
             return self._options[opt].set_value(value)
         return None
 
+    def can_set_bitrate(self, encode_type: StreamEncodeTypeEnum) -> bool:
+        """
+        Whether the bitrate of a stream of this encoding can be set, hardware H.264 needs a bitrate option
+        """
+        match encode_type:
+            case StreamEncodeTypeEnum.H264:
+                return "bitrate" in self._options
+            case StreamEncodeTypeEnum.SOFTWARE_H264:
+                return True
+            case _:
+                return False
+
+    def get_stream_bitrate(self, secondary: bool = False) -> float | None:
+        """
+        Get the bitrate of a stream in Mbps, None if it cannot be set
+        """
+        stream = self.secondary_stream if secondary else self.stream
+        if not stream or not self.can_set_bitrate(stream.encode_type):
+            return None
+        if stream.encode_type == StreamEncodeTypeEnum.H264:
+            return float(self.get_option("bitrate"))
+        return stream.software_h264_bitrate / 1000
+
+    def set_stream_bitrate(self, mbps: float, secondary: bool = False):
+        """
+        Set the bitrate of a stream in Mbps
+        Hardware H.264 changes while streaming, software H.264 streams are restarted with the new bitrate
+        """
+        stream = self.secondary_stream if secondary else self.stream
+        if not stream or not self.can_set_bitrate(stream.encode_type):
+            return
+
+        if stream.encode_type == StreamEncodeTypeEnum.H264:
+            self.set_option("bitrate", mbps)
+            # Keep the control shown in the frontend in sync
+            for control in self.controls:
+                if control.name == self._options["bitrate"].name:
+                    control.value = mbps
+            return
+
+        stream.software_h264_bitrate = int(mbps * 1000)
+        if secondary and self.secondary_stream_runner.active:
+            self.start_secondary_stream()
+        elif not secondary and self.stream_runner.active:
+            self.start_stream()
+
     def _fmt_log(self, message: str) -> str:
         return f"{self.bus_info} - {message}"
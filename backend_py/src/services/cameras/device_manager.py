@@ -13,19 +13,31 @@ import logging
 import event_emitter as events
 import asyncio
 import traceback
+from concurrent.futures import Future
 
 from .pydantic_schemas import *
 from .device import Device, lookup_pid_vid, DeviceInfo, DeviceType
 from .settings import SettingsManager
 from .enumeration import list_devices
 from .device_utils import list_diff, find_device_with_bus_info
-from .exceptions import DeviceNotFoundException
+from .exceptions import DeviceNotFoundException, BandwidthExceededException
 
 import socketio
 
 from .ehd import EHDDevice
 from .shd import SHDDevice
 from .pwm.serial_pwm_controller import SerialPWMController
+from .stream_engines.encoders import H264EncoderRegistry, DEFAULT_ENCODER
+from .stream_engines.gstreamer_stream_engine import GStreamerPipelineBuilder
+from .stream_engines.remux import remove_stale_remuxes
+from .stream_engines.base_stream_engine import BaseStreamEngine
+from .stream_engines.engine_registry import EngineRegistry
+from .stream_engines.scheduling import SchedulingManager
+from .stream_supervisor import StreamSupervisor
+from .bandwidth_planner import BandwidthPlanner
+from .tether_budget import TetherBudgetManager
+from .adaptive_bitrate import AdaptiveBitrateController
+from .resource_usage import ResourceMonitor
 
 
 def todict(obj, classkey=None):
@@ -58,16 +70,57 @@ class DeviceManager(events.EventEmitter):
     Class for interfacing with and monitoring devices
     """
 
+    STREAM_STATS_INTERVAL = 1
+
     def __init__(
-        self, sio: socketio.Server, use_serial=False, settings_manager=SettingsManager()
+        self, sio: socketio.Server, use_serial=False, settings_manager=SettingsManager(), encoder_registry: H264EncoderRegistry | None = None, scheduler: SchedulingManager | None = None,
+        bandwidth_planner: BandwidthPlanner | None = None, tether_budget: TetherBudgetManager | None = None,
+        adaptive_bitrate: AdaptiveBitrateController | None = None
     ) -> None:
         self.devices: List[Device] = []
         self.sio = sio
         self.settings_manager = settings_manager
+
+        # Software H.264 streams are built with the encoders benchmarked by this registry
+        self.encoder_registry = encoder_registry or H264EncoderRegistry()
+        GStreamerPipelineBuilder.encoder_registry = self.encoder_registry
+        self.encoder_registry.on(
+            "benchmark_complete", self._on_encoder_benchmark_complete)
+
+        # CPU affinity and priorities of the engines' threads and processes
+        self.scheduler = scheduler or SchedulingManager()
+        BaseStreamEngine.scheduler = self.scheduler
+
+        # USB bandwidth admission control of stream configurations
+        self.bandwidth_planner = bandwidth_planner or BandwidthPlanner()
+        # H.264 bitrates of every camera within the uplink of the tether
+        self.tether_budget = tether_budget or TetherBudgetManager()
+        # Bitrates adapted to the loss reported by the receivers, within the tether budget
+        self.adaptive_bitrate = adaptive_bitrate or AdaptiveBitrateController()
+        # CPU, memory and disk writes of every running stream
+        self.resource_monitor = ResourceMonitor()
         self._is_monitoring = False
         # List of devices with stream errors
         self.stream_errors: List[str] = []
 
+        # Stream lifecycle and restart events, emitted from the monitor loop since they come from stream threads
+        self.stream_events: List[Tuple[str, Dict[str, Any]]] = []
+
+        # Restarts failed streams
+        self.supervisor = StreamSupervisor(
+            lambda bus_info: find_device_with_bus_info(self.devices, bus_info) is not None, self._fallback_stream)
+        self.supervisor.on("restart_scheduled", lambda bus_info, attempt, delay, secondary: self.stream_events.append(
+            ("stream_restart_scheduled", {"bus_info": bus_info, "attempt": attempt, "delay": delay, "secondary": secondary})))
+        self.supervisor.on("restarted", lambda bus_info, attempt, secondary: self.stream_events.append(
+            ("stream_restarted", {"bus_info": bus_info, "attempt": attempt, "secondary": secondary})))
+        self.supervisor.on("circuit_open", lambda bus_info, secondary: self.stream_events.append(
+            ("stream_circuit_open", {"bus_info": bus_info, "secondary": secondary})))
+        self.supervisor.on("circuit_closed", lambda bus_info, secondary: self.stream_events.append(
+            ("stream_circuit_closed", {"bus_info": bus_info, "secondary": secondary})))
+        # Latest stats of each running stream, by bus_info
+        self.stream_stats: Dict[str, StreamStatsModel] = {}
+        self.secondary_stream_stats: Dict[str, StreamStatsModel] = {}
+
         self.serial = None
         if use_serial:
             self.serial = SerialPWMController()
@@ -80,16 +133,36 @@ class DeviceManager(events.EventEmitter):
         Begin monitoring for devices in the background
         """
         self._is_monitoring = True
+        # Left behind by remuxes interrupted when the backend last stopped
+        remove_stale_remuxes(GStreamerPipelineBuilder.get_video_dir())
         asyncio.create_task(self._monitor())
+        asyncio.create_task(self._emit_stream_stats())
 
-    def stop_monitoring(self):
+    def stop_monitoring(self) -> Dict[str, Callable[[], None]]:
         """
-        Stop monitoring for devices
+        Stop monitoring for devices and stop every stream, returns a wait for the streams of each device by bus_info
         """
         self._is_monitoring = False
+        self.adaptive_bitrate.close()
 
+        stops: Dict[str, Callable[[], None]] = {}
         for device in self.devices:
-            device.stream.stop()
+            if device.timelapse:
+                device.timelapse.stop(wait=False)
+            pending: List[Future] = [device.stream_runner.stop(),
+                                     device.secondary_stream_runner.stop()]
+            stops[device.bus_info] = lambda pending=pending: [
+                stopped.result() for stopped in pending]
+        return stops
+
+    def kill_stream(self, bus_info: str):
+        """
+        Force a device's streams to stop, for stops that take too long
+        """
+        device = find_device_with_bus_info(self.devices, bus_info)
+        if device:
+            device.stream_runner.kill()
+            device.secondary_stream_runner.kill()
 
     def create_device(self, device_info: DeviceInfo) -> Device | None:
         """
@@ -111,7 +184,18 @@ class DeviceManager(events.EventEmitter):
 
         # we need to broadcast that there was a gst error so that the frontend knows there may be a kernel issue
         device.stream_runner.on(
-            "stream_error", lambda _: self._append_stream_error(device))
+            "stream_error", lambda *_: self._append_stream_error(device))
+        device.secondary_stream_runner.on(
+            "stream_error", lambda *_: self._append_stream_error(device))
+        self.supervisor.supervise(device)
+        device.stream_runner.on("state_changed", lambda state, error: self.stream_events.append(
+            ("stream_state_changed", {"bus_info": device.bus_info, "state": state.value, "error": error})))
+        device.secondary_stream_runner.on("state_changed", lambda state, error: self.stream_events.append(
+            ("secondary_stream_state_changed", {"bus_info": device.bus_info, "state": state.value, "error": error})))
+        # Streams enabled, disabled or configured with another format change the share of the others
+        # Runner state changes do not, the budget's own restarts of software H.264 streams would rebalance again
+        device.on("stream_configured",
+                  lambda *_: self.tether_budget.request_rebalance())
 
         if self.serial:
             device.on("pwm_frequency",
@@ -119,11 +203,122 @@ class DeviceManager(events.EventEmitter):
 
         return device
 
+    def _on_encoder_benchmark_complete(self, stream_format: Tuple[int, int, int]):
+        """
+        Restart software H.264 streams that started on the default encoder before their format was benchmarked
+        """
+        (width, height, fps) = stream_format
+        encoder = self.encoder_registry.select(width, height, fps)
+        if encoder.element == DEFAULT_ENCODER.element:
+            return
+
+        for device in self.devices:
+            stream = device.stream
+            if not stream.enabled or stream.encode_type != StreamEncodeTypeEnum.SOFTWARE_H264:
+                continue
+            if (stream.width, stream.height, stream.interval.denominator // stream.interval.numerator) != stream_format:
+                continue
+            self.logger.info(
+                f"{device.bus_info}: Switching software H.264 encoder to {encoder.element}")
+            device.start_stream()
+
+    def get_engines(self) -> List[EngineInfoModel]:
+        """
+        Get the registered stream engines and their capabilities
+        """
+        return EngineRegistry.list_engines()
+
+    def get_bandwidth_plan(self, proposed: StreamInfoModel | None = None, secondary: bool = False) -> BandwidthPlanModel:
+        """
+        Get the USB bandwidth of the enabled streams per root hub, optionally with a proposed (secondary) stream configuration
+        """
+        return self.bandwidth_planner.plan(self.devices, proposed, secondary)
+
+    def get_tether_budget(self) -> TetherBudgetPlanModel:
+        """
+        Get the bitrates of the streams sent over the tether, as allocated by the budget
+        """
+        return self.tether_budget.plan(self.devices, self._stats_by_stream())
+
+    def get_adaptive_bitrate_status(self) -> List[AdaptiveBitrateStatusModel]:
+        """
+        Get the bitrate and reported loss of the streams adapted to their receivers' feedback
+        """
+        return self.adaptive_bitrate.get_status()
+
+    def get_stream_resources(self) -> List[StreamResourceModel]:
+        """
+        Get the CPU, memory and disk writes of every running stream, as of the last sample
+        """
+        return self.resource_monitor.get_usage()
+
+    def _stats_by_stream(self) -> Dict[Tuple[str, bool], StreamStatsModel]:
+        return {(stats.bus_info, stats.secondary): stats for stats in self.get_stream_stats()}
+
+    def _admit_stream(self, stream_info: StreamInfoModel, secondary: bool = False):
+        """
+        Check that a stream configuration fits the USB bandwidth of its root hub
+        Raises BandwidthExceededException if it does not, and admission is set to reject
+        """
+        plan = self.bandwidth_planner.plan(
+            self.devices, stream_info, secondary)
+        if plan.admission == BandwidthAdmissionEnum.OFF:
+            return
+
+        for controller in plan.controllers:
+            if not controller.oversubscribed or not any(stream.bus_info == stream_info.bus_info for stream in controller.streams):
+                continue
+            message = (f"{stream_info.bus_info}: {controller.root_hub} ({controller.controller}) needs ~{controller.allocated_mbps:.0f} Mbps, "
+                       f"budget is {controller.budget_mbps:.0f} Mbps")
+            if plan.admission == BandwidthAdmissionEnum.REJECT:
+                self.logger.error(message)
+                raise BandwidthExceededException(
+                    stream_info.bus_info, controller.suggestions)
+            self.logger.warning(message)
+            self.stream_events.append(("bandwidth_warning", {
+                "bus_info": stream_info.bus_info, "root_hub": controller.root_hub, "allocated_mbps": controller.allocated_mbps,
+                "budget_mbps": controller.budget_mbps, "suggestions": controller.suggestions}))
+
+    def _fallback_stream(self, device: Device, error: str) -> bool:
+        """
+        Reconfigure a stream that failed for lack of USB bandwidth with the next cheaper configuration
+        Returns False if the fallback order is exhausted
+        """
+        fallback = self.bandwidth_planner.next_fallback(device, error)
+        if not fallback:
+            self.logger.warning(
+                f"{device.bus_info}: Not enough USB bandwidth, and no cheaper stream configuration left")
+            return False
+
+        stream = device.stream
+        to_format = fallback.to_format
+        self.logger.warning(
+            f"{device.bus_info}: Not enough USB bandwidth, falling back from {fallback.from_encode_type.value} "
+            f"{fallback.from_format.width}x{fallback.from_format.height} to {fallback.to_encode_type.value} "
+            f"{to_format.width}x{to_format.height} at {to_format.interval.denominator / to_format.interval.numerator:g} fps")
+        device.configure_stream(
+            fallback.to_encode_type, to_format.width, to_format.height, to_format.interval, stream.stream_type,
+            stream.endpoints, stream.recording, stream.engine, stream.latency_profile, stream.srt
+        )
+        self.settings_manager.save_device(device)
+        self.stream_events.append(("stream_fallback", fallback.model_dump()))
+        return True
+
+    def get_encoder_benchmarks(self) -> List[EncoderBenchmarkModel]:
+        """
+        Get the software H.264 encoder benchmark results
+        """
+        return [
+            EncoderBenchmarkModel(
+                element=element, width=width, height=height, fps=fps, achieved_fps=achieved_fps)
+            for (element, width, height, fps, achieved_fps) in self.encoder_registry.get_results()
+        ]
+
     def _append_stream_error(self, device: DeviceModel):
         """
         Helper function to append a gst error
+        The stream stays enabled, the supervisor restarts it
         """
-        device.stream.enabled = False
         self.stream_errors.append(device.bus_info)
 
     def get_devices(self):
@@ -153,6 +348,9 @@ class DeviceManager(events.EventEmitter):
         """
         device = self._find_device_with_bus_info(stream_info.bus_info)
 
+        if stream_info.enabled:
+            self._admit_stream(stream_info)
+
         stream_format = stream_info.stream_format
         width: int = stream_format.width
         height: int = stream_format.height
@@ -162,9 +360,12 @@ class DeviceManager(events.EventEmitter):
         endpoints = stream_info.endpoints
 
         device.configure_stream(
-            encode_type, width, height, interval, stream_type, endpoints
+            encode_type, width, height, interval, stream_type, endpoints, stream_info.recording, stream_info.engine,
+            stream_info.latency_profile, stream_info.srt
         )
 
+        # A new configuration deserves a fresh set of restart attempts
+        self.supervisor.reset(device.bus_info)
         if stream_info.enabled:
             device.start_stream()
         else:
@@ -173,6 +374,32 @@ class DeviceManager(events.EventEmitter):
         self.settings_manager.save_device(device)
         return True
 
+    def configure_device_secondary_stream(self, stream_info: StreamInfoModel) -> bool:
+        """
+        Configure a device's secondary stream, returns False if the device has no other node for the encoding
+        """
+        device = self._find_device_with_bus_info(stream_info.bus_info)
+
+        if stream_info.enabled:
+            self._admit_stream(stream_info, secondary=True)
+
+        stream_format = stream_info.stream_format
+        if not device.configure_secondary_stream(
+            stream_info.encode_type, stream_format.width, stream_format.height, stream_format.interval,
+            stream_info.stream_type, stream_info.endpoints, stream_info.recording, stream_info.engine,
+            stream_info.latency_profile, stream_info.srt
+        ):
+            return False
+
+        self.supervisor.reset(device.bus_info, secondary=True)
+        if stream_info.enabled:
+            device.start_secondary_stream()
+        else:
+            device.stop_secondary_stream()
+
+        self.settings_manager.save_device(device)
+        return True
+
     def set_device_nickname(self, bus_info: str, nickname: str) -> bool:
         """
         Set a device nickname
@@ -303,6 +530,10 @@ class DeviceManager(events.EventEmitter):
             bus_info = self.stream_errors.pop()
             await self._emit_stream_error(bus_info, "GST Error")
 
+        while len(self.stream_events) > 0:
+            (event, data) = self.stream_events.pop(0)
+            await self.sio.emit(event, data)
+
         if len(removed_devices) > 0 or len(new_devices) > 0:
             # make sure to load the leader followers in case there are new ones to check
             self.settings_manager.link_followers(self.devices)
@@ -312,6 +543,13 @@ class DeviceManager(events.EventEmitter):
             for device in self.devices:
                 if device.device_info == device_info:
                     device.stream_runner.stop()
+                    device.secondary_stream_runner.stop()
+                    if device.timelapse:
+                        device.timelapse.stop(wait=False)
+                    self.supervisor.forget(device.bus_info)
+                    self.bandwidth_planner.forget(device.bus_info)
+                    for camera in device.cameras:
+                        GStreamerPipelineBuilder.io_modes.forget(camera.path)
 
                     # What to do when a device is unplugged
                     # If it is a leader, just have the followers detatch temporarily
@@ -362,6 +600,138 @@ class DeviceManager(events.EventEmitter):
             # get the list of devices and update the internal array
             devices_info = await self._get_devices(devices_info)
 
+    def get_restart_stats(self) -> List[StreamRestartStatsModel]:
+        """
+        Get the automatic restart stats of every device that had a stream failure
+        """
+        return self.supervisor.get_stats()
+
+    def start_timelapse(self, bus_info: str, request: TimelapseRequestModel) -> TimelapseStatusModel | None:
+        """
+        Start capturing stills from a device every interval, returns None if the device cannot capture MJPEG stills
+        """
+        device = self._find_device_with_bus_info(bus_info)
+        status = device.start_timelapse(request)
+        if status:
+            self.stream_events.append(("timelapse_started", status.model_dump()))
+        return status
+
+    def stop_timelapse(self, bus_info: str) -> TimelapseStatusModel | None:
+        device = self._find_device_with_bus_info(bus_info)
+        status = device.stop_timelapse()
+        if status:
+            self.stream_events.append(("timelapse_stopped", status.model_dump()))
+        return status
+
+    def start_recording(self, bus_info: str, secondary: bool = False) -> InstantRecordingModel | None:
+        """
+        Start an instant recording of a device's running stream, returns None if the stream cannot be recorded
+        """
+        device = self._find_device_with_bus_info(bus_info)
+        recording = device.start_recording(secondary)
+        if recording:
+            self.stream_events.append(
+                ("recording_started", {**recording.model_dump(), "secondary": secondary}))
+        return recording
+
+    def stop_recording(self, bus_info: str, secondary: bool = False) -> InstantRecordingModel | None:
+        """
+        Stop the instant recording of a device, returns None if it has none
+        """
+        device = self._find_device_with_bus_info(bus_info)
+        recording = device.stop_recording(secondary)
+        if recording:
+            self.stream_events.append(
+                ("recording_stopped", {**recording.model_dump(), "secondary": secondary}))
+        return recording
+
+    def start_diagnostics(self, bus_info: str, request: DiagnosticsRequestModel) -> PipelineDiagnosticsModel | None:
+        """
+        Trace the pipeline of a device's running stream, returns None if it cannot be traced
+        """
+        device = self._find_device_with_bus_info(bus_info)
+        diagnostics = device.start_diagnostics(request, lambda result: self.stream_events.append(
+            ("diagnostics_finished", {"bus_info": result.bus_info, "secondary": result.secondary, "state": result.state.value,
+                                      "directory": result.directory})))
+        if diagnostics and diagnostics.state == DiagnosticsStateEnum.RUNNING:
+            self.stream_events.append(
+                ("diagnostics_started", {"bus_info": bus_info, "secondary": diagnostics.secondary, "duration_s": diagnostics.duration_s}))
+        return diagnostics
+
+    def get_diagnostics(self, bus_info: str) -> PipelineDiagnosticsModel | None:
+        """
+        Get the running or last diagnostics session of a device, None if there was none
+        """
+        device = self._find_device_with_bus_info(bus_info)
+        return device.get_diagnostics()
+
+    def request_keyframe(self, bus_info: str, secondary: bool = False) -> KeyframeRequestModel | None:
+        """
+        Ask the encoder of a device's running stream for a keyframe, returns None if the stream is not running
+        """
+        device = self._find_device_with_bus_info(bus_info)
+        result = device.request_keyframe(secondary)
+        if result and result.method:
+            self.stream_events.append(
+                ("keyframe_requested", result.model_dump()))
+        return result
+
+    def get_stream_stats(self) -> List[StreamStatsModel]:
+        """
+        Get the latest stats of all running streams
+        """
+        return list(self.stream_stats.values()) + list(self.secondary_stream_stats.values())
+
+    async def _emit_stream_stats(self):
+        """
+        Collect the stats of every running stream and emit them about once per second
+        """
+        while self._is_monitoring:
+            await asyncio.sleep(self.STREAM_STATS_INTERVAL)
+
+            stream_stats: Dict[str, StreamStatsModel] = {}
+            secondary_stream_stats: Dict[str, StreamStatsModel] = {}
+            for device in self.devices:
+                for (runner, collected, secondary) in [(device.stream_runner, stream_stats, False),
+                                                       (device.secondary_stream_runner, secondary_stream_stats, True)]:
+                    stats = runner.get_stats()
+                    if stats is None:
+                        continue
+                    stats.bus_info = device.bus_info
+                    stats.secondary = secondary
+                    collected[device.bus_info] = stats
+            self.stream_stats = stream_stats
+            self.secondary_stream_stats = secondary_stream_stats
+
+            # Bitrates are read and written through the cameras' controls, which block
+            await asyncio.to_thread(self._update_bitrates)
+
+            all_stats = self.get_stream_stats()
+            if len(all_stats) > 0:
+                await self.sio.emit("stream_stats", [stats.model_dump() for stats in all_stats])
+
+            if self.resource_monitor.sample_due():
+                for flagged in self.resource_monitor.sample(self.devices, self._stats_by_stream()):
+                    self.stream_events.append(
+                        ("stream_resource_warning", flagged.model_dump()))
+                resources = self.resource_monitor.get_usage()
+                if len(resources) > 0:
+                    await self.sio.emit("stream_resources", [usage.model_dump() for usage in resources])
+
+    def _update_bitrates(self):
+        """
+        Rebalance the tether budget when due and adapt the bitrates to the receivers' feedback
+        """
+        if self.tether_budget.rebalance_due():
+            plan = self.tether_budget.rebalance(
+                self.devices, self._stats_by_stream(), self.adaptive_bitrate.controlled_streams(self.devices))
+            if plan:
+                self.stream_events.append(
+                    ("tether_budget_changed", plan.model_dump()))
+        for adapted in self.adaptive_bitrate.step(self.devices, self.tether_budget.allocation):
+            self.stream_events.append(
+                ("bitrate_adapted", adapted.model_dump()))
+
     async def _emit_stream_error(self, device: str, errors: list):
         """
         Emit a stream_error and make sure it is not due to the device being unplugged
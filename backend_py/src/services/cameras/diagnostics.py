@@ -0,0 +1,219 @@
+"""
+diagnostics.py
+
+On-demand introspection of a stream's GStreamer pipeline
+A session restarts the stream with GStreamer's latency and rusage tracers and graph dumps enabled, and after the
+requested time restarts it again without them, so tracing costs nothing outside of a session. The trace is then broken
+down into the latency of every element and of the whole pipeline, the CPU time of every streaming thread is read from
+/proc, and the DOT graphs of the negotiated pipeline are returned.
+"""
+
+import glob
+import logging
+import os
+import re
+import stat
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from .stream_engines.stream import Stream
+from .stream_engines.gstreamer_stream_engine import GStreamerProcessEngine
+from .pydantic_schemas import (
+    DiagnosticsRequestModel, DiagnosticsStateEnum, LatencyBreakdownModel, PipelineDiagnosticsModel, ThreadCpuModel,
+)
+
+# Tracer records, e.g.
+# element-latency, element-id=(string)0x..., element=(string)x264enc0, src=(string)src, time=(guint64)4103563, ts=...
+# latency, src-element-id=(string)0x..., src-element=(string)v4l2src0, src=(string)src, sink-element-id=(string)0x..., sink-element=(string)multiudpsink0, sink=(string)sink, time=(guint64)20584301, ts=...
+ELEMENT_LATENCY_PATTERN = re.compile(
+    r"\belement-latency, .*?\belement=\(string\)([^,;]+),.*?\btime=\(guint64\)(\d+)")
+PIPELINE_LATENCY_PATTERN = re.compile(
+    r"(?<![\w-])latency, .*?\bsrc-element=\(string\)([^,;]+),.*?\bsink-element=\(string\)([^,;]+),.*?\btime=\(guint64\)(\d+)")
+# proc-rusage, ts=(guint64)..., average-cpuload=(uint)125, current-cpuload=(uint)130, time=...
+PROC_RUSAGE_PATTERN = re.compile(
+    r"\bproc-rusage, .*?\baverage-cpuload=\(uint\)(\d+)")
+# e.g. 0:00:00.123456789-gst-launch.PAUSED_PLAYING.dot
+DOT_STATE_PATTERN = re.compile(r"gst-launch\.(.+)\.dot$")
+
+
+def get_diagnostics_dir() -> str:
+    diagnostics_dir = os.path.join(os.getcwd(), "diagnostics")
+    if not os.path.exists(diagnostics_dir):
+        os.makedirs(diagnostics_dir)
+        permissions = stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH
+        os.chmod(diagnostics_dir, permissions)
+    return diagnostics_dir
+
+
+def read_thread_cpu(pid: int) -> List[ThreadCpuModel]:
+    """
+    Get the CPU usage of every thread of a process over its lifetime, empty if the process is gone
+    """
+    clock_ticks = os.sysconf("SC_CLK_TCK")
+    try:
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        tids = os.listdir(f"/proc/{pid}/task")
+    except OSError:
+        return []
+
+    threads: List[ThreadCpuModel] = []
+    for tid in tids:
+        try:
+            with open(f"/proc/{pid}/task/{tid}/stat") as f:
+                content = f.read()
+            with open(f"/proc/{pid}/task/{tid}/comm") as f:
+                name = f.read().strip()
+        except OSError:
+            # The thread exited
+            continue
+        # The name may contain spaces, the fields after it are (3) state ... (14) utime (15) stime ... (22) starttime
+        fields = content[content.rfind(")") + 2:].split()
+        (utime, stime, started) = (int(fields[11]), int(fields[12]), int(fields[19]))
+        lifetime = uptime - started / clock_ticks
+        threads.append(ThreadCpuModel(
+            tid=int(tid),
+            name=name,
+            cpu_percent=round((utime + stime) / clock_ticks / lifetime * 100, 1) if lifetime > 0 else 0,
+        ))
+    return sorted(threads, key=lambda thread: thread.cpu_percent, reverse=True)
+
+
+def _breakdown(name: str, samples_ns: List[int]) -> LatencyBreakdownModel:
+    samples = sorted(samples_ns)
+    return LatencyBreakdownModel(
+        name=name,
+        samples=len(samples),
+        mean_ms=round(sum(samples) / len(samples) / 1_000_000, 3),
+        p95_ms=round(samples[min(int(len(samples) * 0.95), len(samples) - 1)] / 1_000_000, 3),
+        max_ms=round(samples[-1] / 1_000_000, 3),
+    )
+
+
+def parse_trace(path: str, result: PipelineDiagnosticsModel):
+    """
+    Break the tracer records of a trace file down into the result
+    """
+    elements: Dict[str, List[int]] = {}
+    paths: Dict[str, List[int]] = {}
+    cpu_load: Optional[int] = None
+    with open(path, errors="replace") as f:
+        for line in f:
+            match = ELEMENT_LATENCY_PATTERN.search(line)
+            if match:
+                elements.setdefault(match.group(1), []).append(int(match.group(2)))
+                continue
+            match = PIPELINE_LATENCY_PATTERN.search(line)
+            if match:
+                paths.setdefault(f"{match.group(1)} -> {match.group(2)}", []).append(int(match.group(3)))
+                continue
+            match = PROC_RUSAGE_PATTERN.search(line)
+            if match:
+                # Per mille, averaged since the process started, so the last record covers the session
+                cpu_load = int(match.group(1))
+
+    result.element_latency = sorted((_breakdown(name, samples) for (name, samples) in elements.items()),
+                                    key=lambda breakdown: breakdown.mean_ms, reverse=True)
+    result.pipeline_latency = [_breakdown(name, samples) for (name, samples) in paths.items()]
+    if cpu_load is not None:
+        result.process_cpu_percent = cpu_load / 10
+
+
+class PipelineDiagnostics:
+    """
+    One diagnostics session of a stream
+    """
+
+    # Time for the restarted pipeline to reach PLAYING, added to the requested duration
+    START_MARGIN = 2
+
+    def __init__(self, bus_info: str, stream: Stream, request: DiagnosticsRequestModel, restart: Callable[[], None],
+                 get_pids: Callable[[], List[int]], on_finish: Callable[[PipelineDiagnosticsModel], None] = lambda _: None) -> None:
+        """
+        restart (re)starts the stream, get_pids returns the processes of its running engine
+        """
+        self.stream = stream
+        self._restart = restart
+        self._get_pids = get_pids
+        self._on_finish = on_finish
+        self.logger = logging.getLogger("dwe_os_2.cameras.PipelineDiagnostics")
+
+        prefix = re.sub(r"[^A-Za-z0-9._-]", "_", bus_info)
+        suffix = "_secondary" if request.secondary else ""
+        self.directory = os.path.join(
+            get_diagnostics_dir(), f"{prefix}{suffix}_{datetime.now().strftime('%F-%H%M%S')}")
+
+        self._lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+        self._result = PipelineDiagnosticsModel(
+            bus_info=bus_info,
+            secondary=request.secondary,
+            state=DiagnosticsStateEnum.RUNNING,
+            started_at=time.time(),
+            duration_s=request.duration_s,
+            directory=self.directory,
+        )
+
+    @property
+    def running(self) -> bool:
+        return self._result.state == DiagnosticsStateEnum.RUNNING
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.stream.diagnostics_dir = self.directory
+        self.logger.info(
+            f"{self._result.bus_info}: Tracing the pipeline for {self._result.duration_s:g} seconds")
+        self._restart()
+        self._timer = threading.Timer(
+            self._result.duration_s + self.START_MARGIN, self.finish)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def finish(self):
+        """
+        End the session, restarting the stream untraced if it still runs
+        """
+        with self._lock:
+            if not self.running:
+                return
+            if self._timer:
+                self._timer.cancel()
+
+            # Read before the traced process is stopped
+            pids = self._get_pids()
+            threads: List[ThreadCpuModel] = []
+            for pid in pids:
+                threads += read_thread_cpu(pid)
+            self.stream.diagnostics_dir = None
+            if self.stream.enabled:
+                self._restart()
+
+            result = self._result
+            result.threads = threads
+            for path in sorted(glob.glob(os.path.join(self.directory, "*.dot"))):
+                match = DOT_STATE_PATTERN.search(os.path.basename(path))
+                if match:
+                    with open(path, errors="replace") as f:
+                        result.dot_graphs[match.group(1)] = f.read()
+
+            trace_path = os.path.join(
+                self.directory, GStreamerProcessEngine.DIAGNOSTICS_TRACE_FILE)
+            if os.path.exists(trace_path):
+                parse_trace(trace_path, result)
+            if len(pids) == 0 or not os.path.exists(trace_path):
+                result.state = DiagnosticsStateEnum.FAILED
+                result.error = "The stream stopped during the session" if len(
+                    pids) == 0 else "The pipeline produced no trace"
+            else:
+                result.state = DiagnosticsStateEnum.COMPLETE
+            self.logger.info(
+                f"{result.bus_info}: Diagnostics {result.state.value.lower()}, results in {self.directory}")
+            finished = result.model_copy(deep=True)
+
+        self._on_finish(finished)
+
+    def status(self) -> PipelineDiagnosticsModel:
+        with self._lock:
+            return self._result.model_copy(deep=True)
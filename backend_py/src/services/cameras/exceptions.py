@@ -3,3 +3,16 @@ class DeviceNotFoundException(Exception):
 
     def __init__(self, bus_info, *args: object) -> None:
         super().__init__(f'Device not found: "{bus_info}"', *args)
+
+
+class NoSuitableEngineException(Exception):
+    '''No stream engine can run the requested streams'''
+
+
+class BandwidthExceededException(Exception):
+    '''Stream configuration would oversubscribe a USB root hub'''
+
+    def __init__(self, bus_info, suggestions, *args: object) -> None:
+        super().__init__(
+            f'Not enough USB bandwidth for "{bus_info}"', *args)
+        self.suggestions = suggestions
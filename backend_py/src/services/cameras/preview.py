@@ -0,0 +1,137 @@
+"""
+preview.py
+
+Low-latency browser preview of a camera as multipart MJPEG (multipart/x-mixed-replace)
+While the device is streaming, the preview reads the running capture's frame tap, so no second capture is opened.
+Otherwise, the preview captures the MJPEG node itself, only while a viewer is connected.
+"""
+
+import asyncio
+import threading
+import time
+import logging
+from typing import AsyncIterator, Callable, Optional
+
+from .stream_engines.frame_tap import FrameTap
+from .synchronized_camera import V4L2Camera
+from . import v4l2
+
+# Boundary of the multipart/x-mixed-replace responses
+PREVIEW_BOUNDARY = "frame"
+
+# Resubscribe when a tap has not produced a frame for this long (e.g. the pipeline was still starting when we attached)
+STALE_TIMEOUT = 3
+
+
+class V4L2PreviewSource:
+    """
+    Captures JPEG frames from a V4L2 node for the preview when the device is not streaming
+    """
+
+    def __init__(self, device_path: str, width: int, height: int, fps: int) -> None:
+        self.device_path = device_path
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.logger = logging.getLogger("dwe_os_2.cameras.V4L2PreviewSource")
+
+        self.tap = FrameTap(self._open, self.close)
+        self._camera: Optional[V4L2Camera] = None
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+        self._lock = threading.Lock()
+
+    def _open(self):
+        with self._lock:
+            if self._running:
+                return
+            try:
+                camera = V4L2Camera(self.device_path, self.width,
+                                    self.height, self.fps, v4l2.V4L2_PIX_FMT_MJPEG)
+            except (OSError, AttributeError) as e:
+                # Most likely the node is busy with another capture
+                self.logger.warning(
+                    f"Unable to open {self.device_path} for preview: {e}")
+                return
+            if camera.critical_error:
+                self.logger.warning(
+                    f"Unable to open {self.device_path} for preview")
+                return
+
+            self._camera = camera
+            self._running = True
+            self._thread = threading.Thread(
+                target=self._capture_loop, args=(camera,), daemon=True)
+            self._thread.start()
+
+    def close(self):
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+            thread = self._thread
+            self._thread = None
+        if thread:
+            thread.join(timeout=2)
+
+    def _capture_loop(self, camera: V4L2Camera):
+        try:
+            while self._running:
+                frame = camera.grab_copied_frame(timeout_s=0.5)
+                if frame is not None:
+                    self.tap.publish([frame])
+        finally:
+            camera.close()
+            self._camera = None
+
+
+async def mjpeg_preview(get_tap: Callable[[], Optional[FrameTap]], max_fps: float) -> AsyncIterator[bytes]:
+    """
+    Yield multipart MJPEG parts of the newest frame, at most max_fps per second
+
+    get_tap is called before every frame, so the preview follows the device when its stream starts or stops.
+    Frames that arrive faster than max_fps are skipped, the viewer always gets the latest one.
+    """
+    period = 1 / max_fps
+    tap: Optional[FrameTap] = None
+    last_index = 0
+    last_frame_time = time.monotonic()
+    try:
+        while True:
+            # May open or close the device's preview source
+            current = await asyncio.to_thread(get_tap)
+            if current is not tap or (tap is not None and time.monotonic() - last_frame_time > STALE_TIMEOUT):
+                if tap is not None:
+                    await asyncio.to_thread(tap.unsubscribe)
+                tap = current
+                (last_index, _) = tap.latest() if tap else (0, None)
+                last_frame_time = time.monotonic()
+                if tap is not None:
+                    await asyncio.to_thread(tap.subscribe)
+
+            if tap is None:
+                await asyncio.sleep(period)
+                continue
+
+            started = time.monotonic()
+            (index, frames) = await asyncio.to_thread(tap.wait_for_frame, last_index, period + 0.5)
+            if frames is None:
+                continue
+            last_index = index
+            last_frame_time = time.monotonic()
+
+            # Synchronized rigs publish one frame per camera, the leader is previewed
+            data = frames[0].data
+            yield (
+                f"--{PREVIEW_BOUNDARY}\r\n"
+                f"Content-Type: image/jpeg\r\n"
+                f"Content-Length: {len(data)}\r\n\r\n"
+            ).encode() + data + b"\r\n"
+
+            remaining = period - (time.monotonic() - started)
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+    finally:
+        if tap is not None:
+            # Closing an idle device's preview source joins its capture thread
+            await asyncio.to_thread(tap.unsubscribe)
@@ -45,6 +45,59 @@ class StreamTypeEnum(str, Enum):
 
     RECORDING = "RECORDING"
 
+    RTSP = "RTSP"
+
+    SRT = "SRT"
+
+
+class SrtModeEnum(str, Enum):
+    # Connect to a listener at the endpoint
+    CALLER = "CALLER"
+    # Wait for a caller on the endpoint's port
+    LISTENER = "LISTENER"
+
+
+class LatencyProfileEnum(str, Enum):
+    ULTRA_LOW_LATENCY = "ULTRA_LOW_LATENCY"
+    BALANCED = "BALANCED"
+    QUALITY = "QUALITY"
+
+
+class StreamStateEnum(str, Enum):
+    IDLE = "IDLE"
+    STARTING = "STARTING"
+    RUNNING = "RUNNING"
+    STOPPING = "STOPPING"
+    FAILED = "FAILED"
+
+
+class StreamErrorKindEnum(str, Enum):
+    # The USB controller cannot reserve the bandwidth of the stream
+    BANDWIDTH = "BANDWIDTH"
+    # The device was unplugged or cannot be opened
+    DEVICE_LOST = "DEVICE_LOST"
+    # The pipeline could not agree on a format
+    NEGOTIATION = "NEGOTIATION"
+    UNKNOWN = "UNKNOWN"
+
+
+class FallbackStepEnum(str, Enum):
+    # Stream the hardware H.264 of the camera instead of MJPEG
+    H264 = "H264"
+    # Next lower frame rate the camera supports at the same resolution
+    LOWER_FPS = "LOWER_FPS"
+    # Next smaller resolution the camera supports
+    LOWER_RESOLUTION = "LOWER_RESOLUTION"
+
+
+class BandwidthAdmissionEnum(str, Enum):
+    # Accept every configuration
+    OFF = "OFF"
+    # Accept, but warn about oversubscribed USB root hubs
+    WARN = "WARN"
+    # Refuse configurations that oversubscribe a USB root hub
+    REJECT = "REJECT"
+
 
 class H264Mode(IntEnum):
     """
@@ -150,6 +203,29 @@ class StreamEndpointModel(BaseModel):
         from_attributes = True
 
 
+class RecordingOptionsModel(BaseModel):
+    # Write a fragmented MP4 (moof fragments) that stays playable if the recording is cut off
+    fragmented: bool = False
+    # Duration of each fragment in milliseconds
+    fragment_duration_ms: int = Field(default=1000, ge=100, le=60000)
+    # Remux the fragmented file to a regular fast-start MP4 once the recording stops
+    remux: bool = False
+    # Branch the encoded frames of a UDP or SRT stream to the instant recorder, which can then record it on request
+    instant: bool = False
+
+    class Config:
+        from_attributes = True
+
+
+class SrtOptionsModel(BaseModel):
+    mode: SrtModeEnum = SrtModeEnum.CALLER
+    # How long the receiver waits for retransmissions before giving up on a packet, should be a few round trips
+    latency_ms: int = Field(default=120, ge=20, le=8000)
+
+    class Config:
+        from_attributes = True
+
+
 class StreamModel(BaseModel):
     device_path: str
     encode_type: StreamEncodeTypeEnum
@@ -159,6 +235,11 @@ class StreamModel(BaseModel):
     height: int
     interval: IntervalModel
     enabled: bool
+    recording: RecordingOptionsModel = RecordingOptionsModel()
+    srt: SrtOptionsModel = SrtOptionsModel()
+    # Engine chosen by the user, None selects one automatically
+    engine: Optional[str] = None
+    latency_profile: LatencyProfileEnum = LatencyProfileEnum.BALANCED
 
     class Config:
         from_attributes = True
@@ -189,6 +270,11 @@ class DeviceModel(BaseModel):
     followers: List[str] = []
     # True if is a follower and stream is managed by the leader
     is_managed: bool = False
+    # Lifecycle state of the device's stream runner
+    stream_state: StreamStateEnum = StreamStateEnum.IDLE
+    # Second stream from another node of the camera, e.g. a small MJPEG next to full resolution H.264
+    secondary_stream: Optional[StreamModel] = None
+    secondary_stream_state: StreamStateEnum = StreamStateEnum.IDLE
 
     class Config:
         from_attributes = True
@@ -213,6 +299,10 @@ class StreamInfoModel(BaseModel):
     encode_type: StreamEncodeTypeEnum
     enabled: bool
     endpoints: List[StreamEndpointModel]
+    recording: RecordingOptionsModel = RecordingOptionsModel()
+    srt: SrtOptionsModel = SrtOptionsModel()
+    engine: Optional[str] = None
+    latency_profile: LatencyProfileEnum = LatencyProfileEnum.BALANCED
 
     class Config:
         from_attributes = True
@@ -252,5 +342,368 @@ class AddFollowerPayload(BaseModel):
     follower_bus_info: str
 
 
+class SrtLinkStatsModel(BaseModel):
+    # SRT endpoint, host:port
+    endpoint: str
+    connected: bool
+    rtt_ms: Optional[float] = None
+    send_rate_mbps: Optional[float] = None
+    # Counted since the connection was established
+    packets_sent: int = 0
+    packets_lost: int = 0
+    packets_retransmitted: int = 0
+    # Packets dropped because they could not be delivered within the latency window
+    packets_dropped: int = 0
+
+
+class StreamStatsModel(BaseModel):
+    bus_info: str = ""
+    # Name of the engine running the stream
+    engine: str
+    captured_fps: float
+    sent_fps: float
+    bitrate_kbps: float
+    # Frames dropped by the driver (gaps in the V4L2 buffer sequence), since the stream started
+    capture_drops: int
+    # Frames dropped between capture and send, since the stream started
+    queue_drops: int
+    # Average time spent in the encoder over the last window, None when not encoding
+    encode_latency_ms: Optional[float] = None
+    send_errors: int
+    # Connected clients, for engines that serve viewers themselves (RTSP)
+    viewers: Optional[int] = None
+    # State of each SRT connection, for SRT streams
+    srt_links: Optional[List[SrtLinkStatsModel]] = None
+    # Standard deviation of the time between captured frames over the last window
+    frame_jitter_ms: Optional[float] = None
+    # Whether these are the stats of the device's secondary stream
+    secondary: bool = False
+    timestamp: float
+
+
+class InstantRecordingModel(BaseModel):
+    bus_info: str
+    file_path: str
+    # Unix time of the record request
+    requested_at: float
+    # Time from the record request to the first recorded frame, None until a keyframe was recorded
+    start_latency_ms: Optional[float] = None
+    recording: bool
+
+
+class KeyframeMethodEnum(str, Enum):
+    # V4L2 force key frame control of the H.264 node
+    V4L2_CONTROL = "V4L2_CONTROL"
+    # Force key unit event sent to the software encoder
+    FORCE_KEY_UNIT = "FORCE_KEY_UNIT"
+    # MJPEG, every frame is a keyframe
+    NOT_NEEDED = "NOT_NEEDED"
+
+
+class KeyframeRequestModel(BaseModel):
+    bus_info: str
+    secondary: bool
+    # How the keyframe was requested, None if the stream's encoder cannot be asked for one
+    method: Optional[KeyframeMethodEnum] = None
+
+
+class StreamRestartStatsModel(BaseModel):
+    bus_info: str
+    secondary: bool = False
+    # Automatic restarts since the device was added
+    restarts: int
+    consecutive_failures: int
+    last_error: Optional[str] = None
+    # Unix time of the last failure
+    last_failure: Optional[float] = None
+    # Automatic restarts are suspended after repeated failures, until a trial restart after the cooldown
+    circuit_open: bool
+    # Seconds until the pending restart
+    next_restart_in: Optional[float] = None
+
+
+class EngineSchedulingModel(BaseModel):
+    # CPUs for the engine's threads and child processes, empty means every CPU the API does not use
+    cpus: List[int] = []
+    # Nice level of the capture threads and child processes
+    nice: Optional[int] = Field(None, ge=-20, le=19)
+    # SCHED_FIFO priority of the capture threads, None keeps the normal scheduler
+    realtime_priority: Optional[int] = Field(None, ge=1, le=99)
+
+
+class SchedulingModel(BaseModel):
+    enabled: bool = False
+    # CPUs for the API and everything else that is not a stream engine
+    api_cpus: List[int] = []
+    # Engine name (e.g. GStreamerProcessEngine) -> policy
+    engines: Dict[str, EngineSchedulingModel] = {}
+
+
+class BandwidthModel(BaseModel):
+    admission: BandwidthAdmissionEnum = BandwidthAdmissionEnum.WARN
+    # Isochronous bandwidth the cameras of a root hub may use, in Mbps
+    # USB 2.0 reserves at most 80% of 480 Mbps for periodic transfers, controllers often fail before that
+    usb2_budget_mbps: float = Field(280, gt=0)
+    usb3_budget_mbps: float = Field(3500, gt=0)
+    # Cheaper configurations tried in turn when a stream fails for lack of USB bandwidth, empty disables the fallback
+    fallback_order: List[FallbackStepEnum] = [
+        FallbackStepEnum.H264, FallbackStepEnum.LOWER_FPS, FallbackStepEnum.LOWER_RESOLUTION]
+
+
+class UsbStreamAllocationModel(BaseModel):
+    bus_info: str
+    # Whether this is the device's secondary stream
+    secondary: bool = False
+    encode_type: StreamEncodeTypeEnum
+    width: int
+    height: int
+    fps: float
+    # Estimated USB bandwidth of the stream
+    mbps: float
+
+
+class UsbControllerPlanModel(BaseModel):
+    # Root hub (bus) the streams share, e.g. usb1
+    root_hub: str
+    # Host controller of the root hub, e.g. 0000:01:00.0
+    controller: str
+    speed_mbps: int
+    budget_mbps: float
+    allocated_mbps: float
+    oversubscribed: bool
+    streams: List[UsbStreamAllocationModel]
+    # Changes that would bring the root hub within its budget
+    suggestions: List[str] = []
+
+
+class BandwidthPlanModel(BaseModel):
+    admission: BandwidthAdmissionEnum
+    # Whether no root hub is oversubscribed
+    accepted: bool
+    controllers: List[UsbControllerPlanModel]
+
+
+class TetherBudgetModel(BaseModel):
+    # Allocate the H.264 bitrates of the streams sent over the tether, rather than leaving them as set by hand
+    enabled: bool = False
+    # Usable uplink of the tether, shared by every camera, in Mbps
+    total_mbps: float = Field(80, gt=0)
+    # Left free for telemetry and everything else on the tether
+    reserve_mbps: float = Field(5, ge=0)
+    # Bounds of an allocated H.264 bitrate, in Mbps
+    min_mbps: float = Field(1, gt=0)
+    max_mbps: float = Field(15, gt=0)
+    # Share of the budget of each camera by bus_info, relative to the others, cameras not listed have a priority of 1
+    priorities: Dict[str, float] = {}
+
+
+class TetherStreamAllocationModel(BaseModel):
+    bus_info: str
+    secondary: bool = False
+    encode_type: StreamEncodeTypeEnum
+    priority: float
+    # Streams sent with this bitrate, more than one for a leader and its followers
+    streams: int = 1
+    # Bitrate of each stream on the tether, in Mbps
+    mbps: float
+    # Whether the bitrate is allocated by the budget, False for MJPEG (measured) and H.264 without a bitrate control
+    allocated: bool
+
+
+class TetherBudgetPlanModel(BaseModel):
+    enabled: bool
+    total_mbps: float
+    # Left to the allocated streams, after the reserve and the streams with a fixed bitrate
+    available_mbps: float
+    allocated_mbps: float
+    # Whether the streams exceed the total even at the minimum bitrate
+    oversubscribed: bool
+    streams: List[TetherStreamAllocationModel]
+
+
+class AdaptiveBitrateModel(BaseModel):
+    # Adapt the bitrate of H.264 streams sent over UDP to the loss reported by their receivers
+    enabled: bool = False
+    # Port the receivers send their RTCP receiver reports (or JSON loss feedback) to
+    feedback_port: int = Field(5700, ge=1, le=65535)
+    # Bounds of the adapted bitrate in Mbps, the tether budget lowers the upper bound when enabled
+    min_mbps: float = Field(1, gt=0)
+    max_mbps: float = Field(15, gt=0)
+
+
+class AdaptiveBitrateStatusModel(BaseModel):
+    bus_info: str
+    secondary: bool = False
+    # SSRC of the stream's RTP packets, which the receiver reports refer to
+    ssrc: int
+    bitrate_mbps: float
+    ceiling_mbps: float
+    # Highest fraction of packets lost over the last reports, None without recent reports
+    fraction_lost: Optional[float] = None
+    # Interarrival jitter reported by the receivers
+    jitter_ms: Optional[float] = None
+    # Receivers that reported recently
+    receivers: int = 0
+
+
+class DiagnosticsStateEnum(str, Enum):
+    RUNNING = "RUNNING"
+    COMPLETE = "COMPLETE"
+    # The stream stopped, or could not be traced
+    FAILED = "FAILED"
+
+
+class DiagnosticsRequestModel(BaseModel):
+    # How long the pipeline is traced
+    duration_s: float = Field(10, ge=1, le=300)
+    secondary: bool = False
+
+
+class LatencyBreakdownModel(BaseModel):
+    # Element, or source -> sink for the whole pipeline
+    name: str
+    samples: int
+    mean_ms: float
+    p95_ms: float
+    max_ms: float
+
+
+class ThreadCpuModel(BaseModel):
+    tid: int
+    # GStreamer names its streaming threads after the pad they run, e.g. queue0:src
+    name: str
+    # Percent of one CPU, over the thread's lifetime
+    cpu_percent: float
+
+
+class PipelineDiagnosticsModel(BaseModel):
+    bus_info: str
+    secondary: bool = False
+    state: DiagnosticsStateEnum
+    # Unix time the traced pipeline was started
+    started_at: float
+    duration_s: float
+    directory: str
+    # Latency of every buffer from each source to each sink
+    pipeline_latency: List[LatencyBreakdownModel] = []
+    # Time each element takes to process a buffer
+    element_latency: List[LatencyBreakdownModel] = []
+    threads: List[ThreadCpuModel] = []
+    # Average CPU load of the pipeline process, in percent of all CPUs (rusage tracer)
+    process_cpu_percent: Optional[float] = None
+    # DOT graphs of the pipeline by state change, PAUSED_PLAYING is the negotiated pipeline
+    dot_graphs: Dict[str, str] = {}
+    error: Optional[str] = None
+
+
+class StreamFallbackModel(BaseModel):
+    bus_info: str
+    step: FallbackStepEnum
+    # Error that caused the fallback
+    error: Optional[str] = None
+    from_encode_type: StreamEncodeTypeEnum
+    from_format: StreamFormatModel
+    to_encode_type: StreamEncodeTypeEnum
+    to_format: StreamFormatModel
+
+
+class EngineInfoModel(BaseModel):
+    name: str
+    encode_types: List[StreamEncodeTypeEnum]
+    stream_types: List[StreamTypeEnum]
+    min_cameras: int
+    max_cameras: int
+    synchronized: bool
+    in_process: bool
+    cost: int
+    # Whether the engine's dependencies are installed
+    available: bool
+
+
+class EncoderBenchmarkModel(BaseModel):
+    element: str
+    width: int
+    height: int
+    fps: int
+    # Frames per second the encoder reached on this device
+    achieved_fps: float
+
+
+class SnapshotRequestModel(BaseModel):
+    # Number of consecutive frames to capture
+    count: int = Field(1, ge=1, le=100)
+
+
+class SnapshotFrameModel(BaseModel):
+    path: str
+    # Position of the camera in a synchronized rig, 0 otherwise
+    camera_index: int = 0
+    timestamp_us: int
+    sequence: int
+    width: int
+    height: int
+
+
+class TimelapseRequestModel(BaseModel):
+    # Seconds between stills
+    interval_s: float = Field(ge=0.5, le=86400)
+    # Stop after this many seconds, None runs until stopped
+    duration_s: Optional[float] = Field(default=None, gt=0)
+    # Resolution of the MJPEG node, the stream's (or the largest) by default
+    width: Optional[int] = None
+    height: Optional[int] = None
+
+
+class TimelapseStatusModel(BaseModel):
+    bus_info: str
+    # Directory of the stills and their manifest.jsonl
+    directory: str
+    interval_s: float
+    frames: int
+    # Shots without a frame (e.g. the node was busy), listed in the manifest
+    missed: int
+    running: bool
+    # Unix time
+    started_at: float
+    next_shot_in: Optional[float] = None
+
+
 class SimpleRequestStatusModel(BaseModel):
     success: bool = True
+
+
+class ProcessResourceModel(BaseModel):
+    pid: int
+    # Name of the process, e.g. gst-launch-1.0 for the pipeline or srt-live-transmit for an SRT sender
+    name: str
+    # Percent of one CPU over the last sample interval
+    cpu_percent: float
+    rss_mb: float
+    # Written to storage, sockets are not counted
+    disk_write_kbps: Optional[float] = None
+
+
+class StreamResourceModel(BaseModel):
+    bus_info: str
+    secondary: bool = False
+    engine: str
+    # Percent of one CPU, over the engine's child processes and in-process threads
+    cpu_percent: float
+    # Busiest thread, a thread near 100 % cannot keep up whatever the number of CPUs
+    max_thread_cpu_percent: float
+    max_thread_name: Optional[str] = None
+    # Resident memory of the child processes, None for engines running in-process
+    rss_mb: Optional[float] = None
+    disk_write_kbps: float = 0
+    processes: List[ProcessResourceModel] = []
+    # In-process threads of the engine
+    threads: int = 0
+    # Growth of the resident memory since the stream started, None until it ran long enough to tell
+    rss_growth_mb_per_hour: Optional[float] = None
+    # Frames are dropped, or not sent as fast as they are captured
+    falling_behind: bool = False
+    # Resident memory keeps growing
+    leaking: bool = False
+    # Why the stream is flagged, and the saturated threads
+    warnings: List[str] = []
+    timestamp: float
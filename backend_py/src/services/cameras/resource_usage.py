@@ -0,0 +1,341 @@
+"""
+resource_usage.py
+
+Accounting of the CPU, memory and disk writes of every stream, sampled from /proc every few seconds
+Engine child processes (gst-launch pipelines, SRT senders, recording muxers) are read from /proc/<pid>/stat, statm and
+io along with their threads, and the threads engines run in this process from /proc/self/task/<tid>. Streams are flagged
+when they fall behind (frames dropped, or sent slower than captured) or when the memory of their processes keeps growing.
+"""
+
+import logging
+import os
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+from .device import Device
+from .pydantic_schemas import ProcessResourceModel, StreamResourceModel, StreamStatsModel
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+MB = 1024 * 1024
+
+
+@dataclass
+class TaskStat:
+    """
+    Attributes:
+        name     name of the process or thread, truncated to 15 characters by the kernel
+        ticks    CPU time used, user and system, in clock ticks
+        started  seconds since boot at which the task started
+    """
+    name: str
+    ticks: int
+    started: float
+
+
+def read_stat(path: str) -> Optional[TaskStat]:
+    """
+    Read a /proc/<pid>/stat or /proc/<pid>/task/<tid>/stat file, None if the task exited
+    """
+    try:
+        with open(path) as f:
+            content = f.read()
+    except OSError:
+        return None
+    # The name may contain spaces, the fields after it are (3) state ... (14) utime (15) stime ... (22) starttime
+    name = content[content.find("(") + 1:content.rfind(")")]
+    fields = content[content.rfind(")") + 2:].split()
+    return TaskStat(name=name, ticks=int(fields[11]) + int(fields[12]), started=int(fields[19]) / CLOCK_TICKS)
+
+
+def read_rss(pid: int) -> Optional[int]:
+    """
+    Get the resident memory of a process in bytes
+    """
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def read_write_bytes(path: str) -> Optional[int]:
+    """
+    Get the bytes a task caused to be written to storage from its /proc io file, None if unavailable
+    """
+    try:
+        with open(path) as f:
+            for line in f:
+                if line.startswith("write_bytes:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def list_tasks(pid: int) -> List[int]:
+    try:
+        return [int(tid) for tid in os.listdir(f"/proc/{pid}/task")]
+    except OSError:
+        return []
+
+
+@dataclass
+class _Counters:
+    ticks: int
+    write_bytes: Optional[int]
+    # Seconds since boot of the sample, and of the task's start to tell a reused id apart
+    at: float
+    started: float
+
+
+@dataclass
+class _StreamHistory:
+    # Pipeline process of the stream, the history starts over when it changes (the stream restarted)
+    pid: Optional[int]
+    started: float
+    capture_drops: int = 0
+    queue_drops: int = 0
+    # Consecutive samples sending slower than capturing
+    slow_samples: int = 0
+    # Whether the engine counted a sent frame, the send side is not judged before
+    sends_counted: bool = False
+    # (seconds since boot, resident bytes) over the leak window
+    rss: Deque[Tuple[float, int]] = field(default_factory=deque)
+
+
+class ResourceMonitor:
+    """
+    Samples the resources of every running stream, about every SAMPLE_INTERVAL seconds
+    """
+
+    SAMPLE_INTERVAL = 5
+    # A thread using this much of one CPU cannot do more, whatever the number of CPUs
+    SATURATED_THREAD_PERCENT = 95
+    # Sent frame rate below this ratio of the captured one, over consecutive samples, is falling behind
+    FALLING_BEHIND_RATIO = 0.9
+    FALLING_BEHIND_SAMPLES = 2
+    # Pipelines grow while their buffer pools fill up, memory is judged after this long (seconds)
+    LEAK_WARMUP = 60
+    # Memory is judged over this window (seconds), growing faster than LEAK_MB_PER_HOUR over all of it is a leak
+    LEAK_WINDOW = 600
+    LEAK_MB_PER_HOUR = 20
+
+    def __init__(self) -> None:
+        self.logger = logging.getLogger("dwe_os_2.cameras.ResourceMonitor")
+
+        self._last_sample = 0.0
+        # By (pid, tid), tid 0 for a whole process
+        self._counters: Dict[Tuple[int, int], _Counters] = {}
+        # By (bus_info, secondary)
+        self._history: Dict[Tuple[str, bool], _StreamHistory] = {}
+        self._usage: List[StreamResourceModel] = []
+
+    def sample_due(self) -> bool:
+        return time.monotonic() - self._last_sample >= self.SAMPLE_INTERVAL
+
+    def get_usage(self) -> List[StreamResourceModel]:
+        """
+        Get the resources used by every running stream at the last sample
+        """
+        return self._usage
+
+    def sample(self, devices: List[Device], stats: Dict[Tuple[str, bool], StreamStatsModel] = {}) -> List[StreamResourceModel]:
+        """
+        Sample every running stream, stats are the latest of the running streams by (bus_info, secondary)
+        Returns the streams that were flagged at this sample and not at the previous one
+        """
+        self._last_sample = time.monotonic()
+        now = time.clock_gettime(time.CLOCK_BOOTTIME)
+        previous = {(usage.bus_info, usage.secondary): usage for usage in self._usage}
+        seen: Set[Tuple[int, int]] = set()
+        usage: List[StreamResourceModel] = []
+        flagged: List[StreamResourceModel] = []
+        for device in devices:
+            for secondary in [False, True]:
+                runner = device.secondary_stream_runner if secondary else device.stream_runner
+                engine = runner.engine
+                if not runner.started or not engine:
+                    continue
+                key = (device.bus_info, secondary)
+                stream_usage = self._sample_stream(key, engine.name, runner.get_process_ids(), runner.get_thread_ids(),
+                                                   stats.get(key), now, seen)
+                if stream_usage is None:
+                    continue
+                usage.append(stream_usage)
+
+                last = previous.get(key)
+                if (stream_usage.falling_behind and not (last and last.falling_behind)) or (
+                        stream_usage.leaking and not (last and last.leaking)):
+                    self.logger.warning(
+                        f"{device.bus_info}: {'Secondary stream' if secondary else 'Stream'} {'; '.join(stream_usage.warnings)}")
+                    flagged.append(stream_usage)
+
+        # Forget the tasks and streams that stopped
+        self._counters = {key: counters for (key, counters) in self._counters.items() if key in seen}
+        running = {(stream_usage.bus_info, stream_usage.secondary) for stream_usage in usage}
+        self._history = {key: history for (key, history) in self._history.items() if key in running}
+        self._usage = usage
+        return flagged
+
+    def _sample_stream(self, key: Tuple[str, bool], engine: str, pids: List[int], tids: List[int],
+                       stats: Optional[StreamStatsModel], now: float, seen: Set[Tuple[int, int]]) -> StreamResourceModel | None:
+        cpu = 0.0
+        write_bps = 0.0
+        (max_thread_cpu, max_thread_name) = (0.0, None)
+        rss: Optional[int] = None
+        processes: List[ProcessResourceModel] = []
+        started = now
+
+        for pid in pids:
+            stat = read_stat(f"/proc/{pid}/stat")
+            process_rss = read_rss(pid)
+            if stat is None or process_rss is None:
+                continue
+            (process_cpu, process_write) = self._rates(
+                (pid, 0), stat, read_write_bytes(f"/proc/{pid}/io"), now, seen)
+            cpu += process_cpu
+            write_bps += process_write or 0
+            rss = (rss or 0) + process_rss
+            started = min(started, stat.started)
+            processes.append(ProcessResourceModel(
+                pid=pid,
+                name=stat.name,
+                cpu_percent=round(process_cpu, 1),
+                rss_mb=round(process_rss / MB, 1),
+                disk_write_kbps=round(process_write * 8 / 1000, 1) if process_write is not None else None,
+            ))
+            for tid in list_tasks(pid):
+                thread = read_stat(f"/proc/{pid}/task/{tid}/stat")
+                if thread is None:
+                    continue
+                (thread_cpu, _) = self._rates((pid, tid), thread, None, now, seen)
+                if thread_cpu > max_thread_cpu:
+                    (max_thread_cpu, max_thread_name) = (thread_cpu, thread.name)
+
+        own_pid = os.getpid()
+        threads = 0
+        for tid in tids:
+            thread = read_stat(f"/proc/{own_pid}/task/{tid}/stat")
+            if thread is None:
+                # The thread exited, e.g. a GStreamer streaming thread of a media that was torn down
+                continue
+            threads += 1
+            (thread_cpu, thread_write) = self._rates(
+                (own_pid, tid), thread, read_write_bytes(f"/proc/{own_pid}/task/{tid}/io"), now, seen)
+            cpu += thread_cpu
+            write_bps += thread_write or 0
+            if thread_cpu > max_thread_cpu:
+                (max_thread_cpu, max_thread_name) = (thread_cpu, thread.name)
+
+        if len(processes) == 0 and threads == 0:
+            return None
+
+        warnings: List[str] = []
+        # Muxers are respawned after every recording, the pipeline comes first and lives as long as the stream
+        falling_behind = self._falling_behind(key, pids[0] if len(pids) > 0 else None, started, stats, warnings)
+        if max_thread_cpu >= self.SATURATED_THREAD_PERCENT:
+            warnings.append(f"thread {max_thread_name} uses {max_thread_cpu:.0f} % of a CPU")
+        (growth, leaking) = self._leaking(key, rss, now, warnings)
+
+        return StreamResourceModel(
+            bus_info=key[0],
+            secondary=key[1],
+            engine=engine,
+            cpu_percent=round(cpu, 1),
+            max_thread_cpu_percent=round(max_thread_cpu, 1),
+            max_thread_name=max_thread_name,
+            rss_mb=round(rss / MB, 1) if rss is not None else None,
+            disk_write_kbps=round(write_bps * 8 / 1000, 1),
+            processes=processes,
+            threads=threads,
+            rss_growth_mb_per_hour=growth,
+            falling_behind=falling_behind,
+            leaking=leaking,
+            warnings=warnings,
+            timestamp=time.time(),
+        )
+
+    def _rates(self, key: Tuple[int, int], stat: TaskStat, write_bytes: Optional[int], now: float,
+               seen: Set[Tuple[int, int]]) -> Tuple[float, Optional[float]]:
+        """
+        Get the CPU percent and the bytes written per second of a task since its previous sample
+        """
+        seen.add(key)
+        previous = self._counters.get(key)
+        if previous is None or previous.started != stat.started:
+            # First sample of the task, averaged since it started
+            previous = _Counters(ticks=0, write_bytes=0, at=stat.started, started=stat.started)
+        self._counters[key] = _Counters(ticks=stat.ticks, write_bytes=write_bytes, at=now, started=stat.started)
+
+        elapsed = now - previous.at
+        if elapsed <= 0:
+            return (0.0, None)
+        cpu = max(stat.ticks - previous.ticks, 0) / CLOCK_TICKS / elapsed * 100
+        if write_bytes is None or previous.write_bytes is None:
+            return (cpu, None)
+        return (cpu, max(write_bytes - previous.write_bytes, 0) / elapsed)
+
+    def _falling_behind(self, key: Tuple[str, bool], pid: Optional[int], started: float,
+                        stats: Optional[StreamStatsModel], warnings: List[str]) -> bool:
+        history = self._history.get(key)
+        restarted = history is None or history.pid != pid
+        if restarted:
+            history = _StreamHistory(pid=pid, started=started)
+            self._history[key] = history
+        if stats is None:
+            return False
+
+        falling_behind = False
+        # The drop counters count since the stream started
+        (capture_drops, queue_drops) = (stats.capture_drops - history.capture_drops,
+                                        stats.queue_drops - history.queue_drops)
+        (history.capture_drops, history.queue_drops) = (stats.capture_drops, stats.queue_drops)
+        if not restarted and capture_drops > 0:
+            warnings.append(f"{capture_drops} frames dropped by the driver")
+            falling_behind = True
+        # Engines that do not see their sends (e.g. a stats line they cannot parse) would count every frame as dropped
+        history.sends_counted = history.sends_counted or stats.sent_fps > 0
+        if not history.sends_counted:
+            return falling_behind
+        if not restarted and queue_drops > 0:
+            warnings.append(f"{queue_drops} frames dropped before sending")
+            falling_behind = True
+
+        if stats.captured_fps > 0 and stats.sent_fps < stats.captured_fps * self.FALLING_BEHIND_RATIO:
+            history.slow_samples += 1
+        else:
+            history.slow_samples = 0
+        if history.slow_samples >= self.FALLING_BEHIND_SAMPLES:
+            warnings.append(
+                f"sending {stats.sent_fps:.1f} of {stats.captured_fps:.1f} captured fps")
+            falling_behind = True
+        return falling_behind
+
+    def _leaking(self, key: Tuple[str, bool], rss: Optional[int], now: float, warnings: List[str]) -> Tuple[Optional[float], bool]:
+        """
+        Get the memory growth of a stream's processes in MB per hour, None until it ran long enough, and whether it leaks
+        Engines running in-process share the memory of the backend, it cannot be told apart
+        """
+        history = self._history[key]
+        if rss is None or now - history.started < self.LEAK_WARMUP:
+            return (None, False)
+        history.rss.append((now, rss))
+        while now - history.rss[0][0] > self.LEAK_WINDOW:
+            history.rss.popleft()
+
+        (first_at, first_rss) = history.rss[0]
+        if now - first_at < self.SAMPLE_INTERVAL:
+            return (None, False)
+        growth = (rss - first_rss) / MB / ((now - first_at) / 3600)
+        # A leak grows over the whole window, a pipeline settling into a larger steady state does not
+        covered = now - first_at >= self.LEAK_WINDOW - self.SAMPLE_INTERVAL
+        midpoint = first_at + (now - first_at) / 2
+        second_half_minimum = min(sample_rss for (at, sample_rss) in history.rss if at >= midpoint)
+        first_half_maximum = max(sample_rss for (at, sample_rss) in history.rss if at < midpoint)
+        leaking = covered and growth >= self.LEAK_MB_PER_HOUR and second_half_minimum > first_half_maximum
+        if leaking:
+            warnings.append(f"resident memory grows by {growth:.0f} MB per hour")
+        return (round(growth, 1), leaking)
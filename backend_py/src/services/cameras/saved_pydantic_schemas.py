@@ -8,7 +8,7 @@ Includes schemas for serializing device states (streams, controls, nicknames) to
 from pydantic import BaseModel
 from typing import List, Optional
 
-from .pydantic_schemas import StreamEndpointModel, IntervalModel, DeviceType, StreamEncodeTypeEnum, StreamTypeEnum
+from .pydantic_schemas import StreamEndpointModel, IntervalModel, DeviceType, StreamEncodeTypeEnum, StreamTypeEnum, RecordingOptionsModel, SrtOptionsModel, LatencyProfileEnum
 
 
 class SavedControlModel(BaseModel):
@@ -28,6 +28,10 @@ class SavedStreamModel(BaseModel):
     height: int
     interval: IntervalModel
     enabled: bool
+    recording: RecordingOptionsModel = RecordingOptionsModel()
+    srt: SrtOptionsModel = SrtOptionsModel()
+    engine: Optional[str] = None
+    latency_profile: LatencyProfileEnum = LatencyProfileEnum.BALANCED
 
     class Config:
         # use_enum_values = True
@@ -40,6 +44,8 @@ class SavedDeviceModel(BaseModel):
     pid: int
     nickname: str
     stream: SavedStreamModel
+    # Second stream from another node of the camera
+    secondary_stream: Optional[SavedStreamModel] = None
     controls: List[SavedControlModel]
     device_type: DeviceType
     followers: Optional[List[str]] = []
@@ -29,6 +29,8 @@ class SettingsManager:
             open(path, "w").close()
             self.file_object = open(path, "r+")
         self.to_save: List[SavedDeviceModel] = []
+        self._lock = threading.Lock()
+        self._running = True
         self.thread = threading.Thread(target=self._run_settings_sync)
         self.thread.start()
 
@@ -174,12 +176,26 @@ class SettingsManager:
         self.file_object.flush()
 
     def _run_settings_sync(self):
-        while True:
-            for saved_device in self.to_save:
-                self._save_device(saved_device)
-            self.to_save = []
+        while self._running:
+            self.flush()
             time.sleep(1)
 
+    def flush(self):
+        """
+        Write the pending saves now
+        """
+        with self._lock:
+            (to_save, self.to_save) = (self.to_save, [])
+            for saved_device in to_save:
+                self._save_device(saved_device)
+
+    def stop(self):
+        """
+        Stop the background sync, writing the pending saves first
+        """
+        self._running = False
+        self.flush()
+
     def save_device(self, device: Device):
         # schedule a save command
         self.to_save.append(SavedDeviceModel.model_validate(device))
@@ -210,6 +210,8 @@ class SHDDevice(Device):
 
         # Make the follower managed
         device.set_is_managed(True)
+        # The leader streams for one more or one less camera
+        self.emit("stream_configured", False)
 
         if self.stream.enabled:
             self.start_stream()
@@ -229,6 +231,8 @@ class SHDDevice(Device):
         device.set_is_managed(False)
 
         self.logger.info('Removing follower')
+        # The leader streams for one more or one less camera
+        self.emit("stream_configured", False)
 
         if self.stream.enabled:
             self.start_stream()
@@ -433,6 +437,28 @@ class SHDDevice(Device):
 
         return options
 
+    def can_set_bitrate(self, encode_type: StreamEncodeTypeEnum) -> bool:
+        # The bitrate option is the software encoder's
+        return encode_type == StreamEncodeTypeEnum.SOFTWARE_H264
+
+    def get_stream_bitrate(self, secondary: bool = False) -> float | None:
+        if secondary:
+            return super().get_stream_bitrate(secondary)
+        if not self.can_set_bitrate(self.stream.encode_type):
+            return None
+        return float(self.bitrate_option.get_value())
+
+    def set_stream_bitrate(self, mbps: float, secondary: bool = False):
+        if secondary:
+            return super().set_stream_bitrate(mbps, secondary)
+        if not self.can_set_bitrate(self.stream.encode_type):
+            return
+        # Restarts the stream (and its followers) if it is running
+        self.set_option("bitrate", mbps)
+        for control in self.controls:
+            if control.name == self.bitrate_option.name:
+                control.value = mbps
+
     def load_settings(self, saved_device: SavedDeviceModel):
         return super().load_settings(saved_device)
 
@@ -447,7 +473,8 @@ class SHDDevice(Device):
         for follower_device in self.follower_devices:
             # A not so hacky fix (very clever :]) to ensure the stream's device_path is set
             follower_device.configure_stream(self.stream.encode_type, self.stream.width,
-                                             self.stream.height, self.stream.interval, self.stream.stream_type, [])
+                                             self.stream.height, self.stream.interval, self.stream.stream_type, [],
+                                             latency_profile=self.stream.latency_profile)
 
             # Append the new device stream
             self.stream_runner.streams.append(follower_device.stream)
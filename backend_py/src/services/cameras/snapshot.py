@@ -0,0 +1,97 @@
+"""
+snapshot.py
+
+Still capture from a frame tap, without interrupting the stream the frames come from
+JPEG frames are written exactly as the camera produced them, at the capture's resolution
+"""
+
+import os
+import re
+import stat
+from datetime import datetime
+from typing import List
+
+from .stream_engines.frame_tap import FrameTap
+from .synchronized_camera import CopiedFrame
+from .pydantic_schemas import SnapshotFrameModel
+from . import v4l2
+
+# Time to wait for each frame, generous enough for a tap that still has to attach
+SNAPSHOT_TIMEOUT = 3
+
+
+def get_snapshot_dir() -> str:
+    snapshot_dir = os.path.join(os.getcwd(), "snapshots")
+    if not os.path.exists(snapshot_dir):
+        os.makedirs(snapshot_dir)
+        permissions = stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH
+        os.chmod(snapshot_dir, permissions)
+    return snapshot_dir
+
+
+def capture_snapshots(tap: FrameTap, name: str, count: int = 1) -> List[SnapshotFrameModel]:
+    """
+    Capture count consecutive frame sets from the tap and write them to the snapshot directory
+
+    Every frame set holds one frame per camera, so synchronized rigs save matched pairs.
+    Frames are only kept in memory until the burst is complete, so writing never makes the burst skip frames.
+    """
+    bursts: List[List[CopiedFrame]] = []
+    tap.subscribe()
+    try:
+        # Only frames captured after the request count
+        (index, _) = tap.latest()
+        while len(bursts) < count:
+            (index, frames) = tap.wait_for_frame(index, SNAPSHOT_TIMEOUT)
+            if frames is None:
+                break
+            bursts.append(frames)
+    finally:
+        tap.unsubscribe()
+
+    snapshot_dir = get_snapshot_dir()
+    prefix = re.sub(r"[^A-Za-z0-9._-]", "_", name)
+    now = datetime.now()
+    timestamp = f"{now.strftime('%F-%T')}.{now.microsecond // 1000:03d}"
+
+    results: List[SnapshotFrameModel] = []
+    for (i, frames) in enumerate(bursts):
+        for (camera_index, frame) in enumerate(frames):
+            filename = f"{prefix}_{timestamp}_{i}"
+            if len(frames) > 1:
+                filename += f"_cam{camera_index}"
+            path = _write_new_file(snapshot_dir, filename,
+                                   _extension(frame), frame.data)
+            results.append(SnapshotFrameModel(
+                path=path,
+                camera_index=camera_index,
+                timestamp_us=frame.timestamp_us,
+                sequence=frame.sequence,
+                width=frame.width,
+                height=frame.height,
+            ))
+    return results
+
+
+def _write_new_file(directory: str, filename: str, extension: str, data: bytes) -> str:
+    """
+    Write data to a file that did not exist, numbering the name if it is taken, returns its path
+    """
+    path = os.path.join(directory, f"{filename}.{extension}")
+    counter = 1
+    while True:
+        try:
+            with open(path, "xb") as f:
+                f.write(data)
+            return path
+        except FileExistsError:
+            counter += 1
+            path = os.path.join(directory, f"{filename}-{counter}.{extension}")
+
+
+def _extension(frame: CopiedFrame) -> str:
+    if frame.pixel_format == v4l2.V4L2_PIX_FMT_MJPEG:
+        return "jpg"
+    if frame.pixel_format == v4l2.V4L2_PIX_FMT_H264:
+        return "h264"
+    return "raw"
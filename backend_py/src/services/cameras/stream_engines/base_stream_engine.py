@@ -1,6 +1,13 @@
 from abc import ABC, abstractmethod
-from typing import List, Callable
+import threading
+from typing import List, Callable, Optional, Set
 from .stream import Stream
+from .stream_stats import StreamStatsCollector
+from .frame_tap import FrameTap
+from .instant_recorder import InstantRecorder
+from .scheduling import SchedulingManager
+from .engine_registry import EngineCapabilities
+from ..pydantic_schemas import StreamStatsModel
 import logging
 
 
@@ -9,13 +16,50 @@ class BaseStreamEngine(ABC):
     Abstract class for any streaming backend
     """
 
-    def __init__(self, streams: List[Stream], error_callback: Callable[[str], None]):
+    # Shared by all engines, replaced by the device manager with one reading the saved preferences
+    scheduler = SchedulingManager()
+
+    # What the engine supports, must be declared by every registered engine
+    CAPABILITIES: EngineCapabilities
+    # Whether the engine traces its pipeline while a stream has a diagnostics_dir
+    DIAGNOSTICS = False
+
+    @classmethod
+    def is_available(cls) -> bool:
+        """
+        Whether the engine's dependencies are installed
+        """
+        return True
+
+    def __init__(self, streams: List[Stream], error_callback: Callable[..., None]):
         super().__init__()
 
         self.streams = streams
+        # Called with the error message, and optionally its StreamErrorKindEnum
         self.emit_error = error_callback
         self.logger = logging.getLogger(
             f"dwe_os_2.cameras.{self.__class__.__name__}")
+        self.stats = StreamStatsCollector()
+        # Latest captured frames, for engines that can share them (MJPEG sources)
+        self.frame_tap: Optional[FrameTap] = None
+        # Idle recording branch of the live stream, for engines that can record it without restarting
+        self.recorder: Optional[InstantRecorder] = None
+        # Native ids of the engine's threads in this process, for resource accounting
+        self._thread_ids: Set[int] = set()
+
+    @property
+    def name(self) -> str:
+        return self.__class__.__name__
+
+    def apply_thread_policy(self, capture: bool = False):
+        """
+        Apply this engine's scheduling policy to the calling thread, and count it as one of the engine's threads
+        """
+        self.register_current_thread()
+        self.scheduler.apply_to_current_thread(self.name, capture)
+
+    def register_current_thread(self):
+        self._thread_ids.add(threading.get_native_id())
 
     @abstractmethod
     def start(self):
@@ -23,3 +67,35 @@ class BaseStreamEngine(ABC):
 
     def stop(self):
         pass
+
+    def kill(self):
+        """
+        Release the devices right away, called when a stop is taking too long (e.g. at shutdown)
+        Must not block, and may be called while stop() runs on another thread.
+        """
+        pass
+
+    def process_ids(self) -> List[int]:
+        """
+        Child processes running the streams, empty for engines running in-process
+        """
+        return []
+
+    def thread_ids(self) -> List[int]:
+        """
+        Threads of this process running the streams, some may have exited
+        """
+        return list(self._thread_ids)
+
+    def request_keyframe(self) -> bool:
+        """
+        Ask the engine's own (software) encoder for a keyframe, returns False if it cannot
+        Hardware encoders are asked by the device
+        """
+        return False
+
+    def get_stats(self) -> StreamStatsModel:
+        """
+        Stats since the last call, should be called about once per second
+        """
+        return self.stats.snapshot(self.name)
@@ -0,0 +1,276 @@
+"""
+encoders.py
+
+Registry of the GStreamer H.264 encoders available for software H.264 streams
+Probes which encoders are installed, benchmarks them with videotestsrc for each resolution/fps in use,
+caches the results to disk, and selects the fastest encoder that keeps up in real time
+"""
+
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+import json
+import logging
+import os
+import queue
+import subprocess
+import threading
+import time
+import event_emitter as events
+
+from .latency_profiles import LatencyProfile, get_latency_profile
+
+
+@dataclass
+class H264EncoderSpec:
+    """
+    A GStreamer H.264 encoder element and how to configure it
+
+    Attributes:
+        element          name of the GStreamer element
+        build            returns the pipeline fragment for a bitrate (kbit/sec), byte-stream output,
+                         latency profile and keyframe interval (frames)
+    """
+    element: str
+    build: Callable[[int, bool, LatencyProfile, int], str]
+
+
+# Ordered by preference, so hardware encoders win ties
+H264_ENCODERS: List[H264EncoderSpec] = [
+    H264EncoderSpec(
+        "v4l2h264enc",
+        lambda bitrate, byte_stream, profile, key_int: f'v4l2h264enc extra-controls="controls,video_bitrate={bitrate * 1000},h264_i_frame_period={key_int}" ! video/x-h264,level=(string)4',
+    ),
+    H264EncoderSpec(
+        "vaapih264enc",
+        lambda bitrate, byte_stream, profile, key_int: f"vaapih264enc bitrate={bitrate} keyframe-period={key_int}",
+    ),
+    H264EncoderSpec(
+        "openh264enc",
+        lambda bitrate, byte_stream, profile, key_int: f"openh264enc bitrate={bitrate * 1000} complexity=low gop-size={key_int}",
+    ),
+    H264EncoderSpec(
+        "x264enc",
+        lambda bitrate, byte_stream, profile, key_int: f"x264enc byte-stream={'true' if byte_stream else 'false'}{f' tune={profile.x264_tune}' if profile.x264_tune else ''} bitrate={bitrate} speed-preset={profile.x264_preset} key-int-max={key_int}",
+    ),
+]
+
+# Always installed with gstreamer1.0-plugins-ugly, used until benchmarks are available
+DEFAULT_ENCODER = H264_ENCODERS[-1]
+
+
+class H264EncoderRegistry(events.EventEmitter):
+    """
+    Picks the software H.264 encoder for a given resolution and framerate
+
+    Benchmarks run in a background thread the first time a format is requested, so stream startup never waits on them.
+    Until a benchmark finishes, the default encoder (x264enc) is used, and "benchmark_complete" is emitted with the
+    (width, height, fps) so running streams can switch over.
+    """
+
+    # Frames encoded per benchmark, in seconds of video
+    BENCHMARK_SECONDS = 3
+    BENCHMARK_TIMEOUT = 30
+    # An encoder must run this much faster than real time to be considered keeping up,
+    # since jpegdec and the other streams share the CPU at runtime
+    REALTIME_MARGIN = 1.2
+
+    def __init__(self, settings_path: Optional[str] = None) -> None:
+        super().__init__()
+        self.logger = logging.getLogger("dwe_os_2.cameras.H264EncoderRegistry")
+        self.cache_path = f"{settings_path}/encoder_benchmarks.json" if settings_path else None
+
+        self._lock = threading.Lock()
+        # element -> installed
+        self._available: Dict[str, bool] = {}
+        # "element:WxH@fps" -> achieved fps
+        self._results: Dict[str, float] = {}
+        self._pending: set[Tuple[int, int, int]] = set()
+        self._queue: queue.Queue[Tuple[int, int, int]] = queue.Queue()
+        # Worker running the queued benchmarks, None once it exited, both decided under the lock
+        self._thread: Optional[threading.Thread] = None
+
+        self._gst_version = self._get_gst_version() if self.cache_path else ""
+        self._load_cache()
+
+    def select(self, width: int, height: int, fps: int) -> H264EncoderSpec:
+        """
+        Get the fastest encoder that keeps up with the given format in real time.
+        Schedules a benchmark if this format has not been measured yet.
+        """
+        key = (width, height, fps)
+        with self._lock:
+            results = {spec.element: self._results.get(self._result_key(spec.element, *key))
+                       for spec in H264_ENCODERS if self._available.get(spec.element, True)}
+
+        if any(achieved is None for achieved in results.values()):
+            self.schedule_benchmark(width, height, fps)
+            return DEFAULT_ENCODER
+
+        return self._pick(results, fps)
+
+    def schedule_benchmark(self, width: int, height: int, fps: int):
+        key = (width, height, fps)
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+            self._queue.put(key)
+
+            if not self._thread:
+                self._spawn_worker()
+
+    def _spawn_worker(self):
+        """
+        Called with the lock held
+        """
+        self._thread = threading.Thread(
+            target=self._run_benchmarks, daemon=True)
+        self._thread.start()
+
+    def get_results(self) -> List[Tuple[str, int, int, int, float]]:
+        """
+        Get all benchmark results as (element, width, height, fps, achieved_fps)
+        """
+        results = []
+        with self._lock:
+            for key, achieved in self._results.items():
+                element, fmt = key.split(":")
+                size, fps = fmt.split("@")
+                width, height = size.split("x")
+                results.append((element, int(width), int(height),
+                               int(fps), achieved))
+        return results
+
+    def _pick(self, results: Dict[str, float], fps: int) -> H264EncoderSpec:
+        candidates = [spec for spec in H264_ENCODERS if spec.element in results]
+        realtime = [
+            spec for spec in candidates if results[spec.element] >= fps * self.REALTIME_MARGIN]
+        if len(realtime) > 0:
+            return max(realtime, key=lambda spec: results[spec.element])
+        if len(candidates) > 0:
+            # Nothing keeps up, so drop as few frames as possible
+            return max(candidates, key=lambda spec: results[spec.element])
+        return DEFAULT_ENCODER
+
+    def _run_benchmarks(self):
+        try:
+            while True:
+                try:
+                    stream_format = self._queue.get(timeout=1)
+                except queue.Empty:
+                    with self._lock:
+                        # Keys are queued under the lock, so anything queued since is seen here or by a new worker
+                        if self._queue.empty():
+                            self._thread = None
+                            return
+                    continue
+
+                try:
+                    self._benchmark_format(*stream_format)
+                except Exception as e:
+                    # The worker keeps going, encoders left unmeasured are benchmarked the next time the format is selected
+                    self.logger.exception(
+                        f"Benchmarking {stream_format} failed: {e}")
+                finally:
+                    with self._lock:
+                        self._pending.discard(stream_format)
+        finally:
+            with self._lock:
+                if self._thread is threading.current_thread():
+                    self._thread = None
+                    if not self._queue.empty():
+                        self._spawn_worker()
+
+    def _benchmark_format(self, width: int, height: int, fps: int):
+        for spec in H264_ENCODERS:
+            if not self._is_available(spec.element):
+                continue
+            key = self._result_key(spec.element, width, height, fps)
+            with self._lock:
+                if key in self._results:
+                    continue
+
+            achieved = self._benchmark(spec, width, height, fps)
+            self.logger.info(
+                f"{spec.element} encodes {width}x{height}@{fps} at {achieved:.1f} fps")
+            with self._lock:
+                self._results[key] = achieved
+
+        self._save_cache()
+        self.emit("benchmark_complete", (width, height, fps))
+
+    def _benchmark(self, spec: H264EncoderSpec, width: int, height: int, fps: int) -> float:
+        num_buffers = fps * self.BENCHMARK_SECONDS
+        # Streams are benchmarked with the default profile, slower presets only cost more
+        profile = get_latency_profile(None)
+        pipeline = f"videotestsrc num-buffers={num_buffers} ! video/x-raw,format=I420,width={width},height={height},framerate={fps}/1 ! {spec.build(5000, True, profile, profile.key_int(fps))} ! fakesink sync=false"
+        start = time.monotonic()
+        try:
+            result = subprocess.run(
+                ["gst-launch-1.0", "-q", *pipeline.split(" ")],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=self.BENCHMARK_TIMEOUT,
+            )
+        except subprocess.TimeoutExpired:
+            return 0
+        elapsed = time.monotonic() - start
+        if result.returncode != 0:
+            # Installed, but cannot encode this format (e.g. hardware resolution limits)
+            return 0
+        return num_buffers / elapsed
+
+    def _is_available(self, element: str) -> bool:
+        with self._lock:
+            if element in self._available:
+                return self._available[element]
+        try:
+            available = subprocess.run(
+                ["gst-inspect-1.0", element],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            ).returncode == 0
+        except FileNotFoundError:
+            available = False
+        with self._lock:
+            self._available[element] = available
+        return available
+
+    @staticmethod
+    def _result_key(element: str, width: int, height: int, fps: int):
+        return f"{element}:{width}x{height}@{fps}"
+
+    @staticmethod
+    def _get_gst_version() -> str:
+        try:
+            return subprocess.run(
+                ["gst-launch-1.0", "--version"], capture_output=True, text=True).stdout.split("\n")[0]
+        except FileNotFoundError:
+            return ""
+
+    def _load_cache(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, "r") as f:
+                cache = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            self.logger.warning("Discarding unreadable encoder benchmark cache")
+            return
+        # Installed encoders (and their speed) change with GStreamer upgrades
+        if cache.get("gst_version") != self._gst_version:
+            return
+        self._available = cache.get("available", {})
+        self._results = cache.get("results", {})
+
+    def _save_cache(self):
+        if not self.cache_path:
+            return
+        with self._lock:
+            cache = {
+                "gst_version": self._gst_version,
+                "available": dict(self._available),
+                "results": dict(self._results),
+            }
+        with open(self.cache_path, "w") as f:
+            json.dump(cache, f)
@@ -0,0 +1,136 @@
+"""
+engine_registry.py
+
+Registry of the available stream engines and what each of them supports
+The stream runner asks the registry for the cheapest engine meeting the requirements of its streams,
+so new engines only have to be registered to be used
+"""
+
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, Type
+
+from .stream import Stream
+from ..pydantic_schemas import StreamEncodeTypeEnum, StreamTypeEnum, EngineInfoModel
+from ..exceptions import NoSuitableEngineException
+
+if TYPE_CHECKING:
+    from .base_stream_engine import BaseStreamEngine
+
+
+@dataclass(frozen=True)
+class EngineCapabilities:
+    """
+    What a stream engine supports
+
+    Attributes:
+        encode_types     encodings the engine can stream
+        stream_types     outputs the engine can produce (UDP, recording, RTSP, ...)
+        min_cameras      fewest cameras (streams) the engine runs with
+        max_cameras      most cameras (streams) the engine runs with
+        synchronized     whether frames of several cameras are captured in lockstep
+        in_process       whether the engine runs inside the server process rather than in a child process
+        cost             relative resource cost, the cheapest suitable engine is selected
+    """
+    encode_types: Set[StreamEncodeTypeEnum]
+    stream_types: Set[StreamTypeEnum]
+    min_cameras: int = 1
+    max_cameras: int = 1
+    synchronized: bool = False
+    in_process: bool = False
+    cost: int = 10
+
+
+@dataclass
+class StreamRequirements:
+    """
+    What a set of streams needs from an engine, the first stream is the leader
+    """
+    encode_type: StreamEncodeTypeEnum
+    stream_type: StreamTypeEnum
+    cameras: int = 1
+    # Followers are captured in lockstep with their leader
+    synchronized: bool = False
+
+    @staticmethod
+    def from_streams(streams: List[Stream]) -> 'StreamRequirements':
+        return StreamRequirements(
+            encode_type=streams[0].encode_type,
+            stream_type=streams[0].stream_type,
+            cameras=len(streams),
+            synchronized=len(streams) > 1,
+        )
+
+    def unmet_by(self, capabilities: EngineCapabilities) -> Optional[str]:
+        """
+        Get why an engine with these capabilities cannot run the streams, None if it can
+        """
+        if self.encode_type not in capabilities.encode_types:
+            return f"does not support {self.encode_type.value}"
+        if self.stream_type not in capabilities.stream_types:
+            return f"does not support {self.stream_type.value} streams"
+        if not capabilities.min_cameras <= self.cameras <= capabilities.max_cameras:
+            return f"does not support {self.cameras} camera(s)"
+        if self.synchronized and not capabilities.synchronized:
+            return "does not synchronize cameras"
+        return None
+
+
+class EngineRegistry:
+    """
+    Engines register themselves with the register decorator, and declare their CAPABILITIES
+    """
+
+    _engines: Dict[str, Type['BaseStreamEngine']] = {}
+
+    @classmethod
+    def register(cls, engine: Type['BaseStreamEngine']) -> Type['BaseStreamEngine']:
+        cls._engines[engine.__name__] = engine
+        return engine
+
+    @classmethod
+    def get(cls, name: str) -> Optional[Type['BaseStreamEngine']]:
+        return cls._engines.get(name)
+
+    @classmethod
+    def list_engines(cls) -> List[EngineInfoModel]:
+        return [
+            EngineInfoModel(
+                name=name,
+                encode_types=sorted(engine.CAPABILITIES.encode_types),
+                stream_types=sorted(engine.CAPABILITIES.stream_types),
+                min_cameras=engine.CAPABILITIES.min_cameras,
+                max_cameras=engine.CAPABILITIES.max_cameras,
+                synchronized=engine.CAPABILITIES.synchronized,
+                in_process=engine.CAPABILITIES.in_process,
+                cost=engine.CAPABILITIES.cost,
+                available=engine.is_available(),
+            )
+            for (name, engine) in cls._engines.items()
+        ]
+
+    @classmethod
+    def select(cls, streams: List[Stream], preferred: Optional[str] = None) -> Type['BaseStreamEngine']:
+        """
+        Get the engine to run the streams with
+
+        Without a preference, the cheapest available engine that can run the streams is used.
+        A preferred engine may run followers without synchronizing them, since the user asked for it.
+        Raises NoSuitableEngineException if there is no suitable engine, or the preferred one cannot run the streams.
+        """
+        requirements = StreamRequirements.from_streams(streams)
+
+        if preferred:
+            engine = cls._engines.get(preferred)
+            requirements.synchronized = False
+            reason = "is not registered" if not engine else (
+                "is not available" if not engine.is_available() else requirements.unmet_by(engine.CAPABILITIES))
+            if reason is None:
+                return engine
+            raise NoSuitableEngineException(f"{preferred} {reason}")
+
+        candidates = [engine for engine in cls._engines.values()
+                      if engine.is_available() and requirements.unmet_by(engine.CAPABILITIES) is None]
+        if len(candidates) == 0:
+            raise NoSuitableEngineException(
+                f"No engine supports {requirements.cameras} camera(s) of {requirements.encode_type.value} over {requirements.stream_type.value}")
+        return min(candidates, key=lambda engine: engine.CAPABILITIES.cost)
@@ -0,0 +1,163 @@
+"""
+frame_tap.py
+
+Gives consumers such as the browser preview access to the latest captured frames of a running stream
+One tap exists per capture and is shared by every consumer, the source is only attached while someone is subscribed
+In-process captures only publish while the tap is in use. The gst-launch engine's branch runs regardless, only its
+socket is read on demand.
+"""
+
+import socket
+import threading
+import time
+import logging
+from typing import Callable, List, Optional, Tuple
+
+from ..synchronized_camera import CopiedFrame
+from .. import v4l2
+
+
+class FrameTap:
+    """
+    Holds the most recent frame set (one frame per camera) published by a capture
+
+    The first subscriber calls on_attach and the last one to unsubscribe calls on_detach, so readers (and in-process
+    captures) only do the extra work while the tap is in use.
+    """
+
+    def __init__(self, on_attach: Optional[Callable[[], None]] = None, on_detach: Optional[Callable[[], None]] = None) -> None:
+        self._on_attach = on_attach
+        self._on_detach = on_detach
+        self._cond = threading.Condition()
+        self._frames: Optional[List[CopiedFrame]] = None
+        self._index = 0
+        self._subscribers = 0
+
+    @property
+    def active(self) -> bool:
+        return self._subscribers > 0
+
+    def subscribe(self):
+        with self._cond:
+            self._subscribers += 1
+            first = self._subscribers == 1
+        if first and self._on_attach:
+            self._on_attach()
+
+    def unsubscribe(self):
+        with self._cond:
+            self._subscribers = max(self._subscribers - 1, 0)
+            last = self._subscribers == 0
+            if last:
+                self._frames = None
+        if last and self._on_detach:
+            self._on_detach()
+
+    def publish(self, frames: List[CopiedFrame]):
+        with self._cond:
+            self._frames = frames
+            self._index += 1
+            self._cond.notify_all()
+
+    def latest(self) -> Tuple[int, Optional[List[CopiedFrame]]]:
+        with self._cond:
+            return (self._index, self._frames)
+
+    def wait_for_frame(self, after_index: int, timeout: float) -> Tuple[int, Optional[List[CopiedFrame]]]:
+        """
+        Block until a frame newer than after_index is published, returns (index, None) on timeout
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._index > after_index and self._frames is not None, timeout)
+            if self._index > after_index and self._frames is not None:
+                return (self._index, self._frames)
+            return (self._index, None)
+
+
+class MultipartTapReader:
+    """
+    Reads JPEG frames from the multipartmux ! tcpserversink branch of a gst-launch pipeline and publishes them to a tap
+    """
+
+    BOUNDARY = "dweframe"
+    RECV_SIZE = 65536
+
+    def __init__(self, tap: FrameTap, port: int, width: int, height: int) -> None:
+        self.tap = tap
+        self.port = port
+        self.width = width
+        self.height = height
+        self.logger = logging.getLogger("dwe_os_2.cameras.MultipartTapReader")
+
+        self._socket: Optional[socket.socket] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def allocate_port() -> int:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.bind(("127.0.0.1", 0))
+            return s.getsockname()[1]
+
+    def attach(self):
+        try:
+            self._socket = socket.create_connection(("127.0.0.1", self.port), timeout=2)
+        except OSError as e:
+            self.logger.warning(f"Unable to attach to frame tap: {e}")
+            self._socket = None
+            return
+        self._socket.settimeout(None)
+        self._thread = threading.Thread(target=self._read_loop, args=(self._socket,), daemon=True)
+        self._thread.start()
+
+    def detach(self):
+        if self._socket:
+            try:
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._socket.close()
+            self._socket = None
+
+    def _read_loop(self, sock: socket.socket):
+        buffer = bytearray()
+        sequence = 0
+        try:
+            while True:
+                header_end = buffer.find(b"\r\n\r\n")
+                if header_end == -1:
+                    chunk = sock.recv(self.RECV_SIZE)
+                    if not chunk:
+                        return
+                    buffer += chunk
+                    continue
+
+                length = None
+                for line in bytes(buffer[:header_end]).split(b"\r\n"):
+                    if line.lower().startswith(b"content-length:"):
+                        length = int(line.split(b":")[1])
+                if length is None:
+                    # Not a frame header, resynchronize on the next one
+                    del buffer[:header_end + 4]
+                    continue
+
+                frame_end = header_end + 4 + length
+                while len(buffer) < frame_end:
+                    chunk = sock.recv(self.RECV_SIZE)
+                    if not chunk:
+                        return
+                    buffer += chunk
+
+                sequence += 1
+                self.tap.publish([CopiedFrame(
+                    data=bytes(buffer[header_end + 4:frame_end]),
+                    width=self.width,
+                    height=self.height,
+                    pixel_format=v4l2.V4L2_PIX_FMT_MJPEG,
+                    # Same clock as V4L2 buffer timestamps
+                    timestamp_us=time.monotonic_ns() // 1000,
+                    sequence=sequence,
+                )])
+                del buffer[:frame_end]
+        except OSError:
+            # Socket closed on detach or pipeline stopped
+            pass
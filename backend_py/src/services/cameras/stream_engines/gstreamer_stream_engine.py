@@ -1,13 +1,24 @@
 import os
+import re
+import time
+import collections
 from .stream import Stream
-from ..pydantic_schemas import StreamEncodeTypeEnum, StreamTypeEnum
+from ..pydantic_schemas import StreamEncodeTypeEnum, StreamTypeEnum, StreamErrorKindEnum, StreamEndpointModel
 import stat
 import subprocess
-from typing import Optional
+from typing import List, Optional
 import signal
 import threading
 from datetime import datetime
 from .base_stream_engine import BaseStreamEngine
+from .remux import remux_in_background
+from .encoders import H264EncoderRegistry
+from .frame_tap import FrameTap, MultipartTapReader
+from .instant_recorder import InstantRecorder
+from .engine_registry import EngineRegistry, EngineCapabilities
+from .stream_errors import classify_gstreamer_error
+from .io_modes import IoModeRegistry
+from .latency_profiles import get_latency_profile
 
 
 class GStreamerPipelineBuilder():
@@ -15,13 +26,77 @@ class GStreamerPipelineBuilder():
     Responsible for creation of GStreamer pipelines based on a Stream configuraiton
     """
 
+    # Chooses the encoder for software H.264, replaced with a disk-cached registry by the DeviceManager
+    encoder_registry = H264EncoderRegistry()
+
+    # Chooses the v4l2src io-mode of each device, shared so probe results outlive the engines
+    io_modes = IoModeRegistry()
+
+    # identity elements print every buffer with gst-launch -v, which the engine parses for stream stats
+    CAPTURE_STATS_NAME = "capstats"
+    SEND_STATS_NAME = "sendstats"
+    # tee of the encoded frames, branched to the instant recorder of streams opted in
+    RECORD_TEE_NAME = "rec"
+    # Encoded frames the recording branch holds while the recorder is busy
+    RECORD_QUEUE_TIME_NS = 2_000_000_000
+
+    @classmethod
+    def build(cls, stream: Stream, index: int = 0, with_stats: bool = False, tap_port: Optional[int] = None, io_mode: Optional[str] = None,
+              relay_ports: Optional[List[int]] = None, record_port: Optional[int] = None) -> str:
+        """
+        relay_ports are the local ports of the processes sending an SRT stream, one per endpoint
+        record_port is the local port the encoded frames are sent to for instant recordings
+        """
+        source = cls._build_source(stream, io_mode)
+        caps = GStreamerPipelineBuilder._construct_caps(stream)
+        payload = GStreamerPipelineBuilder._build_payload(
+            stream, index, with_stats, record_port is not None)
+        sink = GStreamerPipelineBuilder._build_sink(stream, relay_ports)
+        record = ""
+        if record_port is not None:
+            # gdppay keeps the timestamps and keyframe flags of the frames, so the recorder can start a file at a keyframe
+            # The recorder only connects while recording, until then tcpserversink drops the frames
+            record = f" {cls.RECORD_TEE_NAME}{index}. ! queue leaky=downstream max-size-buffers=0 max-size-bytes=0 max-size-time={cls.RECORD_QUEUE_TIME_NS} ! gdppay crc-header=false ! tcpserversink host=127.0.0.1 port={record_port} sync=false"
+        if tap_port is None or not GStreamerPipelineBuilder.has_jpeg_source(stream):
+            return f"{source} ! {caps} ! {payload} ! {sink}{record}"
+
+        # Branch the camera's JPEG frames, untouched, to a local socket for previews and snapshots
+        # gst-launch cannot add the branch on demand, so it runs while nobody is connected: per frame, the tee pushes a
+        # reference (no copy), the queue hands it to the branch's thread, multipartmux prepends a small header and
+        # tcpserversink drops it. The leaky queue keeps a slow reader from stalling the stream.
+        tap = f"tap{index}"
+        return f"{source} ! {caps} ! tee name={tap} ! {payload} ! {sink} {tap}. ! queue leaky=downstream max-size-buffers=1 ! multipartmux boundary={MultipartTapReader.BOUNDARY} ! tcpserversink host=127.0.0.1 port={tap_port} sync=false{record}"
+
     @classmethod
-    def build(cls, stream: Stream) -> str:
+    def build_instant_recorder(cls, stream: Stream, path: str) -> str:
+        """
+        Pipeline writing the GDP stream of the recording branch, read from stdin, to a file
+        """
+        parse = "" if stream.encode_type == StreamEncodeTypeEnum.MJPG else "h264parse ! "
+        return f"fdsrc fd=0 ! gdpdepay ! {parse}queue ! {cls._build_muxer(stream)} ! filesink location={path}"
+
+    @staticmethod
+    def has_jpeg_source(stream: Stream) -> bool:
+        return stream.encode_type in [StreamEncodeTypeEnum.MJPG, StreamEncodeTypeEnum.SOFTWARE_H264]
+
+    @classmethod
+    def build_rtsp(cls, stream: Stream) -> str:
+        """
+        Launch line for a gst-rtsp-server media factory, which requires the payloader to be named pay0
+        """
         source = cls._build_source(stream)
         caps = GStreamerPipelineBuilder._construct_caps(stream)
-        payload = GStreamerPipelineBuilder._build_payload(stream)
-        sink = GStreamerPipelineBuilder._build_sink(stream)
-        return f"{source} ! {caps} ! {payload} ! {sink}"
+        encode = GStreamerPipelineBuilder._build_encode(stream)
+        match stream.encode_type:
+            case StreamEncodeTypeEnum.MJPG:
+                payload = "rtpjpegpay name=pay0 pt=26"
+            case _:
+                # Send SPS/PPS with every keyframe, so clients can join at any time
+                payload = "rtph264pay name=pay0 pt=96 config-interval=-1"
+        payload += f" mtu={get_latency_profile(stream.latency_profile).mtu}"
+        parts = [source, caps, encode,
+                 GStreamerPipelineBuilder._build_queue(stream, encoded=stream.encode_type != StreamEncodeTypeEnum.MJPG), payload]
+        return f"( {' ! '.join([part for part in parts if part])} )"
 
     @staticmethod
     def _get_format(stream: Stream):
@@ -35,80 +110,246 @@ class GStreamerPipelineBuilder():
             case _:
                 return ""
 
+    @classmethod
+    def _build_source(cls, stream: Stream, io_mode: Optional[str] = None):
+        if io_mode is None:
+            io_mode = cls.select_io_mode(stream)
+        return f"v4l2src device={stream.device_path} io-mode={io_mode}"
+
+    @classmethod
+    def select_io_mode(cls, stream: Stream) -> str:
+        """
+        Get the cheapest io-mode that works for the stream's device and caps, probes the device the first time
+        """
+        return cls.io_modes.select(stream.device_path, cls._construct_caps(stream))
+
     @staticmethod
-    def _build_source(stream: Stream):
-        return f"v4l2src device={stream.device_path}"
+    def _build_queue(stream: Stream, encoded: bool = False):
+        """
+        encoded is True for a queue of H.264 access units, which never leaks: a dropped P-frame corrupts the picture
+        until the next IDR, which may be many seconds away. It blocks upstream when full instead.
+        """
+        if stream.stream_type == StreamTypeEnum.RECORDING:
+            # Recordings keep every frame
+            return "queue"
+        profile = get_latency_profile(stream.latency_profile)
+        # A leaky queue drops the oldest frames when its consumer stalls, rather than building up latency
+        leaky = " leaky=downstream" if profile.queue_leaky and not encoded else ""
+        return f"queue{leaky} max-size-buffers={profile.queue_buffers} max-size-bytes=0 max-size-time=0"
 
     @staticmethod
     def _construct_caps(stream: Stream):
         return f"{GStreamerPipelineBuilder._get_format(stream)},width={stream.width},height={stream.height},framerate={stream.interval.denominator}/{stream.interval.numerator}"
 
     @staticmethod
-    def _build_payload(stream: Stream):
+    def _build_payload(stream: Stream, index: int = 0, with_stats: bool = False, with_record_tee: bool = False):
+        parts = []
+        if with_stats:
+            parts.append(
+                f"identity name={GStreamerPipelineBuilder.CAPTURE_STATS_NAME}{index} silent=false")
+        parts.append(GStreamerPipelineBuilder._build_encode(stream))
+        if with_stats:
+            parts.append(
+                f"identity name={GStreamerPipelineBuilder.SEND_STATS_NAME}{index} silent=false")
+        if with_record_tee:
+            parts.append(
+                f"tee name={GStreamerPipelineBuilder.RECORD_TEE_NAME}{index}")
+        parts.append(GStreamerPipelineBuilder._build_mux(stream))
+        return " ! ".join([part for part in parts if part])
+
+    @staticmethod
+    def _build_encode(stream: Stream):
+        match stream.encode_type:
+            case StreamEncodeTypeEnum.H264:
+                if stream.stream_type == StreamTypeEnum.RECORDING:
+                    return f"h264parse ! video/x-h264,width={stream.width},height={stream.height},framerate={stream.interval.denominator}/{stream.interval.numerator}"
+                elif stream.stream_type == StreamTypeEnum.SRT:
+                    # SPS/PPS before every keyframe, so a receiver can join (or rejoin) the transport stream at any keyframe
+                    return "h264parse config-interval=-1"
+                else:
+                    return "h264parse"
+            case StreamEncodeTypeEnum.MJPG:
+                return ""
+            case StreamEncodeTypeEnum.SOFTWARE_H264:
+                if stream.stream_type == StreamTypeEnum.RECORDING:
+                    return f"jpegdec ! queue ! {GStreamerPipelineBuilder._build_encoder(stream, False)} ! h264parse ! video/x-h264,width={stream.width},height={stream.height},framerate={stream.interval.denominator}/{stream.interval.numerator}"
+                else:
+                    return f"jpegdec ! {GStreamerPipelineBuilder._build_queue(stream)} ! {GStreamerPipelineBuilder._build_encoder(stream, True)}"
+            case _:
+                return ""
+
+    @staticmethod
+    def _build_mux(stream: Stream):
+        if stream.stream_type == StreamTypeEnum.SRT:
+            # SRT carries MPEG-TS, alignment=7 packs 7 TS packets (1316 bytes) per buffer, which fits an SRT packet
+            # The queue never drops encoded frames ahead of the transport chosen so that no loss corrupts the GOP
+            match stream.encode_type:
+                case StreamEncodeTypeEnum.SOFTWARE_H264:
+                    return f"h264parse config-interval=-1 ! {GStreamerPipelineBuilder._build_queue(stream, encoded=True)} ! mpegtsmux alignment=7"
+                case _:
+                    return f"{GStreamerPipelineBuilder._build_queue(stream, encoded=True)} ! mpegtsmux alignment=7"
+
+        mtu = get_latency_profile(stream.latency_profile).mtu
+        # A fixed SSRC, so RTCP receiver reports can be matched to the stream
         match stream.encode_type:
             case StreamEncodeTypeEnum.H264:
                 if stream.stream_type == StreamTypeEnum.RECORDING:
-                    return f"h264parse ! video/x-h264,width={stream.width},height={stream.height},framerate={stream.interval.denominator}/{stream.interval.numerator} ! queue ! mp4mux"
+                    return f"queue ! {GStreamerPipelineBuilder._build_muxer(stream)}"
                 else:
-                    return "h264parse ! queue ! rtph264pay config-interval=10 pt=96"
+                    return f"{GStreamerPipelineBuilder._build_queue(stream, encoded=True)} ! rtph264pay config-interval=10 pt=96 mtu={mtu} ssrc={stream.ssrc}"
             case StreamEncodeTypeEnum.MJPG:
                 if stream.stream_type == StreamTypeEnum.RECORDING:
-                    return "queue ! avimux"
+                    return f"queue ! {GStreamerPipelineBuilder._build_muxer(stream)}"
                 else:
-                    return "rtpjpegpay"
+                    return f"rtpjpegpay mtu={mtu} ssrc={stream.ssrc}"
             case StreamEncodeTypeEnum.SOFTWARE_H264:
                 if stream.stream_type == StreamTypeEnum.RECORDING:
-                    return f"jpegdec ! queue ! x264enc byte-stream=false tune=zerolatency bitrate={stream.software_h264_bitrate} speed-preset=ultrafast ! h264parse ! video/x-h264,width={stream.width},height={stream.height},framerate={stream.interval.denominator}/{stream.interval.numerator} ! queue ! mp4mux"
+                    return f"queue ! {GStreamerPipelineBuilder._build_muxer(stream)}"
                 else:
-                    return f"jpegdec ! queue ! x264enc byte-stream=true tune=zerolatency bitrate={stream.software_h264_bitrate} speed-preset=ultrafast ! rtph264pay config-interval=10 pt=96"
+                    return f"rtph264pay config-interval=10 pt=96 mtu={mtu} ssrc={stream.ssrc}"
             case _:
                 return ""
 
-    def _build_sink(stream: Stream):
+    @classmethod
+    def _build_encoder(cls, stream: Stream, byte_stream: bool):
+        fps = stream.interval.denominator // stream.interval.numerator
+        encoder = cls.encoder_registry.select(
+            stream.width, stream.height, fps)
+        profile = get_latency_profile(stream.latency_profile)
+        return encoder.build(stream.software_h264_bitrate, byte_stream, profile, profile.key_int(fps))
+
+    @staticmethod
+    def _build_muxer(stream: Stream):
+        if stream.recording.fragmented:
+            # Fragmented MP4 keeps the file playable up to the last written fragment, even without EOS.
+            # streamable=true avoids seeking back to rewrite the header, so a clean stop and a power loss produce the same file
+            # mp4mux accepts MJPEG as well, so fragmented recordings are always MP4
+            return f"mp4mux fragment-duration={stream.recording.fragment_duration_ms} streamable=true"
+        match stream.encode_type:
+            case StreamEncodeTypeEnum.MJPG:
+                return "avimux"
+            case _:
+                return "mp4mux"
+
+    def _build_sink(stream: Stream, relay_ports: Optional[List[int]] = None):
         match stream.stream_type:
             case StreamTypeEnum.UDP:
-                if len(stream.endpoints) == 0:
-                    return "fakesink"
-                sink = "multiudpsink sync=true clients="
-                for endpoint, i in zip(stream.endpoints, range(len(stream.endpoints))):
-                    sink += f"{endpoint.host}:{endpoint.port}"
-                    if i < len(stream.endpoints) - 1:
-                        sink += ","
-
-                return sink
+                return GStreamerPipelineBuilder._build_udp_sink(stream, stream.endpoints)
+            case StreamTypeEnum.SRT:
+                # The transport stream goes to the local SRT senders
+                return GStreamerPipelineBuilder._build_udp_sink(
+                    stream, [StreamEndpointModel(host="127.0.0.1", port=port) for port in relay_ports or []])
             case StreamTypeEnum.RECORDING:
-                home_dir = os.getcwd()
-                video_dir = os.path.join(home_dir, "videos")
-                if not os.path.exists(video_dir):
-                    os.makedirs(video_dir)
-                permissions = stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH
-                os.chmod(video_dir, permissions)
-                extension = "avi" if stream.encode_type == StreamEncodeTypeEnum.MJPG else "mp4"
-                timestamp = datetime.now().strftime("%F-%T")
-                unique_filename = f"{stream.device_path.split('/')[-1]}_{timestamp}.{extension}"
-                unique_path = os.path.join(video_dir, unique_filename)
-                if os.path.exists(unique_path):
-                    unique_filename = f"{stream.device_path.split('/')[-1]}_{timestamp}_{os.getpid()}.{extension}"
-                unique_path = os.path.join(video_dir, unique_filename)
+                unique_path = GStreamerPipelineBuilder.recording_path(stream)
                 stream.file_path = unique_path
                 return f"filesink location={unique_path} sync=true"
             case _:
                 return ""
 
 
+    @staticmethod
+    def get_video_dir() -> str:
+        home_dir = os.getcwd()
+        video_dir = os.path.join(home_dir, "videos")
+        if not os.path.exists(video_dir):
+            os.makedirs(video_dir)
+        permissions = stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH
+        os.chmod(video_dir, permissions)
+        return video_dir
+
+    @staticmethod
+    def recording_path(stream: Stream) -> str:
+        """
+        Get a new file path in the video directory for a recording of the stream
+        """
+        video_dir = GStreamerPipelineBuilder.get_video_dir()
+        extension = "avi" if stream.encode_type == StreamEncodeTypeEnum.MJPG and not stream.recording.fragmented else "mp4"
+        timestamp = datetime.now().strftime("%F-%T")
+        base_filename = f"{stream.device_path.split('/')[-1]}_{timestamp}"
+        unique_path = os.path.join(video_dir, f"{base_filename}.{extension}")
+        # Several recordings may start within the same second
+        counter = 1
+        while os.path.exists(unique_path):
+            counter += 1
+            unique_path = os.path.join(
+                video_dir, f"{base_filename}_{counter}.{extension}")
+        return unique_path
+
+    def _build_udp_sink(stream: Stream, endpoints: List[StreamEndpointModel]):
+        if len(endpoints) == 0:
+            return "fakesink"
+        profile = get_latency_profile(stream.latency_profile)
+        sink = f"multiudpsink sync={'true' if profile.sink_sync else 'false'} "
+        if profile.send_buffer > 0:
+            sink += f"buffer-size={profile.send_buffer} "
+        sink += "clients="
+        for endpoint, i in zip(endpoints, range(len(endpoints))):
+            sink += f"{endpoint.host}:{endpoint.port}"
+            if i < len(endpoints) - 1:
+                sink += ","
+
+        return sink
+
+
+@EngineRegistry.register
 class GStreamerProcessEngine(BaseStreamEngine):
     """
     GStreamer stream Engine
     """
 
+    # Several cameras run side by side in one gst-launch, but they are not synchronized
+    CAPABILITIES = EngineCapabilities(
+        encode_types={StreamEncodeTypeEnum.MJPG, StreamEncodeTypeEnum.H264,
+                      StreamEncodeTypeEnum.SOFTWARE_H264},
+        stream_types={StreamTypeEnum.UDP, StreamTypeEnum.RECORDING},
+        max_cameras=4,
+        cost=20,
+    )
+
+    # mp4mux/avimux write their index at EOS, so we have to wait for it
+    EOS_TIMEOUT = 10
+    # Fragmented recordings are valid up to the last fragment, so EOS only flushes the tail
+    FRAGMENTED_EOS_TIMEOUT = 1
+
+    # Matches the per-buffer output of the stats identity elements, e.g.
+    # /GstPipeline:pipeline0/GstIdentity:capstats0: last-message = chain   ******* (capstats0:sink) (27856 bytes, dts: none, pts: 0:00:01.366666666, duration: ..., offset: 41, ...
+    # Every frame prints two such lines, parsed in about 1 µs each. Anchored on the fixed layout of the message, so
+    # nothing backtracks, and lines without the marker are skipped before the pattern runs.
+    STATS_MARKER = "last-message = chain"
+    STATS_PATTERN = re.compile(
+        rf"GstIdentity:({GStreamerPipelineBuilder.CAPTURE_STATS_NAME}|{GStreamerPipelineBuilder.SEND_STATS_NAME})(\d+): last-message = chain +\*+ \([^)]*\) \((\d+) bytes, dts: [^,]*, pts: ([^,]*), duration: [^,]*, offset: (-?\d+)")
+    # Frames that were captured but not sent after this many newer captures are counted as dropped
+    MAX_IN_FLIGHT = 30
+    # gst-launch names the sources v4l2src0, v4l2src1, ... in stream order
+    SOURCE_ERROR_PATTERN = re.compile(r"GstV4l2Src:v4l2src(\d+)")
+    # Live streams keep an idle recording branch, for the first stream only
+    RECORDABLE_STREAM_TYPES = {StreamTypeEnum.UDP, StreamTypeEnum.SRT}
+    DIAGNOSTICS = True
+    # Tracers of a diagnostics session: the latency of every element and of the whole pipeline, and the CPU load
+    DIAGNOSTICS_TRACERS = "latency(flags=pipeline+element);rusage"
+    DIAGNOSTICS_TRACE_FILE = "trace.log"
+
     def __init__(self, streams, error_callback):
         super().__init__(streams, error_callback)
 
         self._process: Optional[subprocess.Popen] = None
         self._error_thread: Optional[threading.thread] = None
+        self._stats_thread: Optional[threading.Thread] = None
         self._lock = threading.RLock()
         self.started = False
 
+        # io-mode of each stream's source, chosen when the pipeline is constructed
+        self._io_modes: List[str] = []
+
+        # Only the first stream is tapped, engines with several streams are synchronized ones
+        self._tap_reader: Optional[MultipartTapReader] = None
+        if GStreamerPipelineBuilder.has_jpeg_source(self.streams[0]):
+            self._tap_reader = MultipartTapReader(
+                None, MultipartTapReader.allocate_port(), self.streams[0].width, self.streams[0].height)
+            self.frame_tap = FrameTap(
+                self._tap_reader.attach, self._tap_reader.detach)
+            self._tap_reader.tap = self.frame_tap
+
     def start(self):
         with self._lock:
             self.logger.info(
@@ -119,19 +360,60 @@ class GStreamerProcessEngine(BaseStreamEngine):
             self._run_pipeline()
 
     def _run_pipeline(self):
+        self.recorder = None
+        if self.streams[0].stream_type in self.RECORDABLE_STREAM_TYPES and self.streams[0].recording.instant:
+            self.recorder = InstantRecorder(
+                self.streams[0], MultipartTapReader.allocate_port())
         pipeline_str = self._construct_pipeline()
         self.logger.info(pipeline_str)
         has_recording_stream = any(
             stream.stream_type == StreamTypeEnum.RECORDING for stream in self.streams)
+        # -v prints the stats identity output to stdout
+        args = ["gst-launch-1.0", "-v"]
+        if has_recording_stream:
+            args.append("-e")
         self._process = subprocess.Popen(
-            f"gst-launch-1.0 {'-e' if has_recording_stream else ''} {pipeline_str}".split(
-                " "),
-            stdout=subprocess.DEVNULL,
+            args + pipeline_str.split(" "),
+            stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             text=True,
+            # An undecodable byte would end the reading of stdout, and gst-launch blocks once the pipe is full
+            errors="replace",
+            env=self._diagnostics_env(),
         )
+        self.scheduler.apply_to_process(self.name, self._process.pid)
         self._error_thread = threading.Thread(target=self._monitor_stderr)
         self._error_thread.start()
+        self._stats_thread = threading.Thread(
+            target=self._monitor_stdout, args=(self._process,), daemon=True)
+        self._stats_thread.start()
+
+    def _diagnostics_env(self) -> Optional[dict]:
+        """
+        Environment tracing the pipeline into the diagnostics directory, None (inherited) unless a session is running
+        Tracers can only be set when GStreamer initializes, so they cost nothing otherwise
+        """
+        directory = next(
+            (stream.diagnostics_dir for stream in self.streams if stream.diagnostics_dir), None)
+        if not directory:
+            return None
+        return dict(
+            os.environ,
+            GST_TRACERS=self.DIAGNOSTICS_TRACERS,
+            GST_DEBUG="GST_TRACER:7",
+            GST_DEBUG_FILE=os.path.join(directory, self.DIAGNOSTICS_TRACE_FILE),
+            GST_DEBUG_NO_COLOR="1",
+            # gst-launch dumps the graph at every state change, the PAUSED_PLAYING one is negotiated
+            GST_DEBUG_DUMP_DOT_DIR=directory,
+        )
+
+    def process_ids(self) -> List[int]:
+        process = self._process
+        pids = [process.pid] if process else []
+        recorder = self.recorder
+        if recorder and recorder.process_id is not None:
+            pids.append(recorder.process_id)
+        return pids
 
     def stop(self):
         with self._lock:
@@ -141,19 +423,31 @@ class GStreamerProcessEngine(BaseStreamEngine):
             self.logger.info("Stopping stream")
             self.started = False
 
+            if self._tap_reader:
+                self._tap_reader.detach()
+            # Finalize an instant recording while its frames still come in
+            if self.recorder:
+                self.recorder.close()
+
             # For recording streams, send EOS to properly finalize the file
-            has_recording_stream = any(
-                stream.stream_type == StreamTypeEnum.RECORDING for stream in self.streams)
+            recording_streams = [
+                stream for stream in self.streams if stream.stream_type == StreamTypeEnum.RECORDING]
+            eos_timeout = self.FRAGMENTED_EOS_TIMEOUT if all(
+                stream.recording.fragmented for stream in recording_streams) else self.EOS_TIMEOUT
 
             try:
-                if has_recording_stream:
+                if len(recording_streams) > 0:
                     self._process.send_signal(signal.SIGINT)  # EOS signal
-                    self._process.wait(timeout=10)
+                    self._process.wait(timeout=eos_timeout)
                 else:
                     self._process.terminate()
                     self._process.wait(timeout=5)
             except subprocess.TimeoutExpired:
-                self.logger.warning("Shutdown timed out, force killing...")
+                if len(recording_streams) > 0 and eos_timeout == self.FRAGMENTED_EOS_TIMEOUT:
+                    self.logger.info(
+                        "EOS not reached in time, the fragmented recording is kept up to the last fragment")
+                else:
+                    self.logger.warning("Shutdown timed out, force killing...")
                 self._process.kill()
                 self._process.wait()
             except Exception as e:
@@ -162,18 +456,122 @@ class GStreamerProcessEngine(BaseStreamEngine):
             finally:
                 if self._process.stderr:
                     self._process.stderr.close()
+                if self._process.stdout:
+                    self._process.stdout.close()
                 self._process = None
 
+            for stream in recording_streams:
+                if stream.recording.fragmented and stream.recording.remux and stream.file_path:
+                    remux_in_background(stream.file_path)
+
+    def kill(self):
+        # No lock, stop() holds it while waiting for EOS
+        process = self._process
+        if process:
+            self.logger.warning("Killing GStreamer process")
+            process.kill()
+
     def _construct_pipeline(self) -> str:
-        parts = [GStreamerPipelineBuilder.build(s) for s in self.streams]
+        self._io_modes = [GStreamerPipelineBuilder.select_io_mode(
+            s) for s in self.streams]
+        parts = [GStreamerPipelineBuilder.build(s, i, with_stats=True, tap_port=self._tap_reader.port if self._tap_reader and i == 0 else None, io_mode=self._io_modes[i],
+                                                record_port=self.recorder.port if self.recorder and i == 0 else None)
+                 for i, s in enumerate(self.streams)]
         return " ".join(parts)
 
+    def _monitor_stdout(self, process: subprocess.Popen):
+        # stream index -> pts -> (capture count, capture time) of frames between the two stats elements
+        in_flight: dict[int, collections.OrderedDict[str, tuple[int, float]]] = {
+            i: collections.OrderedDict() for i in range(len(self.streams))}
+        captured = 0
+        capture_threads_scheduled = False
+        # Logged once, the stats keep failing the same way
+        failed = False
+        try:
+            for line in iter(process.stdout.readline, ""):
+                try:
+                    if self.STATS_MARKER not in line:
+                        continue
+                    match = self.STATS_PATTERN.search(line)
+                    if not match:
+                        continue
+
+                    (name, index, nbytes, pts, offset) = match.groups()
+                    index = int(index)
+                    now = time.monotonic()
+                    frames = in_flight[index]
+
+                    if name == GStreamerPipelineBuilder.CAPTURE_STATS_NAME:
+                        if not capture_threads_scheduled:
+                            # The capture threads exist once the first frame comes through
+                            self.scheduler.apply_to_process_capture_threads(
+                                self.name, process.pid)
+                            capture_threads_scheduled = True
+                        captured += 1
+                        self.stats.record_capture(
+                            timestamp_us=self._parse_clock_time_us(pts))
+                        # v4l2src sets the offset to the V4L2 sequence number, identity prints GST_BUFFER_OFFSET_NONE as -1
+                        if int(offset) >= 0:
+                            self.stats.record_sequence(index, int(offset))
+                        frames[pts] = (captured, now)
+                        if len(frames) > self.MAX_IN_FLIGHT:
+                            frames.popitem(last=False)
+                            self.stats.record_queue_drop()
+                        continue
+
+                    self.stats.record_send(int(nbytes))
+                    frame = frames.pop(pts, None)
+                    if frame is None:
+                        continue
+                    (count, captured_at) = frame
+                    # Anything captured before this frame that is still in flight was dropped along the way
+                    while len(frames) > 0 and next(iter(frames.values()))[0] < count:
+                        frames.popitem(last=False)
+                        self.stats.record_queue_drop()
+                    if self.streams[index].encode_type == StreamEncodeTypeEnum.SOFTWARE_H264:
+                        self.stats.record_encode_latency(
+                            (now - captured_at) * 1000)
+                except Exception as e:
+                    # gst-launch blocks once the pipe is full, a line that fails to parse must not stop the reading
+                    if not failed:
+                        self.logger.exception(f"Failed to parse the stream stats: {e}")
+                        failed = True
+        except (ValueError, OSError):
+            # stdout was closed on stop
+            pass
+
+    def _report_io_mode_failures(self, error_block: List[str]):
+        """
+        Skip the io-mode of the sources that failed, so the restarted stream falls back to the next one
+        """
+        indices = {int(match.group(1)) for line in error_block
+                   for match in self.SOURCE_ERROR_PATTERN.finditer(line)}
+        for index in indices:
+            if index < len(self._io_modes):
+                stream = self.streams[index]
+                GStreamerPipelineBuilder.io_modes.report_failure(
+                    stream.device_path, GStreamerPipelineBuilder._construct_caps(stream), self._io_modes[index])
+
+    @staticmethod
+    def _parse_clock_time_us(clock_time: str) -> Optional[int]:
+        """
+        Parse a GStreamer clock time (h:mm:ss.nnnnnnnnn) into microseconds, None if unset
+        """
+        try:
+            (hours, minutes, seconds) = clock_time.split(":")
+            return (int(hours) * 3600 + int(minutes) * 60) * 1_000_000 + int(float(seconds) * 1_000_000)
+        except ValueError:
+            return None
+
     def _monitor_stderr(self):
         error_block = []
         try:
             for stderr_line in iter(self._process.stderr.readline, ""):
                 line_stripped = stderr_line.strip()
 
+                if "error sending" in line_stripped.lower():
+                    self.stats.record_send_error()
+
                 # Log all stderr output but only stop on actual errors
                 if any(error_keyword in line_stripped.lower() for error_keyword in ['error', 'failed', 'warning', 'critical']):
                     error_block.append(line_stripped)
@@ -191,10 +589,20 @@ class GStreamerProcessEngine(BaseStreamEngine):
                 for error in error_block:
                     self.logger.error(error)
 
+                # Bus errors are printed to stderr by gst-launch, along with the system error
+                kind = classify_gstreamer_error(error_block)
+                if kind == StreamErrorKindEnum.NEGOTIATION:
+                    self._report_io_mode_failures(error_block)
+
                 # Construct error message
                 error_msg = f"Process exited with code {return_code}."
+                if kind != StreamErrorKindEnum.UNKNOWN:
+                    error_msg += f" ({kind.value.lower().replace('_', ' ')} error)"
+
+                self.emit_error(error_msg, kind)
 
-                self.emit_error(error_msg)
+                if self.recorder:
+                    self.recorder.close()
 
                 # Reset state
                 with self._lock:
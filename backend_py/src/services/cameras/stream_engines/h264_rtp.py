@@ -0,0 +1,90 @@
+"""
+h264_rtp.py
+
+RTP packetization of H.264 access units (RFC 6184), as captured from the cameras' hardware H.264 nodes
+NAL units that fit the MTU are sent as single NAL unit packets, larger ones are split into FU-A fragments
+"""
+
+from typing import List
+
+from rtp import RTP, PayloadType
+
+NAL_TYPE_IDR = 5
+NAL_TYPE_FU_A = 28
+
+# RTP clock rate of H.264 video
+CLOCK_RATE = 90000
+
+
+def split_nal_units(access_unit: bytes) -> List[bytes]:
+    """
+    Split an Annex B access unit into its NAL units, without start codes
+    """
+    nal_units = []
+    start = access_unit.find(b"\x00\x00\x01")
+    while start >= 0:
+        start += 3
+        # A four byte start code (00 00 00 01) leaves a zero at the end of the previous NAL unit, which is stripped
+        end = access_unit.find(b"\x00\x00\x01", start)
+        nal = access_unit[start:end].rstrip(b"\x00") if end >= 0 else access_unit[start:]
+        if len(nal) > 0:
+            nal_units.append(nal)
+        start = end
+    return nal_units
+
+
+def is_keyframe(access_unit: bytes) -> bool:
+    return any(nal[0] & 0x1F == NAL_TYPE_IDR for nal in split_nal_units(access_unit))
+
+
+def timestamp_to_rtp(timestamp_us: int) -> int:
+    return (timestamp_us * CLOCK_RATE // 1_000_000) & 0xFFFFFFFF
+
+
+class H264RtpPacketizer:
+    """
+    Packetizes the access units of one camera, keeping its RTP sequence numbers continuous
+    """
+
+    def __init__(self, ssrc: int, mtu: int = 1400) -> None:
+        self.ssrc = ssrc
+        self.mtu = mtu
+        self.sequence_number = 0
+
+    def packetize(self, access_unit: bytes, timestamp: int) -> List[bytes]:
+        """
+        Get the RTP packets of an access unit, the marker bit is set on the last one
+        """
+        payloads: List[bytes] = []
+        for nal in split_nal_units(access_unit):
+            if len(nal) <= self.mtu:
+                payloads.append(nal)
+                continue
+
+            # FU-A: the NAL header is replaced by an indicator (NRI + type 28) and a header (S/E bits + NAL type)
+            indicator = (nal[0] & 0xE0) | NAL_TYPE_FU_A
+            nal_type = nal[0] & 0x1F
+            data = nal[1:]
+            chunk_size = self.mtu - 2
+            for offset in range(0, len(data), chunk_size):
+                header = nal_type
+                if offset == 0:
+                    header |= 0x80
+                if offset + chunk_size >= len(data):
+                    header |= 0x40
+                payloads.append(
+                    bytes([indicator, header]) + data[offset:offset + chunk_size])
+
+        packets = []
+        for (i, payload) in enumerate(payloads):
+            packets.append(bytes(RTP(
+                version=2,
+                marker=i == len(payloads) - 1,
+                payloadType=PayloadType.DYNAMIC_96,
+                sequenceNumber=self.sequence_number,
+                timestamp=timestamp,
+                ssrc=self.ssrc,
+                payload=bytearray(payload),
+            )))
+            self.sequence_number = (self.sequence_number + 1) & 0xFFFF
+        return packets
@@ -0,0 +1,282 @@
+"""
+instant_recorder.py
+
+Records a running stream on request, without starting a new pipeline
+Streams opted in (recording.instant) branch their encoded frames to a local socket, serialized with gdppay so their
+timestamps and keyframe flags survive. Nobody is connected while idle, so tcpserversink drops the frames without them
+leaving the pipeline. A recording connects, spawns its muxer, and starts writing at the stream's next keyframe (every
+frame for MJPEG). gdppay sends the caps and segment as stream headers, which tcpserversink sends every new client first.
+"""
+
+import logging
+import os
+import socket
+import struct
+import subprocess
+import threading
+import time
+from typing import Optional
+
+from .stream import Stream
+from ..pydantic_schemas import InstantRecordingModel
+
+# GStreamer data protocol (gdppay) packet header, all fields big endian
+GDP_HEADER_LENGTH = 62
+GDP_PAYLOAD_TYPE_OFFSET = 4
+GDP_PAYLOAD_LENGTH_OFFSET = 6
+GDP_PTS_OFFSET = 10
+GDP_FLAGS_OFFSET = 42
+GDP_DTS_OFFSET = 44
+# Other payload types are caps and events, which describe the buffers that follow
+GDP_PAYLOAD_BUFFER = 1
+GST_BUFFER_FLAG_DELTA_UNIT = 1 << 13
+GST_CLOCK_TIME_NONE = 2 ** 64 - 1
+
+
+class InstantRecorder:
+    """
+    Recording branch of one stream, connected to only while recording
+    """
+
+    CONNECT_RETRY = 0.5
+    RECV_SIZE = 65536
+    # Longest wait for the first keyframe, connecting included
+    START_TIMEOUT = 5
+    # mp4mux/avimux write their index at EOS
+    EOS_TIMEOUT = 10
+
+    def __init__(self, stream: Stream, port: int) -> None:
+        self.stream = stream
+        self.port = port
+        self.logger = logging.getLogger("dwe_os_2.cameras.InstantRecorder")
+
+        self._lock = threading.Lock()
+        self._first_frame = threading.Condition(self._lock)
+        self._closed = False
+        self._socket: Optional[socket.socket] = None
+
+        # Muxer of the running recording
+        self._muxer: Optional[subprocess.Popen] = None
+        self._muxer_path: Optional[str] = None
+        self._recording: Optional[InstantRecordingModel] = None
+        self._requested_at: Optional[float] = None
+        # Timestamp (DTS, or PTS if unset) of the first recorded frame, recordings start at 0
+        self._base_ts: Optional[int] = None
+
+    @property
+    def process_id(self) -> Optional[int]:
+        """
+        Muxer of the running recording
+        """
+        muxer = self._muxer
+        return muxer.pid if muxer else None
+
+    def start(self) -> InstantRecordingModel:
+        """
+        Record from the next keyframe, blocks until the first frame is written or START_TIMEOUT
+        """
+        with self._lock:
+            if self._recording and self._recording.recording:
+                return self._recording.model_copy()
+            if self._closed:
+                raise RuntimeError("The stream is not running")
+
+            self._requested_at = time.monotonic()
+            sock = self._connect(self._requested_at + self.START_TIMEOUT)
+            if not sock:
+                raise RuntimeError("The stream's recording branch is not reachable")
+            self._muxer_path = self._claim_path()
+            self._spawn_muxer()
+            self._base_ts = None
+            self._recording = InstantRecordingModel(
+                bus_info=self.stream.bus_info, file_path=self._muxer_path, requested_at=time.time(), recording=True)
+            self._socket = sock
+            threading.Thread(target=self._read_loop, args=(sock,), daemon=True).start()
+
+            self._first_frame.wait_for(
+                lambda: self._base_ts is not None or not self._recording.recording,
+                max(self._requested_at + self.START_TIMEOUT - time.monotonic(), 0))
+            if self._base_ts is None:
+                self.logger.warning(
+                    f"{self.stream.device_path}: No keyframe within {self.START_TIMEOUT} seconds, the recording starts at the next one")
+            return self._recording.model_copy()
+
+    def stop(self) -> Optional[InstantRecordingModel]:
+        """
+        Finalize the recording and disconnect from the stream
+        """
+        with self._lock:
+            recording = self._recording
+            if recording and recording.recording:
+                self._finish_recording()
+            return recording.model_copy() if recording else None
+
+    def close(self):
+        """
+        Called when the stream's pipeline stops, finalizes a running recording
+        """
+        with self._lock:
+            self._closed = True
+            if self._recording and self._recording.recording:
+                self._finish_recording()
+
+    def _unique_path(self) -> str:
+        # Imported here, the engine module imports this one
+        from .gstreamer_stream_engine import GStreamerPipelineBuilder
+        return GStreamerPipelineBuilder.recording_path(self.stream)
+
+    def _claim_path(self) -> str:
+        """
+        Create the file of a new recording, never replacing an existing file
+        filesink then truncates the empty file it is given
+        """
+        while True:
+            path = self._unique_path()
+            try:
+                # Fails if the name was taken since it was picked
+                with open(path, "xb"):
+                    return path
+            except FileExistsError:
+                continue
+
+    def _spawn_muxer(self):
+        from .gstreamer_stream_engine import GStreamerPipelineBuilder
+        pipeline = GStreamerPipelineBuilder.build_instant_recorder(
+            self.stream, self._muxer_path)
+        # Unbuffered, frames reach the muxer as they arrive
+        self._muxer = subprocess.Popen(
+            ["gst-launch-1.0", "-q", *pipeline.split(" ")],
+            bufsize=0,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def _finish_recording(self):
+        """
+        Disconnect, close the muxer's input, which ends its stream, and wait for it to write the index
+        """
+        self._disconnect()
+        muxer = self._muxer
+        self._muxer = None
+        self._recording.recording = False
+        self._first_frame.notify_all()
+        if muxer:
+            try:
+                muxer.stdin.close()
+            except OSError:
+                pass
+            try:
+                muxer.wait(timeout=self.EOS_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.logger.warning(
+                    f"{self._muxer_path}: EOS not reached in time, killing the muxer")
+                muxer.kill()
+                muxer.wait()
+        if self._base_ts is None:
+            # Not a single frame was written
+            self._remove(self._muxer_path)
+        self.logger.info(f"Recording finished: {self._muxer_path}")
+
+    @staticmethod
+    def _remove(path: Optional[str]):
+        if path and os.path.exists(path):
+            os.remove(path)
+
+    def _connect(self, deadline: float) -> Optional[socket.socket]:
+        # The pipeline opens the socket once it is playing
+        while not self._closed and time.monotonic() < deadline:
+            try:
+                sock = socket.create_connection(
+                    ("127.0.0.1", self.port), timeout=2)
+                sock.settimeout(None)
+                return sock
+            except OSError:
+                time.sleep(self.CONNECT_RETRY)
+        return None
+
+    def _disconnect(self):
+        # tcpserversink drops the frames again once its last client is gone
+        if self._socket:
+            try:
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._socket.close()
+            self._socket = None
+
+    def _read_loop(self, sock: socket.socket):
+        buffer = bytearray()
+        try:
+            while True:
+                while len(buffer) < GDP_HEADER_LENGTH:
+                    chunk = sock.recv(self.RECV_SIZE)
+                    if not chunk:
+                        return
+                    buffer += chunk
+                (payload_type,) = struct.unpack_from(
+                    ">H", buffer, GDP_PAYLOAD_TYPE_OFFSET)
+                (payload_length,) = struct.unpack_from(
+                    ">I", buffer, GDP_PAYLOAD_LENGTH_OFFSET)
+                packet_end = GDP_HEADER_LENGTH + payload_length
+                while len(buffer) < packet_end:
+                    chunk = sock.recv(self.RECV_SIZE)
+                    if not chunk:
+                        return
+                    buffer += chunk
+
+                packet = buffer[:packet_end]
+                del buffer[:packet_end]
+                self._on_packet(sock, payload_type, packet)
+        except OSError:
+            # Disconnected on stop() or pipeline stopped
+            pass
+
+    def _on_packet(self, sock: socket.socket, payload_type: int, packet: bytearray):
+        with self._lock:
+            # A packet read before a stop(), from the connection of a previous recording
+            if sock is not self._socket or not (self._recording and self._recording.recording):
+                return
+            if payload_type != GDP_PAYLOAD_BUFFER:
+                # The stream headers, then any caps or event change
+                self._write(packet)
+                return
+
+            if self._base_ts is None:
+                (flags,) = struct.unpack_from(">H", packet, GDP_FLAGS_OFFSET)
+                if flags & GST_BUFFER_FLAG_DELTA_UNIT:
+                    return
+                (pts, dts) = (self._read_ts(packet, GDP_PTS_OFFSET),
+                              self._read_ts(packet, GDP_DTS_OFFSET))
+                self._base_ts = dts if dts is not None else (pts or 0)
+                self._recording.start_latency_ms = round(
+                    (time.monotonic() - self._requested_at) * 1000, 1)
+                self.logger.info(
+                    f"Recording {self._recording.file_path}, first frame {self._recording.start_latency_ms} ms after the request")
+                self._first_frame.notify_all()
+
+            # Recordings start at 0, as if the stream had started with them
+            for offset in (GDP_PTS_OFFSET, GDP_DTS_OFFSET):
+                ts = self._read_ts(packet, offset)
+                if ts is not None:
+                    struct.pack_into(">Q", packet, offset,
+                                     max(ts - self._base_ts, 0))
+            self._write(packet)
+
+    @staticmethod
+    def _read_ts(packet: bytearray, offset: int) -> Optional[int]:
+        (ts,) = struct.unpack_from(">Q", packet, offset)
+        return None if ts == GST_CLOCK_TIME_NONE else ts
+
+    def _write(self, packet: bytes):
+        if not self._muxer:
+            return
+        try:
+            self._muxer.stdin.write(packet)
+        except (BrokenPipeError, ValueError):
+            self.logger.error(
+                f"{self._muxer_path}: The muxer exited, recording stopped")
+            self._recording.recording = False
+            self._muxer = None
+            self._disconnect()
+            self._first_frame.notify_all()
@@ -0,0 +1,145 @@
+"""
+io_modes.py
+
+Chooses the v4l2src io-mode (how capture buffers are shared with the rest of the pipeline) per device and format
+DMABUF exports the driver's buffers so downstream elements use them without a copy, MMAP maps them into the process,
+and USERPTR lets GStreamer allocate them. Not every driver supports every mode, so modes are probed before first use,
+and a mode that fails to negotiate (at probe time or at runtime) is skipped from then on. Other failures, such as the
+node still being released or the USB bandwidth being taken, say nothing about the mode and are not remembered.
+"""
+
+import logging
+import subprocess
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+from .stream_errors import classify_gstreamer_error
+from ..pydantic_schemas import StreamErrorKindEnum
+
+# Cheapest first
+IO_MODES: List[str] = ["dmabuf", "mmap", "userptr"]
+# Lets v4l2src decide, used when every other mode failed
+DEFAULT_IO_MODE = "auto"
+
+
+class IoModeRegistry:
+    """
+    Remembers which io-modes work for each device and caps
+
+    Probes run gst-launch against the device, so they must happen while the device is not streaming,
+    i.e. right before a pipeline starts.
+    """
+
+    # Buffers captured to consider a mode working
+    PROBE_BUFFERS = 5
+    PROBE_TIMEOUT = 5
+    # Starts on the working mode before the cheaper modes that were unavailable (e.g. busy) are probed again
+    RETRY_AFTER_STARTS = 10
+
+    def __init__(self) -> None:
+        self.logger = logging.getLogger("dwe_os_2.cameras.IoModeRegistry")
+        self._lock = threading.Lock()
+        # (device path, caps) -> modes known to work / fail
+        self._working: Dict[Tuple[str, str], str] = {}
+        self._failed: Dict[Tuple[str, str], Set[str]] = {}
+        # (device path, caps) -> (cheaper modes to probe again, starts left until then)
+        self._retry: Dict[Tuple[str, str], Tuple[List[str], int]] = {}
+
+    def select(self, device_path: str, caps: str) -> str:
+        """
+        Get the cheapest io-mode that works for the device and caps, probing the untried ones in order
+        Cheaper modes whose probe was inconclusive are probed again every RETRY_AFTER_STARTS starts, not on every start
+        """
+        key = (device_path, caps)
+        with self._lock:
+            working = self._working.get(key)
+            (retry, starts) = self._retry.get(key, ([], 0))
+            if working is not None and (len(retry) == 0 or starts > 1):
+                if len(retry) > 0:
+                    self._retry[key] = (retry, starts - 1)
+                return working
+            self._retry.pop(key, None)
+            failed = set(self._failed.get(key, set()))
+
+        candidates = retry if working is not None else [
+            mode for mode in IO_MODES if mode not in failed]
+        unsupported: List[str] = []
+        inconclusive: List[str] = []
+        for mode in candidates:
+            works = self._probe(device_path, caps, mode)
+            if works:
+                self._remember(key, mode, unsupported, inconclusive)
+                message = f"{device_path}: Using io-mode {mode}, {', '.join(unsupported) or 'no mode'} unsupported"
+                if len(inconclusive) > 0:
+                    message += f", {', '.join(inconclusive)} unavailable for now"
+                self.logger.info(message)
+                return mode
+            if works is None:
+                inconclusive.append(mode)
+            else:
+                unsupported.append(mode)
+
+        if working is not None:
+            # The cheaper modes are still unavailable, keep the one known to work
+            self._remember(key, working, unsupported, inconclusive)
+            return working
+
+        # Nothing was remembered, since the device may just have been busy
+        self.logger.warning(
+            f"{device_path}: No io-mode could be probed, letting v4l2src decide")
+        return DEFAULT_IO_MODE
+
+    def _remember(self, key: Tuple[str, str], mode: str, unsupported: List[str], inconclusive: List[str]):
+        with self._lock:
+            self._working[key] = mode
+            self._failed.setdefault(key, set()).update(unsupported)
+            if len(inconclusive) > 0:
+                # Cheaper than the working mode, worth another probe later
+                self._retry[key] = (inconclusive, self.RETRY_AFTER_STARTS)
+
+    def report_failure(self, device_path: str, caps: str, mode: str):
+        """
+        Skip a mode that failed to negotiate in a running pipeline, the next start uses the next mode
+        """
+        if mode == DEFAULT_IO_MODE:
+            return
+        key = (device_path, caps)
+        with self._lock:
+            if self._working.get(key) == mode:
+                del self._working[key]
+            self._failed.setdefault(key, set()).add(mode)
+        self.logger.warning(
+            f"{device_path}: io-mode {mode} failed, falling back")
+
+    def forget(self, device_path: str):
+        """
+        Probe again next time, e.g. after the device was replugged
+        """
+        with self._lock:
+            for key in [key for key in self._working if key[0] == device_path]:
+                del self._working[key]
+            for key in [key for key in self._failed if key[0] == device_path]:
+                del self._failed[key]
+            for key in [key for key in self._retry if key[0] == device_path]:
+                del self._retry[key]
+
+    def _probe(self, device_path: str, caps: str, mode: str) -> Optional[bool]:
+        """
+        Returns True if the mode works, False if it failed to negotiate, None if it failed for another reason
+        """
+        pipeline = f"v4l2src device={device_path} io-mode={mode} num-buffers={self.PROBE_BUFFERS} ! {caps} ! fakesink sync=false"
+        try:
+            result = subprocess.run(
+                ["gst-launch-1.0", "-q", *pipeline.split(" ")],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                timeout=self.PROBE_TIMEOUT,
+            )
+        except (subprocess.TimeoutExpired, FileNotFoundError):
+            return None
+        if result.returncode == 0:
+            return True
+        if classify_gstreamer_error(result.stdout.splitlines()) == StreamErrorKindEnum.NEGOTIATION:
+            return False
+        return None
@@ -0,0 +1,82 @@
+"""
+latency_profiles.py
+
+Named trade-offs between latency and quality for live streams, see docs/latency-profiles.md
+A profile sets how the sink paces buffers, how much the queues hold and whether they drop, how the software encoder
+is tuned, and how frames are packetized and sent
+"""
+
+from dataclasses import dataclass
+from typing import Dict
+
+from ..pydantic_schemas import LatencyProfileEnum
+
+
+@dataclass(frozen=True)
+class LatencyProfile:
+    """
+    Attributes:
+        sink_sync        whether the UDP sink waits for each buffer's running time (smooth pacing) or sends right away
+        queue_buffers    buffers a queue of a live stream holds
+        queue_leaky      whether a full queue drops its oldest buffer rather than blocking upstream, for queues of raw or
+                         JPEG frames only, queues of encoded H.264 always block
+        x264_preset      x264enc speed-preset
+        x264_tune        x264enc tune, empty for none (allows B-frames and lookahead)
+        key_int_seconds  time between keyframes, also how long a receiver that joins or loses a packet waits for a clean picture
+        mtu              size of the RTP packets
+        send_buffer      socket send buffer of the UDP sink in bytes, 0 keeps the system default
+    """
+    sink_sync: bool
+    queue_buffers: int
+    queue_leaky: bool
+    x264_preset: str
+    x264_tune: str
+    key_int_seconds: float
+    mtu: int
+    send_buffer: int
+
+    def key_int(self, fps: int) -> int:
+        """
+        Frames between keyframes at the given framerate
+        """
+        return max(int(self.key_int_seconds * fps), 1)
+
+
+LATENCY_PROFILES: Dict[LatencyProfileEnum, LatencyProfile] = {
+    # Every frame leaves as soon as it is ready, and only the newest frame is kept when anything falls behind
+    LatencyProfileEnum.ULTRA_LOW_LATENCY: LatencyProfile(
+        sink_sync=False,
+        queue_buffers=1,
+        queue_leaky=True,
+        x264_preset="ultrafast",
+        x264_tune="zerolatency",
+        key_int_seconds=1,
+        mtu=1200,
+        send_buffer=256 * 1024,
+    ),
+    LatencyProfileEnum.BALANCED: LatencyProfile(
+        sink_sync=True,
+        queue_buffers=2,
+        queue_leaky=True,
+        x264_preset="ultrafast",
+        x264_tune="zerolatency",
+        key_int_seconds=2,
+        mtu=1400,
+        send_buffer=0,
+    ),
+    # Nothing is dropped before the network, and the encoder may look ahead
+    LatencyProfileEnum.QUALITY: LatencyProfile(
+        sink_sync=True,
+        queue_buffers=30,
+        queue_leaky=False,
+        x264_preset="veryfast",
+        x264_tune="",
+        key_int_seconds=4,
+        mtu=1400,
+        send_buffer=4 * 1024 * 1024,
+    ),
+}
+
+
+def get_latency_profile(profile: LatencyProfileEnum | None) -> LatencyProfile:
+    return LATENCY_PROFILES[profile or LatencyProfileEnum.BALANCED]
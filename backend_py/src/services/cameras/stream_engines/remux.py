@@ -0,0 +1,77 @@
+"""
+remux.py
+
+Remuxes fragmented MP4 recordings into regular fast-start MP4 files once a recording session closes
+"""
+
+import glob
+import os
+import subprocess
+import threading
+import logging
+
+logger = logging.getLogger("dwe_os_2.cameras.Remux")
+
+# Remuxing only copies the samples, so this is generous even for long recordings
+REMUX_TIMEOUT = 10 * 60
+# Suffix of the file being remuxed, next to the recording so it can replace it atomically
+REMUX_SUFFIX = ".remux"
+
+
+def remux_to_faststart(path: str) -> bool:
+    """
+    Rewrite a fragmented MP4 as a regular MP4 with the moov atom at the start of the file.
+    The original file is only replaced once the remux succeeds.
+    """
+    tmp_path = f"{path}{REMUX_SUFFIX}"
+    command = [
+        "gst-launch-1.0", "-q",
+        "filesrc", f"location={path}", "!", "qtdemux", "name=demux",
+        "demux.video_0", "!", "queue", "!", "mp4mux", "faststart=true",
+        "!", "filesink", f"location={tmp_path}",
+    ]
+
+    logger.info(f"Remuxing recording: {path}")
+    try:
+        result = subprocess.run(
+            command,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+            timeout=REMUX_TIMEOUT,
+        )
+    except subprocess.TimeoutExpired:
+        logger.error(f"Remux timed out: {path}")
+        result = None
+
+    if result is None or result.returncode != 0:
+        if result is not None:
+            logger.error(
+                f"Remux failed with code {result.returncode}: {result.stderr.strip()}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        # The fragmented file is still playable, so we just keep it
+        return False
+
+    os.replace(tmp_path, path)
+    logger.info(f"Remux finished: {path}")
+    return True
+
+
+def remove_stale_remuxes(video_dir: str):
+    """
+    Remove the partial files of remuxes that were interrupted (e.g. by a power loss), their recordings are intact
+    """
+    for tmp_path in glob.glob(os.path.join(glob.escape(video_dir), f"*{REMUX_SUFFIX}")):
+        try:
+            os.remove(tmp_path)
+            logger.info(f"Removed interrupted remux: {tmp_path}")
+        except OSError as e:
+            logger.warning(f"Unable to remove interrupted remux {tmp_path}: {e}")
+
+
+def remux_in_background(path: str) -> threading.Thread:
+    thread = threading.Thread(
+        target=remux_to_faststart, args=(path,), daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,189 @@
+"""
+rtsp_stream_engine.py
+
+Serves streams over RTSP with gst-rtsp-server, so any number of viewers share a single capture and encode
+Clients can pull RTP over UDP or TCP interleaved, and connecting/disconnecting never restarts the pipeline for other viewers
+"""
+
+import re
+import threading
+import logging
+from typing import Callable, Dict, Optional
+
+from .base_stream_engine import BaseStreamEngine
+from .gstreamer_stream_engine import GStreamerPipelineBuilder
+from .engine_registry import EngineRegistry, EngineCapabilities
+from ..pydantic_schemas import StreamStatsModel, StreamEncodeTypeEnum, StreamTypeEnum
+
+# gst-rtsp-server is only available through GObject introspection, which is optional
+try:
+    import gi
+    gi.require_version("Gst", "1.0")
+    gi.require_version("GstRtspServer", "1.0")
+    from gi.repository import Gst, GstRtspServer, GLib
+except (ImportError, ValueError):
+    Gst = None
+
+
+class RTSPServerHost:
+    """
+    The single RTSP server shared by all cameras, each camera has its own mount point
+    """
+
+    PORT = 8554
+
+    _instance: Optional['RTSPServerHost'] = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get(cls) -> 'RTSPServerHost':
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = RTSPServerHost()
+            return cls._instance
+
+    def __init__(self) -> None:
+        self.logger = logging.getLogger("dwe_os_2.cameras.RTSPServerHost")
+
+        Gst.init(None)
+        self.server = GstRtspServer.RTSPServer()
+        self.server.set_service(str(self.PORT))
+        self.server.attach(None)
+
+        self._factories: Dict[str, object] = {}
+        # Called when a client starts playing a mount
+        self._play_callbacks: Dict[str, Callable[[], None]] = {}
+        self.server.connect("client-connected", self._on_client_connected)
+        self._loop = GLib.MainLoop()
+        self._thread = threading.Thread(target=self._loop.run, daemon=True)
+        self._thread.start()
+
+        self.logger.info(f"RTSP server listening on port {self.PORT}")
+
+    def mount(self, path: str, launch: str, on_play: Optional[Callable[[], None]] = None):
+        factory = GstRtspServer.RTSPMediaFactory()
+        factory.set_launch(launch)
+        # One pipeline for all clients of this mount, so we only encode once
+        factory.set_shared(True)
+        factory.set_protocols(
+            GstRtspServer.RTSPLowerTrans.UDP | GstRtspServer.RTSPLowerTrans.TCP)
+
+        self.server.get_mount_points().add_factory(path, factory)
+        self._factories[path] = factory
+        if on_play:
+            self._play_callbacks[path] = on_play
+        return factory
+
+    def unmount(self, path: str):
+        self.server.get_mount_points().remove_factory(path)
+        self._factories.pop(path, None)
+        self._play_callbacks.pop(path, None)
+
+        # Disconnect the clients of this mount only
+        def filter_session(pool, session, user_data):
+            (media, _) = session.get_media(path)
+            if media is not None:
+                return GstRtspServer.RTSPFilterResult.REMOVE
+            return GstRtspServer.RTSPFilterResult.KEEP
+
+        self.server.get_session_pool().filter(filter_session, None)
+
+    def _on_client_connected(self, server, client):
+        client.connect("play-request", self._on_play_request)
+
+    def _on_play_request(self, client, context):
+        # The request targets the mount, or one of its streams (<mount>/stream=0)
+        uri_path = context.uri.abspath
+        for (path, callback) in list(self._play_callbacks.items()):
+            if uri_path == path or uri_path.startswith(path + "/"):
+                callback()
+                break
+
+    def session_count(self, path: str) -> int:
+        count = 0
+        for session in self.server.get_session_pool().filter(None, None):
+            (media, _) = session.get_media(path)
+            if media is not None:
+                count += 1
+        return count
+
+
+@EngineRegistry.register
+class RTSPServerEngine(BaseStreamEngine):
+    """
+    Stream engine that serves the stream on rtsp://<host>:8554/<bus_info>
+    """
+
+    CAPABILITIES = EngineCapabilities(
+        encode_types={StreamEncodeTypeEnum.MJPG, StreamEncodeTypeEnum.H264,
+                      StreamEncodeTypeEnum.SOFTWARE_H264},
+        stream_types={StreamTypeEnum.RTSP},
+        in_process=True,
+        cost=10,
+    )
+
+    @classmethod
+    def is_available(cls) -> bool:
+        return Gst is not None
+
+    def __init__(self, streams, error_callback):
+        super().__init__(streams, error_callback)
+
+        self.stream = self.streams[0]
+        # bus_info is stable across replugs, so viewers can keep the same URL
+        self.mount_path = "/" + re.sub(r"[^A-Za-z0-9._-]", "_",
+                                       self.stream.bus_info or self.stream.device_path)
+        self._host: Optional[RTSPServerHost] = None
+        # Payloader of the shared media, recreated along with the media once all viewers left
+        self._payloader = None
+
+    def start(self):
+        if Gst is None:
+            self.logger.error(
+                "RTSP streaming requires PyGObject and gst-rtsp-server (gir1.2-gst-rtsp-server-1.0)")
+            self.emit_error("RTSP server is not available")
+            return
+
+        launch = GStreamerPipelineBuilder.build_rtsp(self.stream)
+        self.logger.info(f"Serving {self.mount_path}: {launch}")
+
+        self._host = RTSPServerHost.get()
+        # A viewer that joins mid-GOP gets a keyframe right away, rather than waiting for the next one
+        factory = self._host.mount(
+            self.mount_path, launch, on_play=self.request_keyframe)
+        factory.connect("media-configure", self._on_media_configure)
+
+    def stop(self):
+        if self._host:
+            self._host.unmount(self.mount_path)
+            self._host = None
+        self._payloader = None
+
+    def get_stats(self) -> StreamStatsModel:
+        stats = super().get_stats()
+        if self._host:
+            stats.viewers = self._host.session_count(self.mount_path)
+        return stats
+
+    def request_keyframe(self) -> bool:
+        payloader = self._payloader
+        if self.stream.encode_type != StreamEncodeTypeEnum.SOFTWARE_H264 or payloader is None:
+            return False
+        # Travels upstream from the payloader to x264enc, which encodes the next frame as an IDR
+        event = Gst.Event.new_custom(Gst.EventType.CUSTOM_UPSTREAM, Gst.Structure.new_from_string(
+            "GstForceKeyUnit, all-headers=(boolean)true"))
+        return payloader.get_static_pad("sink").push_event(event)
+
+    def _on_media_configure(self, factory, media):
+        # Count every frame going into the payloader, once per frame regardless of the number of viewers
+        payloader = media.get_element().get_by_name("pay0")
+        self._payloader = payloader
+        payloader.get_static_pad("sink").add_probe(
+            Gst.PadProbeType.BUFFER, self._on_buffer)
+
+    def _on_buffer(self, pad, info):
+        # The media's streaming threads are GStreamer's, counted from the one pushing into the payloader
+        self.register_current_thread()
+        self.stats.record_capture()
+        self.stats.record_send(info.get_buffer().get_size())
+        return Gst.PadProbeReturn.OK
@@ -0,0 +1,177 @@
+"""
+scheduling.py
+
+CPU affinity and scheduling policy for the stream engines
+Keeps capture, packetizing and encoding off the CPUs used by the API (uvicorn, DBus polling, ...),
+and optionally runs capture threads with SCHED_FIFO or a lower nice level so frame timing does not jitter
+"""
+
+import os
+import threading
+import logging
+from typing import Callable, List, Optional, Set
+
+from ..pydantic_schemas import SchedulingModel, EngineSchedulingModel
+
+
+class SchedulingManager:
+    """
+    Applies the scheduling preferences to threads and child processes
+
+    Policies are read when a thread or process starts, so changes apply on the next stream (re)start.
+    Without CAP_SYS_NICE, real-time priorities and negative nice levels are refused by the kernel,
+    this is logged and the stream runs with the normal scheduler.
+    """
+
+    # Name prefix of the GStreamer streaming threads that capture from V4L2 (e.g. "v4l2src0:src")
+    CAPTURE_THREAD_PREFIX = "v4l2src"
+
+    def __init__(self, get_settings: Callable[[], SchedulingModel] = SchedulingModel) -> None:
+        self._get_settings = get_settings
+        self.logger = logging.getLogger("dwe_os_2.cameras.SchedulingManager")
+
+        self._lock = threading.Lock()
+        # Native ids of the threads pinned by engines, so the API policy leaves them alone
+        self._engine_threads: Set[int] = set()
+        # CPUs this process may use (e.g. within a cpuset), read before any thread is pinned
+        self._cpus: Set[int] = os.sched_getaffinity(0)
+
+    @property
+    def settings(self) -> SchedulingModel:
+        return self._get_settings()
+
+    def policy_for(self, engine: str) -> Optional[EngineSchedulingModel]:
+        """
+        Get the policy of an engine, None when scheduling is disabled
+        """
+        settings = self.settings
+        if not settings.enabled:
+            return None
+        return settings.engines.get(engine, EngineSchedulingModel())
+
+    def engine_cpus(self, policy: EngineSchedulingModel) -> Set[int]:
+        available = self._available_cpus()
+        if len(policy.cpus) > 0:
+            cpus = set(policy.cpus) & available
+        else:
+            cpus = available - set(self.settings.api_cpus)
+        # Never leave a thread without a CPU because of a bad configuration
+        return cpus or available
+
+    def apply_api_policy(self):
+        """
+        Pin every thread of this process that does not belong to an engine to the API CPUs
+        """
+        settings = self.settings
+        available = self._available_cpus()
+        if settings.enabled and len(settings.api_cpus) > 0:
+            cpus = (set(settings.api_cpus) & available) or available
+        else:
+            cpus = available
+
+        with self._lock:
+            engine_threads = set(self._engine_threads)
+        for tid in self._list_threads(os.getpid()):
+            if tid in engine_threads:
+                continue
+            try:
+                os.sched_setaffinity(tid, cpus)
+            except OSError:
+                # The thread exited in the meantime
+                pass
+        self.logger.info(f"API threads running on CPUs {sorted(cpus)}")
+
+    def apply_to_current_thread(self, engine: str, capture: bool = False):
+        """
+        Apply the engine policy to the calling thread, capture threads also get the nice level and real-time priority
+        """
+        policy = self.policy_for(engine)
+        tid = threading.get_native_id()
+        with self._lock:
+            self._engine_threads.add(tid)
+        if policy is None:
+            return
+
+        self._set_affinity(tid, self.engine_cpus(policy))
+        if capture:
+            self._set_priority(tid, policy)
+
+    def release_current_thread(self):
+        with self._lock:
+            self._engine_threads.discard(threading.get_native_id())
+
+    def apply_to_process(self, engine: str, pid: int):
+        """
+        Set the affinity and nice level of an engine's child process, called right after it is spawned
+        Applied to every thread it has so far, the threads it creates later inherit them. Not done in a preexec_fn,
+        which is unsafe in this multi-threaded process.
+        """
+        policy = self.policy_for(engine)
+        if policy is None:
+            return
+        cpus = self.engine_cpus(policy)
+        for tid in self._list_threads(pid):
+            try:
+                os.sched_setaffinity(tid, cpus)
+                if policy.nice is not None:
+                    os.setpriority(os.PRIO_PROCESS, tid, policy.nice)
+            except PermissionError:
+                self.logger.warning(
+                    "Insufficient permissions for negative nice levels (CAP_SYS_NICE required)")
+                return
+            except OSError:
+                # The thread (or the process) exited in the meantime
+                pass
+
+    def apply_to_process_capture_threads(self, engine: str, pid: int) -> int:
+        """
+        Give the V4L2 capture threads of a GStreamer child process the real-time priority, returns the number of threads found
+
+        Only the capture threads get SCHED_FIFO, a real-time encoder could starve the rest of the system.
+        """
+        policy = self.policy_for(engine)
+        if policy is None or policy.realtime_priority is None:
+            return 0
+
+        found = 0
+        for tid in self._list_threads(pid):
+            try:
+                with open(f"/proc/{pid}/task/{tid}/comm", "r") as f:
+                    name = f.read().strip()
+            except OSError:
+                continue
+            if name.startswith(self.CAPTURE_THREAD_PREFIX):
+                found += 1
+                self._set_priority(tid, policy)
+        return found
+
+    def _set_affinity(self, tid: int, cpus: Set[int]):
+        try:
+            os.sched_setaffinity(tid, cpus)
+        except OSError as e:
+            self.logger.warning(
+                f"Unable to pin thread {tid} to CPUs {sorted(cpus)}: {e}")
+
+    def _set_priority(self, tid: int, policy: EngineSchedulingModel):
+        try:
+            if policy.realtime_priority is not None:
+                os.sched_setscheduler(
+                    tid, os.SCHED_FIFO, os.sched_param(policy.realtime_priority))
+            elif policy.nice is not None:
+                os.setpriority(os.PRIO_PROCESS, tid, policy.nice)
+        except PermissionError:
+            self.logger.warning(
+                "Insufficient permissions for real-time scheduling or negative nice levels (CAP_SYS_NICE required)")
+        except OSError as e:
+            self.logger.warning(
+                f"Unable to set scheduling policy of thread {tid}: {e}")
+
+    def _available_cpus(self) -> Set[int]:
+        return set(self._cpus)
+
+    @staticmethod
+    def _list_threads(pid: int) -> List[int]:
+        try:
+            return [int(tid) for tid in os.listdir(f"/proc/{pid}/task")]
+        except OSError:
+            return []
@@ -0,0 +1,227 @@
+"""
+srt_stream_engine.py
+
+Streams MPEG-TS over SRT, which retransmits lost packets within a latency window, for lossy or long-distance links
+GStreamer muxes the stream and sends it over local UDP to one srt-live-transmit per endpoint, which also reports the
+statistics of its SRT connection (RTT, retransmissions, drops) as JSON
+"""
+
+import json
+import shutil
+import socket
+import subprocess
+import threading
+import time
+from typing import Callable, List, Optional
+
+from .gstreamer_stream_engine import GStreamerPipelineBuilder, GStreamerProcessEngine
+from .engine_registry import EngineRegistry, EngineCapabilities
+from ..pydantic_schemas import StreamStatsModel, StreamEncodeTypeEnum, StreamTypeEnum, StreamEndpointModel, SrtOptionsModel, SrtModeEnum, SrtLinkStatsModel
+
+
+class SrtSender:
+    """
+    Sends the transport stream received on a local UDP port to one SRT endpoint, with srt-live-transmit
+    """
+
+    SRT_LIVE_TRANSMIT = "srt-live-transmit"
+    # srt-live-transmit reports its statistics every this many packets
+    STATS_PACKETS = 100
+    # A connection without a report for this long is considered down
+    STALE_AFTER = 5
+
+    def __init__(self, endpoint: StreamEndpointModel, options: SrtOptionsModel, on_exit: Callable[[str], None], logger) -> None:
+        self.endpoint = endpoint
+        self.options = options
+        self.logger = logger
+        # Called with the error output when srt-live-transmit exits on its own
+        self._on_exit = on_exit
+        self.port = self.allocate_port()
+
+        self._process: Optional[subprocess.Popen] = None
+        self._stopping = False
+        self._errors: List[str] = []
+        self._lock = threading.Lock()
+        self._stats = SrtLinkStatsModel(
+            endpoint=f"{endpoint.host}:{endpoint.port}", connected=False)
+        self._last_report: Optional[float] = None
+
+    @staticmethod
+    def allocate_port() -> int:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.bind(("127.0.0.1", 0))
+            return s.getsockname()[1]
+
+    @property
+    def uri(self) -> str:
+        query = f"mode={self.options.mode.value.lower()}&latency={self.options.latency_ms}"
+        # A listener without a host listens on every interface
+        host = self.endpoint.host if self.options.mode == SrtModeEnum.CALLER or self.endpoint.host else ""
+        return f"srt://{host}:{self.endpoint.port}?{query}"
+
+    def start(self):
+        # -fullstats reports the totals since the connection was established, rather than since the last report
+        args = [self.SRT_LIVE_TRANSMIT, f"-s:{self.STATS_PACKETS}", "-pf:json", "-fullstats",
+                f"udp://127.0.0.1:{self.port}", self.uri]
+        self.logger.info(" ".join(args))
+        self._process = subprocess.Popen(
+            args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        threading.Thread(target=self._monitor_stderr, args=(
+            self._process,), daemon=True).start()
+        threading.Thread(target=self._monitor_stdout, args=(
+            self._process,), daemon=True).start()
+
+    def stop(self):
+        process = self._process
+        if not process:
+            return
+        self._stopping = True
+        process.terminate()
+        try:
+            process.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        self._process = None
+
+    def kill(self):
+        process = self._process
+        if process:
+            self._stopping = True
+            process.kill()
+
+    @property
+    def process_id(self) -> Optional[int]:
+        process = self._process
+        return process.pid if process else None
+
+    def get_stats(self) -> SrtLinkStatsModel:
+        with self._lock:
+            stats = self._stats.model_copy()
+            stats.connected = self._last_report is not None and time.monotonic() - \
+                self._last_report < self.STALE_AFTER
+        return stats
+
+    def _monitor_stdout(self, process: subprocess.Popen):
+        try:
+            for line in iter(process.stdout.readline, ""):
+                line = line.strip()
+                if not line.startswith("{"):
+                    continue
+                try:
+                    report = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                self._record(report)
+        except (ValueError, OSError):
+            pass
+
+        process.wait()
+        if not self._stopping:
+            self._on_exit(
+                f"srt-live-transmit to {self._stats.endpoint} exited with code {process.returncode}. {' '.join(self._errors[-3:])}".strip())
+
+    def _monitor_stderr(self, process: subprocess.Popen):
+        try:
+            for line in iter(process.stderr.readline, ""):
+                line = line.strip()
+                if not line:
+                    continue
+                self.logger.debug(f"{self._stats.endpoint}: {line}")
+                if "error" in line.lower():
+                    self._errors.append(line)
+        except (ValueError, OSError):
+            pass
+
+    def _record(self, report: dict):
+        link = report.get("link", {})
+        send = report.get("send", {})
+        with self._lock:
+            self._last_report = time.monotonic()
+            self._stats.rtt_ms = link.get("rtt", self._stats.rtt_ms)
+            self._stats.send_rate_mbps = send.get(
+                "mbitRate", self._stats.send_rate_mbps)
+            self._stats.packets_sent = int(send.get("packets", 0))
+            self._stats.packets_lost = int(send.get("packetsLost", 0))
+            self._stats.packets_retransmitted = int(
+                send.get("packetsRetransmitted", 0))
+            self._stats.packets_dropped = int(send.get("packetsDropped", 0))
+
+
+@EngineRegistry.register
+class SRTStreamEngine(GStreamerProcessEngine):
+    """
+    Stream engine that sends H.264 in MPEG-TS over SRT, as a caller to each endpoint or as a listener on its port
+    """
+
+    # MPEG-TS does not carry MJPEG
+    CAPABILITIES = EngineCapabilities(
+        encode_types={StreamEncodeTypeEnum.H264,
+                      StreamEncodeTypeEnum.SOFTWARE_H264},
+        stream_types={StreamTypeEnum.SRT},
+        cost=20,
+    )
+
+    @classmethod
+    def is_available(cls) -> bool:
+        return shutil.which(SrtSender.SRT_LIVE_TRANSMIT) is not None
+
+    def __init__(self, streams, error_callback):
+        super().__init__(streams, error_callback)
+
+        self._senders: List[SrtSender] = []
+
+    def start(self):
+        if len(self.streams[0].endpoints) == 0:
+            self.emit_error("SRT streams need an endpoint")
+            return
+        super().start()
+
+    def _run_pipeline(self):
+        # The senders must be bound to their ports before GStreamer sends anything
+        self._stop_senders()
+        stream = self.streams[0]
+        self._senders = [SrtSender(endpoint, stream.srt, self._on_sender_exit, self.logger)
+                         for endpoint in stream.endpoints]
+        for sender in self._senders:
+            sender.start()
+        super()._run_pipeline()
+
+    def _construct_pipeline(self) -> str:
+        self._io_modes = [
+            GStreamerPipelineBuilder.select_io_mode(self.streams[0])]
+        return GStreamerPipelineBuilder.build(self.streams[0], with_stats=True, tap_port=self._tap_reader.port if self._tap_reader else None,
+                                              io_mode=self._io_modes[0], relay_ports=[sender.port for sender in self._senders],
+                                              record_port=self.recorder.port if self.recorder else None)
+
+    def stop(self):
+        super().stop()
+        self._stop_senders()
+
+    def kill(self):
+        super().kill()
+        for sender in self._senders:
+            sender.kill()
+
+    def process_ids(self) -> List[int]:
+        return super().process_ids() + [sender.process_id for sender in self._senders if sender.process_id is not None]
+
+    def get_stats(self) -> StreamStatsModel:
+        stats = super().get_stats()
+        stats.srt_links = [sender.get_stats() for sender in self._senders]
+        return stats
+
+    def _stop_senders(self):
+        senders = self._senders
+        self._senders = []
+        for sender in senders:
+            sender.stop()
+
+    def _on_sender_exit(self, error: str):
+        if self.started:
+            self.logger.error(error)
+            self.emit_error(error)
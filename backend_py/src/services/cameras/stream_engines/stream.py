@@ -1,3 +1,4 @@
+import zlib
 from dataclasses import dataclass, field
 from ..pydantic_schemas import *
 
@@ -7,6 +8,8 @@ class Stream:
     """
     Pure configuration object for a video stream.
     """
+    # bus_info of the owning device, stable across replugs (unlike device_path)
+    bus_info: str = ""
     device_path: str = ""
     encode_type: StreamEncodeTypeEnum = None
     stream_type: StreamTypeEnum = StreamTypeEnum.UDP
@@ -17,7 +20,23 @@ class Stream:
         default_factory=lambda: IntervalModel(numerator=1, denominator=30)
     )
     enabled: bool = False
+    recording: RecordingOptionsModel = field(
+        default_factory=RecordingOptionsModel)
+    srt: SrtOptionsModel = field(default_factory=SrtOptionsModel)
+    # Name of the engine to use instead of the automatic choice
+    engine: Optional[str] = None
+    # Latency / quality trade-off of live streams
+    latency_profile: LatencyProfileEnum = LatencyProfileEnum.BALANCED
 
     # Configuration specific
     software_h264_bitrate: int = 5000
     file_path: Optional[str] = None
+    # Directory of a running diagnostics session, the pipeline is traced while set
+    diagnostics_dir: Optional[str] = None
+
+    @property
+    def ssrc(self) -> int:
+        """
+        SSRC of the stream's RTP packets, stable for its node so receiver reports can be matched to the stream
+        """
+        return zlib.crc32(f"{self.bus_info}:{self.device_path}".encode())
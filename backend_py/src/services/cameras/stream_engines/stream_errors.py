@@ -0,0 +1,44 @@
+"""
+stream_errors.py
+
+Classifies the errors reported by the stream engines, so a failure can be handled according to its cause
+(e.g. a stream that does not fit the USB bandwidth is retried with a cheaper configuration rather than as is)
+"""
+
+import errno
+from typing import List
+
+from ..pydantic_schemas import StreamErrorKindEnum
+
+# Lowercase fragments of GStreamer error output (gst-launch stderr and bus messages), checked in order
+GSTREAMER_ERROR_PATTERNS = [
+    # VIDIOC_STREAMON fails with ENOSPC when the UVC driver cannot reserve the isochronous bandwidth
+    (StreamErrorKindEnum.BANDWIDTH, ["no space left on device",
+     "not enough bandwidth", "insufficient bandwidth"]),
+    (StreamErrorKindEnum.DEVICE_LOST, ["no such device", "cannot identify device",
+     "could not open device", "device has been disconnected"]),
+    # A buffer pool that cannot be activated is usually an io-mode the driver does not support
+    (StreamErrorKindEnum.NEGOTIATION, ["not-negotiated", "not negotiated",
+     "could not negotiate format", "buffer pool activation failed"]),
+]
+
+OS_ERROR_KINDS = {
+    errno.ENOSPC: StreamErrorKindEnum.BANDWIDTH,
+    errno.ENODEV: StreamErrorKindEnum.DEVICE_LOST,
+    errno.ENOENT: StreamErrorKindEnum.DEVICE_LOST,
+}
+
+
+def classify_gstreamer_error(lines: List[str]) -> StreamErrorKindEnum:
+    """
+    Classify the error output of a failed pipeline
+    """
+    output = "\n".join(lines).lower()
+    for (kind, patterns) in GSTREAMER_ERROR_PATTERNS:
+        if any(pattern in output for pattern in patterns):
+            return kind
+    return StreamErrorKindEnum.UNKNOWN
+
+
+def classify_os_error(error: OSError) -> StreamErrorKindEnum:
+    return OS_ERROR_KINDS.get(error.errno, StreamErrorKindEnum.UNKNOWN)
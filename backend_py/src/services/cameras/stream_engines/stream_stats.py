@@ -0,0 +1,110 @@
+"""
+stream_stats.py
+
+Collects live stream telemetry from the engines
+Counters are cheap to update from the data path, and are turned into rates when a snapshot is taken (about once per second)
+"""
+
+import time
+from typing import Dict, Optional
+
+from ..pydantic_schemas import StreamStatsModel
+
+
+class StreamStatsCollector:
+    """
+    Per-engine stream statistics
+
+    The record_* methods are called from the capture/stream threads. They only bump counters, no locking is done,
+    since a slightly off count in one window is not worth slowing down the data path for.
+    """
+
+    def __init__(self) -> None:
+        # Totals since the engine started
+        self.capture_drops = 0
+        self.queue_drops = 0
+        self.send_errors = 0
+
+        self._last_sequence: Dict[int, int] = {}
+        self._last_capture_us: Optional[int] = None
+        self._reset_window(time.monotonic())
+
+    def _reset_window(self, now: float):
+        self._window_start = now
+        self._captured = 0
+        self._sent = 0
+        self._sent_bytes = 0
+        self._latency_total_ms = 0.0
+        self._latency_count = 0
+        self._interval_count = 0
+        self._interval_total = 0.0
+        self._interval_total_sq = 0.0
+
+    def record_capture(self, count: int = 1, timestamp_us: Optional[int] = None):
+        """
+        Count captured frames, timestamp_us is the capture time of the frame (monotonic) if known
+        """
+        self._captured += count
+        if timestamp_us is None:
+            timestamp_us = time.monotonic_ns() // 1000
+        if self._last_capture_us is not None and timestamp_us > self._last_capture_us:
+            interval = (timestamp_us - self._last_capture_us) / 1000
+            self._interval_count += 1
+            self._interval_total += interval
+            self._interval_total_sq += interval * interval
+        self._last_capture_us = timestamp_us
+
+    def record_sequence(self, source: int, sequence: int):
+        """
+        Track the V4L2 buffer sequence of a source, gaps mean the driver dropped frames
+        """
+        last = self._last_sequence.get(source)
+        if last is not None and sequence > last + 1:
+            self.capture_drops += sequence - last - 1
+        self._last_sequence[source] = sequence
+
+    def record_send(self, nbytes: int):
+        self._sent += 1
+        self._sent_bytes += nbytes
+
+    def record_queue_drop(self, count: int = 1):
+        self.queue_drops += count
+
+    def record_send_error(self):
+        self.send_errors += 1
+
+    def record_encode_latency(self, latency_ms: float):
+        self._latency_total_ms += latency_ms
+        self._latency_count += 1
+
+    def snapshot(self, engine: str) -> StreamStatsModel:
+        """
+        Compute the rates since the last snapshot and start a new window
+        """
+        now = time.monotonic()
+        elapsed = max(now - self._window_start, 1e-6)
+
+        stats = StreamStatsModel(
+            engine=engine,
+            captured_fps=round(self._captured / elapsed, 2),
+            sent_fps=round(self._sent / elapsed, 2),
+            bitrate_kbps=round(self._sent_bytes * 8 / elapsed / 1000, 1),
+            capture_drops=self.capture_drops,
+            queue_drops=self.queue_drops,
+            encode_latency_ms=round(
+                self._latency_total_ms / self._latency_count, 2) if self._latency_count > 0 else None,
+            send_errors=self.send_errors,
+            frame_jitter_ms=self._jitter_ms(),
+            timestamp=time.time(),
+        )
+
+        self._reset_window(now)
+        return stats
+
+    def _jitter_ms(self) -> Optional[float]:
+        if self._interval_count < 2:
+            return None
+        mean = self._interval_total / self._interval_count
+        variance = max(self._interval_total_sq /
+                       self._interval_count - mean * mean, 0)
+        return round(variance ** 0.5, 3)
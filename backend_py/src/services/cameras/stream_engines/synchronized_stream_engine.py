@@ -1,5 +1,6 @@
 from ..synchronized_camera import V4L2Camera, SynchronizedCamera, CopiedFrame
-from ..pydantic_schemas import StreamEndpointModel
+from .. import v4l2
+from ..pydantic_schemas import StreamEndpointModel, StreamEncodeTypeEnum, StreamTypeEnum
 from rtp import RTP
 import time
 import struct
@@ -7,23 +8,48 @@ import socket
 import threading
 import time
 import collections
-from typing import List
+from typing import List, Tuple
 
 from .base_stream_engine import BaseStreamEngine
+from .frame_tap import FrameTap
+from .engine_registry import EngineRegistry, EngineCapabilities
+from .h264_rtp import H264RtpPacketizer, is_keyframe, timestamp_to_rtp
+from .stream_errors import classify_os_error
+from .latency_profiles import get_latency_profile
 from .stream import Stream
 
 
+@EngineRegistry.register
 class SynchronizedStreamEngine(BaseStreamEngine):
 
+    # The protocol carries exactly one stereo pair
+    CAPABILITIES = EngineCapabilities(
+        encode_types={StreamEncodeTypeEnum.MJPG, StreamEncodeTypeEnum.H264},
+        stream_types={StreamTypeEnum.UDP},
+        min_cameras=2,
+        max_cameras=2,
+        synchronized=True,
+        in_process=True,
+        cost=10,
+    )
+
+    # Frames waiting to be sent, older frames are dropped when the sender falls behind
+    FRAME_QUEUE_SIZE = 4
+
     def __init__(self, streams, error_callback):
         super().__init__(streams, error_callback)
 
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.frame_queue: collections.deque[tuple[CopiedFrame]] = \
-            collections.deque()
+        # (shared timestamp, [(camera index, frame)]), a matched pair or a single unmatched H.264 frame
+        self.frame_queue: collections.deque[Tuple[int, List[Tuple[int, CopiedFrame]]]] = \
+            collections.deque(maxlen=self.FRAME_QUEUE_SIZE)
 
-        self.MTU = 1400
+        profile = get_latency_profile(streams[0].latency_profile)
+        self.MTU = profile.mtu
         self.SSRC = 0x445745  # "DWE"
+        if profile.send_buffer > 0:
+            self.socket.setsockopt(
+                socket.SOL_SOCKET, socket.SO_SNDBUF, profile.send_buffer)
 
         self.stream_thread: threading.Thread | None = None
         self.capture_thread: threading.Thread | None = None
@@ -31,14 +57,27 @@ class SynchronizedStreamEngine(BaseStreamEngine):
 
         self.synchronized_camera = None
 
-        # Always MJPEG
+        # H.264 is captured from the cameras' hardware encoders, and sent as one RTP stream per camera
+        # on consecutive even ports (port, port + 2, ...), a matched pair shares its RTP timestamp
+        self.h264 = streams[0].encode_type == StreamEncodeTypeEnum.H264
+        pixel_format = v4l2.V4L2_PIX_FMT_H264 if self.h264 else v4l2.V4L2_PIX_FMT_MJPEG
+        self._packetizers = [H264RtpPacketizer(
+            stream.ssrc, self.MTU) for stream in streams]
+        # Frames of a camera are skipped until its next keyframe after one was dropped, since they cannot be decoded
+        self._awaiting_keyframe = [True] * len(streams)
+
+        # Matched frame pairs are published while someone is subscribed, previews and stills expect JPEG
+        if not self.h264:
+            self.frame_tap = FrameTap()
+
         try:
             self.cameras: List[V4L2Camera] = [V4L2Camera(
-                stream.device_path, stream.width, stream.height, stream.interval.denominator) for stream in streams]
-            self.synchronized_camera = SynchronizedCamera(self.cameras)
+                stream.device_path, stream.width, stream.height, stream.interval.denominator, pixel_format) for stream in streams]
+            self.synchronized_camera = SynchronizedCamera(
+                self.cameras, keep_unmatched=self.h264)
         except OSError as e:
             self.logger.error("Unable to open synchronized camera: '%s'", e)
-            self.emit_error(e.strerror)
+            self.emit_error(e.strerror, classify_os_error(e))
         
 
     def _send_frame(self, frames: List[CopiedFrame], endpoint: StreamEndpointModel):
@@ -77,12 +116,45 @@ class SynchronizedStreamEngine(BaseStreamEngine):
                 marker=is_last
             )
 
-            self.socket.sendto(bytes(
-                rtp_pkt), (endpoint.host, endpoint.port))
+            try:
+                self.socket.sendto(bytes(
+                    rtp_pkt), (endpoint.host, endpoint.port))
+            except OSError:
+                self.stats.record_send_error()
 
             bytes_sent = chunk_end
             sequence_number += 1
 
+        self.stats.record_send(payload_size)
+
+    def _send_h264(self, timestamp_us: int, frames: List[Tuple[int, CopiedFrame]], endpoint: StreamEndpointModel):
+        timestamp = timestamp_to_rtp(timestamp_us)
+        nbytes = 0
+        for (i, frame) in frames:
+            if self._awaiting_keyframe[i]:
+                if not is_keyframe(frame.data):
+                    continue
+                self._awaiting_keyframe[i] = False
+
+            for packet in self._packetizers[i].packetize(frame.data, timestamp):
+                try:
+                    self.socket.sendto(
+                        packet, (endpoint.host, endpoint.port + 2 * i))
+                except OSError:
+                    self.stats.record_send_error()
+            nbytes += len(frame.data)
+
+        if nbytes > 0:
+            self.stats.record_send(nbytes)
+
+    def _enqueue(self, timestamp_us: int, frames: List[Tuple[int, CopiedFrame]]):
+        if len(self.frame_queue) == self.frame_queue.maxlen:
+            # The deque drops the oldest frame on append
+            self.stats.record_queue_drop()
+            if self.h264:
+                self._awaiting_keyframe = [True] * len(self.streams)
+        self.frame_queue.append((timestamp_us, frames))
+
     def start(self):
         self.logger.info(
             f"Starting synchronized stream with: {(', '.join([stream.device_path for stream in self.streams]))}")
@@ -115,28 +187,54 @@ class SynchronizedStreamEngine(BaseStreamEngine):
             self.logger.error(
                 f"Timeout exceeded while joining capture thread: {e}")
 
+    def kill(self):
+        # The loops exit at their next iteration
+        self._running = False
+
     def capture_loop_(self):
+        self.apply_thread_policy(capture=True)
         # We need to be careful about the blocking aspect of grab
         while self._running:
             frames = self.synchronized_camera.grab()
+
+            # Older than anything still waiting to be matched, so each camera's frames stay in order
+            unmatched = self.synchronized_camera.unmatched
+            while len(unmatched) > 0:
+                (i, frame) = unmatched.popleft()
+                self._enqueue(frame.timestamp_us, [(i, frame)])
+
             if frames is None:
                 time.sleep(0.01)
                 continue
 
-            self.frame_queue.append([frames[0], frames[1]])
+            self.stats.record_capture(timestamp_us=frames[0].timestamp_us)
+            for i, frame in enumerate(frames):
+                self.stats.record_sequence(i, frame.sequence)
+
+            if self.frame_tap and self.frame_tap.active:
+                self.frame_tap.publish(frames)
+
+            self._enqueue(frames[0].timestamp_us, list(enumerate(frames)))
         self.synchronized_camera.stop()
+        self.scheduler.release_current_thread()
 
     def stream_loop_(self):
+        self.apply_thread_policy()
         while self._running:
             try:
                 endpoint = self.streams[0].endpoints[0]
             except IndexError:
+                time.sleep(0.01)
                 continue
-            # TODO: do not assume two
             try:
-                (left, right) = self.frame_queue.popleft()
-                # TODO: make less scuffed
-                self._send_frame([left, right], endpoint)
+                (timestamp_us, frames) = self.frame_queue.popleft()
             except IndexError:
                 time.sleep(0.01)
                 continue
+
+            if self.h264:
+                self._send_h264(timestamp_us, frames, endpoint)
+            else:
+                # TODO: do not assume two
+                self._send_frame([frame for (_, frame) in frames], endpoint)
+        self.scheduler.release_current_thread()
@@ -3,13 +3,19 @@ stream_runner.py
 """
 
 import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List
 import event_emitter as events
 import logging
 from .stream_engines.stream import Stream
 from .stream_engines.base_stream_engine import BaseStreamEngine
-from .stream_engines.synchronized_stream_engine import SynchronizedStreamEngine
-from .stream_engines.gstreamer_stream_engine import GStreamerProcessEngine
-import time
+from .stream_engines.frame_tap import FrameTap
+from .stream_engines.instant_recorder import InstantRecorder
+from .stream_engines.engine_registry import EngineRegistry
+from .exceptions import NoSuitableEngineException
+# Importing the engines registers them
+from .stream_engines import synchronized_stream_engine, gstreamer_stream_engine, rtsp_stream_engine, srt_stream_engine
+from .pydantic_schemas import StreamStatsModel, StreamStateEnum, StreamErrorKindEnum
 
 
 class StreamRunner(events.EventEmitter):
@@ -17,61 +23,230 @@ class StreamRunner(events.EventEmitter):
     The main entry point. Automatically decides which engine to use based on usage.
 
     Streams are expected to be added dynamically. Calling start() will construct the correct engine on the fly with the provided streams.
+
+    start() and stop() return right away, the blocking work (opening devices, waiting for EOS, ...) runs on the runner's
+    own worker thread, one request at a time. A request supersedes every request made before it, so queued requests are
+    skipped and a running one gives up at its next step. Every transition emits "state_changed" (state, error).
     """
 
+    # Time for the previous engine to release the devices before the next one opens them
+    RESTART_DELAY = 1
+
     def __init__(self, *streams: Stream) -> None:
         super().__init__()
         self.streams = list(streams)
-        self.started = False
-        self._lock = threading.RLock()
+        self.state = StreamStateEnum.IDLE
+        self.engine: BaseStreamEngine | None = None
         self.logger = logging.getLogger("dwe_os_2.cameras.StreamRunner")
 
-    def _select_engine(self) -> BaseStreamEngine:
-        """Factory method to choose the correct streaming backend."""
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="StreamRunner")
+        # Incremented by every request, a request only proceeds while it is the latest one
+        self._generation = 0
+        self._superseded = threading.Condition()
+        # Generation of the request that created the current engine
+        self._engine_generation = 0
+
+    @property
+    def started(self) -> bool:
+        """
+        Whether the engine is running
+        """
+        return self.state == StreamStateEnum.RUNNING
 
-        # Selecting engines like this is extremely naive, but works at the moment
-        # Still infinitely better than only being able to do GStreamer as a backend
-        # Ideally we would have a way for either the user or the backend to control
+    @property
+    def active(self) -> bool:
+        """
+        Whether the stream is running or about to
+        """
+        return self.state in [StreamStateEnum.STARTING, StreamStateEnum.RUNNING]
 
-        if len(self.streams) > 1:
-            self.logger.info(
-                "Multiple streams detected: Using SynchronizedStreamEngine.")
-            return SynchronizedStreamEngine(self.streams, self._on_engine_error)
-        else:
-            self.logger.info(
-                "Single stream detected: Using GStreamerProcessEngine.")
-            return GStreamerProcessEngine(self.streams, self._on_engine_error)
+    def _select_engine(self, error_callback: Callable[..., None]) -> BaseStreamEngine:
+        """Factory method to choose the correct streaming backend."""
+        preferred = self.streams[0].engine
+        try:
+            engine = EngineRegistry.select(self.streams, preferred)
+        except NoSuitableEngineException as e:
+            if not preferred:
+                raise
+            # Keep streaming with the automatic choice rather than not at all
+            self.logger.warning(f"{e}, selecting an engine automatically")
+            engine = EngineRegistry.select(self.streams)
+
+        self.logger.info(
+            f"Using {engine.__name__} for {len(self.streams)} stream(s)")
+        return engine(self.streams, error_callback)
 
-    def _on_engine_error(self, error_data):
+    def _on_engine_error(self, generation: int, error_data, kind: StreamErrorKindEnum = StreamErrorKindEnum.UNKNOWN):
         """Callback to bubble up errors from the engine to the runner's listeners."""
         # TODO: change to general stream error
-        self.emit("stream_error", error_data)
-        self.stop()
+        self.emit("stream_error", error_data, kind)
+        # Queued without superseding anything, a start requested in the meantime still goes through
+        self._executor.submit(self._fail_engine, generation, str(error_data))
 
-    def start(self):
-        with self._lock:
-            self.logger.info(
-                f"Starting streams: {[s.device_path for s in self.streams]}")
-            if self.started:
-                self.stop()
-                time.sleep(1)
+    def start(self, before_start: Callable[[], None] | None = None) -> Future:
+        """
+        (Re)start the streams with a new engine
+        before_start runs on the worker thread before the engine opens the devices, e.g. to wait for them to be free
+        """
+        return self._submit(self._start_engine, before_start)
 
-            # We create the engine on start, so the engine can perform initial setup on constructor
-            self.engine: BaseStreamEngine = self._select_engine()
-
-            self.started = True
-            # We don't need to catch exceptions, maybe remove later
-            try:
-                self.engine.start()
-            except Exception as e:
-                self.logger.error(f"Failed to start engine: {e}")
-                self.started = False
-
-    def stop(self):
-        with self._lock:
-            if not self.started:
+    def stop(self) -> Future:
+        return self._submit(self._stop_engine, StreamStateEnum.IDLE, None)
+
+    def kill(self):
+        """
+        Force the current engine to release its devices, unblocking a stop that is taking too long
+        """
+        engine = self.engine
+        if engine:
+            engine.kill()
+
+    def _submit(self, fn, *args) -> Future:
+        with self._superseded:
+            self._generation += 1
+            generation = self._generation
+            self._superseded.notify_all()
+        return self._executor.submit(self._run_request, generation, fn, *args)
+
+    def _run_request(self, generation: int, fn, *args):
+        if self._is_superseded(generation):
+            return
+        try:
+            fn(generation, *args)
+        except Exception as e:
+            self.logger.error(f"Stream request failed: {e}")
+            self._set_state(StreamStateEnum.FAILED, str(e))
+
+    def _is_superseded(self, generation: int) -> bool:
+        return generation != self._generation
+
+    def _wait_superseded(self, generation: int, timeout: float) -> bool:
+        """
+        Sleep up to timeout, returns True early if a newer request was made
+        """
+        with self._superseded:
+            return self._superseded.wait_for(lambda: self._is_superseded(generation), timeout)
+
+    def _set_state(self, state: StreamStateEnum, error: str | None = None):
+        if state == self.state and error is None:
+            return
+        self.state = state
+        self.emit("state_changed", state, error)
+
+    def _start_engine(self, generation: int, before_start: Callable[[], None] | None = None):
+        self.logger.info(
+            f"Starting streams: {[s.device_path for s in self.streams]}")
+        if self.engine:
+            self._set_state(StreamStateEnum.STOPPING)
+            self.engine.stop()
+            self.engine = None
+            self._set_state(StreamStateEnum.IDLE)
+            if self._wait_superseded(generation, self.RESTART_DELAY):
                 return
 
+        self._set_state(StreamStateEnum.STARTING)
+        if before_start:
+            before_start()
+            if self._is_superseded(generation):
+                return
+        self._engine_generation = generation
+        errors = []
+
+        def on_error(error, kind: StreamErrorKindEnum = StreamErrorKindEnum.UNKNOWN):
+            errors.append(error)
+            self._on_engine_error(generation, error, kind)
+
+        try:
+            # We create the engine on start, so the engine can perform initial setup on constructor
+            # No suitable engine (e.g. MJPEG over SRT) is reported like any other failure to start
+            engine = self._select_engine(on_error)
+            self.engine = engine
+            engine.start()
+        except Exception as e:
+            self.logger.error(f"Failed to start engine: {e}")
+            self.engine = None
+            self._set_state(StreamStateEnum.FAILED, str(e))
+            self.emit("stream_error", str(e), StreamErrorKindEnum.UNKNOWN)
+            return
+
+        # An error reported while starting already queued the engine's stop
+        if len(errors) == 0:
+            self._set_state(StreamStateEnum.RUNNING)
+
+    def _fail_engine(self, generation: int, error: str):
+        if generation != self._engine_generation or not self.engine:
+            # The failed engine was already replaced or stopped
+            return
+        try:
+            self._stop_engine(generation, StreamStateEnum.FAILED, error)
+        except Exception as e:
+            self.logger.error(f"Failed to stop engine: {e}")
+            self.engine = None
+            self._set_state(StreamStateEnum.FAILED, error)
+
+    def _stop_engine(self, generation: int, final_state: StreamStateEnum, error: str | None):
+        if self.engine:
             self.logger.info("Stopping streams...")
-            self.started = False
+            self._set_state(StreamStateEnum.STOPPING)
             self.engine.stop()
+            self.engine = None
+        self._set_state(final_state, error)
+
+    def get_stats(self) -> StreamStatsModel | None:
+        """
+        Get the stats of the running engine since the last call
+        """
+        engine = self.engine
+        if not self.started or not engine:
+            return None
+        return engine.get_stats()
+
+    def get_frame_tap(self) -> FrameTap | None:
+        """
+        Get the tap of the running engine, if it can share its frames
+        """
+        engine = self.engine
+        if not self.started or not engine:
+            return None
+        return engine.frame_tap
+
+    def get_recorder(self) -> InstantRecorder | None:
+        """
+        Get the recording branch of the running engine, if it has one (streams with recording.instant set)
+        """
+        engine = self.engine
+        if not self.started or not engine:
+            return None
+        return engine.recorder
+
+    def request_keyframe(self) -> bool:
+        """
+        Ask the running engine's software encoder for a keyframe
+        """
+        engine = self.engine
+        if not self.started or not engine:
+            return False
+        return engine.request_keyframe()
+
+    def get_process_ids(self) -> List[int]:
+        """
+        Get the child processes of the running engine
+        """
+        engine = self.engine
+        if not self.started or not engine:
+            return []
+        return engine.process_ids()
+
+    def get_thread_ids(self) -> List[int]:
+        """
+        Get the threads of the running engine in this process
+        """
+        engine = self.engine
+        if not self.started or not engine:
+            return []
+        return engine.thread_ids()
+
+    def supports_diagnostics(self) -> bool:
+        engine = self.engine
+        return self.started and engine is not None and engine.DIAGNOSTICS
@@ -0,0 +1,238 @@
+"""
+stream_supervisor.py
+
+Restarts streams whose engine failed (e.g. after a transient USB glitch), without operator action
+Restarts are delayed with jittered exponential backoff, and a circuit breaker stops retrying a stream that keeps failing
+A stream that failed for lack of USB bandwidth is first restarted with a cheaper configuration, if one is left
+"""
+
+import random
+import threading
+import time
+import logging
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+import event_emitter as events
+
+from .device import Device
+from .pydantic_schemas import StreamRestartStatsModel, StreamErrorKindEnum
+
+
+@dataclass
+class _SupervisedStream:
+    """
+    Restart state of one stream of a device
+
+    Attributes:
+        restarts                 restarts done since the device was added
+        consecutive_failures     failures since the stream last ran for STABLE_PERIOD
+        failure_times            monotonic times of the recent failures, for the circuit breaker
+        last_error               last error reported by the engine
+        last_failure             wall clock time of the last failure
+        last_start               monotonic time of the last restart
+        circuit_open             whether restarts are suspended
+        next_restart             monotonic time of the pending restart
+        timer                    pending restart (or half-open trial)
+    """
+    restarts: int = 0
+    consecutive_failures: int = 0
+    failure_times: List[float] = field(default_factory=list)
+    last_error: Optional[str] = None
+    last_failure: Optional[float] = None
+    last_start: float = 0
+    circuit_open: bool = False
+    next_restart: Optional[float] = None
+    timer: Optional[threading.Timer] = None
+
+
+class StreamSupervisor(events.EventEmitter):
+    """
+    Watches the stream runners of the devices, secondary streams included, and restarts them when their engine fails
+
+    Apart from the bandwidth fallback, the stream configuration is left untouched, so the restarted stream is the one the user configured.
+    Emits "restart_scheduled" (bus_info, attempt, delay, secondary), "restarted" (bus_info, attempt, secondary),
+    and "circuit_open" / "circuit_closed" (bus_info, secondary).
+
+    The fallback callback reconfigures the stream of a device after a bandwidth error, returning whether it did.
+    A fallback is not counted as a failure, since the configuration that failed is not the one restarted.
+    """
+
+    # Backoff delays, in seconds
+    BASE_DELAY = 1
+    MAX_DELAY = 60
+    # A stream that ran this long without failing starts over with the base delay
+    STABLE_PERIOD = 60
+    # The circuit opens after this many failures within the window, and a single trial restart is done after the cooldown
+    CIRCUIT_FAILURES = 5
+    CIRCUIT_WINDOW = 120
+    CIRCUIT_COOLDOWN = 300
+
+    def __init__(self, is_present: Callable[[str], bool] = lambda _: True,
+                 fallback: Callable[[Device, str], bool] = lambda device, error: False) -> None:
+        super().__init__()
+        self.logger = logging.getLogger("dwe_os_2.cameras.StreamSupervisor")
+        # Restarting a device that was unplugged in the meantime would only fail again
+        self._is_present = is_present
+        self._fallback = fallback
+        self._lock = threading.Lock()
+        # By (bus_info, secondary)
+        self._streams: Dict[Tuple[str, bool], _SupervisedStream] = {}
+
+    def supervise(self, device: Device):
+        device.stream_runner.on(
+            "stream_error", lambda error, kind=StreamErrorKindEnum.UNKNOWN: self._on_stream_error(device, error, kind))
+        device.secondary_stream_runner.on(
+            "stream_error", lambda error, kind=StreamErrorKindEnum.UNKNOWN: self._on_stream_error(device, error, kind, True))
+
+    def forget(self, bus_info: str):
+        """
+        Cancel the pending restarts and drop the stats of a removed device
+        """
+        with self._lock:
+            states = [self._streams.pop((bus_info, secondary), None) for secondary in [False, True]]
+        for state in states:
+            if state and state.timer:
+                state.timer.cancel()
+
+    def reset(self, bus_info: str, secondary: bool = False):
+        """
+        Close the circuit and clear the failure history, e.g. when the user restarts or reconfigures the stream
+        """
+        with self._lock:
+            state = self._streams.get((bus_info, secondary))
+            if not state:
+                return
+            was_open = state.circuit_open
+            state.circuit_open = False
+            state.consecutive_failures = 0
+            state.failure_times.clear()
+            if state.timer:
+                state.timer.cancel()
+                state.timer = None
+            state.next_restart = None
+        if was_open:
+            self.emit("circuit_closed", bus_info, secondary)
+
+    def get_stats(self) -> List[StreamRestartStatsModel]:
+        now = time.monotonic()
+        with self._lock:
+            return [
+                StreamRestartStatsModel(
+                    bus_info=bus_info,
+                    secondary=secondary,
+                    restarts=state.restarts,
+                    consecutive_failures=state.consecutive_failures,
+                    last_error=state.last_error,
+                    last_failure=state.last_failure,
+                    circuit_open=state.circuit_open,
+                    next_restart_in=round(
+                        max(state.next_restart - now, 0), 1) if state.next_restart is not None else None,
+                )
+                for ((bus_info, secondary), state) in self._streams.items()
+            ]
+
+    def _on_stream_error(self, device: Device, error, kind: StreamErrorKindEnum = StreamErrorKindEnum.UNKNOWN,
+                         secondary: bool = False):
+        bus_info = device.bus_info
+        name = "Secondary stream" if secondary else "Stream"
+        # Retrying the same configuration would fail the same way, the fallback order is the main stream's
+        fallback = kind == StreamErrorKindEnum.BANDWIDTH and not secondary and self._fallback(
+            device, str(error))
+        now = time.monotonic()
+        with self._lock:
+            state = self._streams.setdefault((bus_info, secondary), _SupervisedStream())
+            if state.timer:
+                state.timer.cancel()
+
+            state.last_error = str(error)
+            state.last_failure = time.time()
+            opened = False
+            if fallback:
+                delay = self.BASE_DELAY
+            else:
+                if now - state.last_start > self.STABLE_PERIOD:
+                    state.consecutive_failures = 0
+                state.consecutive_failures += 1
+                state.failure_times = [t for t in state.failure_times
+                                       if now - t < self.CIRCUIT_WINDOW] + [now]
+
+                # A failed half-open trial, or too many failures in the window
+                open_circuit = state.circuit_open or len(
+                    state.failure_times) >= self.CIRCUIT_FAILURES
+                if open_circuit:
+                    delay = self.CIRCUIT_COOLDOWN
+                else:
+                    # Full jitter keeps several cameras on the same hub from retrying in lockstep
+                    backoff = min(self.BASE_DELAY * 2 **
+                                  (state.consecutive_failures - 1), self.MAX_DELAY)
+                    delay = random.uniform(backoff / 2, backoff)
+                opened = open_circuit and not state.circuit_open
+                state.circuit_open = open_circuit
+            state.next_restart = now + delay
+            attempt = state.consecutive_failures
+
+            state.timer = threading.Timer(
+                delay, self._restart, args=(device, attempt, secondary))
+            state.timer.daemon = True
+            state.timer.start()
+
+        if opened:
+            self.logger.warning(
+                f"{bus_info}: {name} failed {len(state.failure_times)} times within {self.CIRCUIT_WINDOW}s, retrying in {self.CIRCUIT_COOLDOWN}s")
+            self.emit("circuit_open", bus_info, secondary)
+        elif fallback:
+            self.logger.info(
+                f"{bus_info}: Restarting stream with a cheaper configuration in {delay}s")
+        else:
+            self.logger.info(
+                f"{bus_info}: Restarting failed {name.lower()} in {delay:.1f}s (attempt {attempt})")
+        self.emit("restart_scheduled", bus_info, attempt, delay, secondary)
+
+    def _restart(self, device: Device, attempt: int, secondary: bool = False):
+        bus_info = device.bus_info
+        name = "Secondary stream" if secondary else "Stream"
+        with self._lock:
+            state = self._streams.get((bus_info, secondary))
+            if not state:
+                return
+            state.timer = None
+            state.next_restart = None
+
+        if not self._is_present(bus_info):
+            self.logger.info(f"{bus_info}: Device is gone, not restarting")
+            return
+        (stream, runner) = (device.secondary_stream, device.secondary_stream_runner) if secondary else (
+            device.stream, device.stream_runner)
+        if not stream or not stream.enabled or runner.active:
+            # Stopped or restarted by the user in the meantime
+            return
+
+        with self._lock:
+            state.restarts += 1
+            state.last_start = time.monotonic()
+            half_open = state.circuit_open
+        self.logger.info(f"{bus_info}: Restarting {name.lower()} (attempt {attempt})")
+        if secondary:
+            device.start_secondary_stream()
+        else:
+            device.start_stream()
+        self.emit("restarted", bus_info, attempt, secondary)
+
+        if half_open:
+            # The trial restart has to hold for a while before the circuit closes
+            timer = threading.Timer(
+                self.STABLE_PERIOD, self._close_if_stable, args=(device, state.last_start, secondary))
+            timer.daemon = True
+            timer.start()
+
+    def _close_if_stable(self, device: Device, started_at: float, secondary: bool = False):
+        with self._lock:
+            state = self._streams.get((device.bus_info, secondary))
+            if not state or not state.circuit_open or state.last_start != started_at:
+                return
+            runner = device.secondary_stream_runner if secondary else device.stream_runner
+            if not runner.started:
+                return
+        self.logger.info(f"{device.bus_info}: {'Secondary stream' if secondary else 'Stream'} recovered")
+        self.reset(device.bus_info, secondary)
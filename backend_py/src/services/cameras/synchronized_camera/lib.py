@@ -20,17 +20,19 @@ class CopiedFrame:
     """A frame copied from the kernel
 
     Attributes:
-        data             JPEG encoded data
+        data             JPEG encoded data, or an H.264 access unit (Annex B)
         width            width of frame
         height           height of frame
-        pixel_format     number defining the format of the image (currently always jpeg)
+        pixel_format     number defining the format of the image (MJPEG or H.264)
         timestamp_us     the timestamp of the frame in microseconds
+        sequence         the V4L2 buffer sequence number, gaps indicate dropped frames
     """
     data: bytes
     width: int
     height: int
     pixel_format: int
     timestamp_us: int
+    sequence: int = 0
 
 
 class V4L2Camera:
@@ -196,6 +198,7 @@ class V4L2Camera:
             height=self.height,
             pixel_format=self.pixel_format,
             timestamp_us=ts_us,
+            sequence=buf.sequence,
         )
 
     def close(self):
@@ -244,7 +247,8 @@ class SynchronizedCamera:
 
     def __init__(self,
                  cameras: List[V4L2Camera],
-                 queue_cap: int = 8):
+                 queue_cap: int = 8,
+                 keep_unmatched: bool = False):
         self.cameras = cameras
         sync_threshold_us = 1.0 / self.cameras[0].fps * 1000000
 
@@ -253,6 +257,10 @@ class SynchronizedCamera:
         self.queues: List[deque[CopiedFrame]] = [
             deque() for _ in cameras
         ]
+        # H.264 frames depend on each other, so frames that could not be matched are kept as (camera index, frame)
+        # for the caller to send on their own, instead of being dropped
+        self.keep_unmatched = keep_unmatched
+        self.unmatched: deque[tuple[int, CopiedFrame]] = deque()
         self.logger = logging.getLogger(
             f"dwe_os_2.cameras.SynchronizedCamera")
 
@@ -273,6 +281,11 @@ class SynchronizedCamera:
         for cam in self.cameras:
             cam.close()
 
+    def _drop(self, index: int):
+        frame = self.queues[index].popleft()
+        if self.keep_unmatched:
+            self.unmatched.append((index, frame))
+
     def grab(self) -> Optional[List[CopiedFrame]]:
         """
         Grab and synchronize frames from all cameras.
@@ -295,7 +308,7 @@ class SynchronizedCamera:
             q.append(cf)
             if len(q) > self.queue_cap:
                 # Camera i is lagging relative to others; drop oldest
-                q.popleft()
+                self._drop(i)
 
         # attempt synchronization
         while self._queues_full():
@@ -315,7 +328,7 @@ class SynchronizedCamera:
                 min_index = timestamps.index(min_ts)
                 self.logger.warning(
                     f"Dropping frame of difference: {max_ts - min_ts}")
-                self.queues[min_index].popleft()
+                self._drop(min_index)
 
         # Not enough frames anymore to sync
         return None
@@ -0,0 +1,249 @@
+"""
+tether_budget.py
+
+Shares the uplink of the tether between the streams of every camera
+MJPEG streams, and H.264 streams whose bitrate cannot be set, take what they use (measured once they run). What is left
+is split between the H.264 streams by priority, within the configured bounds, and pushed through the devices' bitrate
+options. Rebalanced whenever a stream is enabled, disabled or reconfigured, and periodically as the measured bitrates drift.
+Software H.264 streams restart to change their bitrate, so they are planned from the estimated bitrates of the other
+streams rather than the measured ones, and restarted at most once every SOFTWARE_RESTART_INTERVAL.
+"""
+
+import logging
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from .device import Device
+from .pydantic_schemas import (
+    TetherBudgetModel, TetherBudgetPlanModel, TetherStreamAllocationModel, StreamEncodeTypeEnum, StreamTypeEnum,
+    StreamStatsModel,
+)
+
+
+@dataclass
+class _Unit:
+    """
+    Streams sharing one bitrate, a device's stream along with its followers'
+    """
+    device: Device
+    secondary: bool
+    encode_type: StreamEncodeTypeEnum
+    priority: float
+    streams: int
+    mbps: float
+    allocated: bool
+
+
+class TetherBudgetManager:
+    """
+    Allocates the H.264 bitrates of all cameras within the tether's budget
+    """
+
+    # Typical size of an MJPEG frame, until the stream's bitrate is measured
+    MJPEG_BITS_PER_PIXEL = 1.0
+    # Bitrate of H.264 streams that cannot be set, until measured
+    DEFAULT_H264_MBPS = 10
+    # Smallest change pushed to a device, software H.264 streams restart on every change
+    MIN_CHANGE_MBPS = 0.5
+    MIN_CHANGE_RATIO = 0.1
+    # Rebalance at least this often (in seconds), for the measured bitrates
+    REBALANCE_INTERVAL = 10
+    # Restart a software H.264 stream for a new bitrate at most this often (in seconds)
+    SOFTWARE_RESTART_INTERVAL = 60
+
+    def __init__(self, get_settings: Callable[[], TetherBudgetModel] = TetherBudgetModel) -> None:
+        self._get_settings = get_settings
+        self.logger = logging.getLogger("dwe_os_2.cameras.TetherBudgetManager")
+
+        self._pending = True
+        self._last_rebalance = 0.0
+        # When the budget last restarted each software H.264 stream, by (bus_info, secondary)
+        self._restarts: Dict[Tuple[str, bool], float] = {}
+        # Plan of the last rebalance, None while disabled
+        self.last_plan: Optional[TetherBudgetPlanModel] = None
+
+    @property
+    def settings(self) -> TetherBudgetModel:
+        return self._get_settings()
+
+    def request_rebalance(self):
+        """
+        Rebalance at the next opportunity, called when streams are enabled, disabled or reconfigured
+        """
+        self._pending = True
+
+    def rebalance_due(self) -> bool:
+        return self._pending or time.monotonic() - self._last_rebalance >= self.REBALANCE_INTERVAL
+
+    def plan(self, devices: List[Device], stats: Dict[Tuple[str, bool], StreamStatsModel] = {}) -> TetherBudgetPlanModel:
+        """
+        Allocate the bitrates of the enabled streams, stats are the latest of the running streams by (bus_info, secondary)
+        """
+        settings = self.settings
+        units = self._collect(devices, stats, settings)
+
+        fixed = sum(unit.mbps * unit.streams for unit in units if not unit.allocated)
+        available = max(settings.total_mbps - settings.reserve_mbps - fixed, 0)
+        allocated_units = [unit for unit in units if unit.allocated]
+        oversubscribed = self._allocate(allocated_units, available, settings)
+        if fixed + settings.reserve_mbps > settings.total_mbps:
+            oversubscribed = True
+
+        return TetherBudgetPlanModel(
+            enabled=settings.enabled,
+            total_mbps=settings.total_mbps,
+            available_mbps=round(available, 1),
+            allocated_mbps=round(sum(unit.mbps * unit.streams for unit in allocated_units), 1),
+            oversubscribed=oversubscribed,
+            streams=[TetherStreamAllocationModel(
+                bus_info=unit.device.bus_info,
+                secondary=unit.secondary,
+                encode_type=unit.encode_type,
+                priority=unit.priority,
+                streams=unit.streams,
+                mbps=round(unit.mbps, 1),
+                allocated=unit.allocated,
+            ) for unit in units],
+        )
+
+    def allocation(self, bus_info: str, secondary: bool = False) -> Optional[float]:
+        """
+        Bitrate allocated to a stream by the last rebalance, None if the budget is disabled or does not set it
+        """
+        if not self.last_plan:
+            return None
+        for stream in self.last_plan.streams:
+            if stream.allocated and (stream.bus_info, stream.secondary) == (bus_info, secondary):
+                return stream.mbps
+        return None
+
+    def rebalance(self, devices: List[Device], stats: Dict[Tuple[str, bool], StreamStatsModel] = {},
+                  exclude: Set[Tuple[str, bool]] = set()) -> TetherBudgetPlanModel | None:
+        """
+        Plan the budget and push the bitrates that changed enough to the devices
+        Streams in exclude, by (bus_info, secondary), are allocated but not pushed, their allocation is an upper bound
+        for whatever sets their bitrate (the adaptive bitrate controller)
+        Software H.264 streams are allocated from the estimated bitrates of the others, so that measurements drifting
+        do not restart them, and not pushed again within SOFTWARE_RESTART_INTERVAL of their last restart
+        Returns the plan if any bitrate was changed, None otherwise
+        """
+        self._pending = False
+        self._last_rebalance = time.monotonic()
+        if not self.settings.enabled:
+            self.last_plan = None
+            return None
+
+        plan = self.plan(devices, stats)
+        if any(allocation.allocated and allocation.encode_type == StreamEncodeTypeEnum.SOFTWARE_H264
+               for allocation in plan.streams):
+            estimated = {(allocation.bus_info, allocation.secondary): allocation.mbps
+                         for allocation in self.plan(devices).streams}
+            for allocation in plan.streams:
+                if allocation.allocated and allocation.encode_type == StreamEncodeTypeEnum.SOFTWARE_H264:
+                    allocation.mbps = estimated.get((allocation.bus_info, allocation.secondary), allocation.mbps)
+        self.last_plan = plan
+
+        devices_by_bus_info = {device.bus_info: device for device in devices}
+        streams = {(allocation.bus_info, allocation.secondary) for allocation in plan.streams}
+        self._restarts = {key: at for (key, at) in self._restarts.items() if key in streams}
+        changed = False
+        for allocation in plan.streams:
+            key = (allocation.bus_info, allocation.secondary)
+            if not allocation.allocated or key in exclude:
+                continue
+            device = devices_by_bus_info[allocation.bus_info]
+            current = device.get_stream_bitrate(allocation.secondary)
+            if current is not None and abs(allocation.mbps - current) < max(self.MIN_CHANGE_MBPS, current * self.MIN_CHANGE_RATIO):
+                continue
+            if allocation.encode_type == StreamEncodeTypeEnum.SOFTWARE_H264:
+                if key in self._restarts and time.monotonic() - self._restarts[key] < self.SOFTWARE_RESTART_INTERVAL:
+                    # Pushed by a later rebalance
+                    continue
+                self._restarts[key] = time.monotonic()
+            self.logger.info(
+                f"{allocation.bus_info}: {'Secondary stream' if allocation.secondary else 'Stream'} bitrate {current} -> {allocation.mbps} Mbps")
+            device.set_stream_bitrate(allocation.mbps, allocation.secondary)
+            changed = True
+
+        if plan.oversubscribed:
+            self.logger.warning(
+                f"The streams exceed the tether budget of {plan.total_mbps:g} Mbps even at their minimum bitrate")
+        return plan if changed else None
+
+    def _collect(self, devices: List[Device], stats: Dict[Tuple[str, bool], StreamStatsModel], settings: TetherBudgetModel) -> List[_Unit]:
+        units: List[_Unit] = []
+        devices_by_bus_info = {device.bus_info: device for device in devices}
+        for device in devices:
+            if getattr(device, "is_managed", False):
+                # Streamed with its leader, at its leader's bitrate
+                continue
+            for secondary in [False, True]:
+                stream = device.secondary_stream if secondary else device.stream
+                # Recordings stay on the vehicle
+                if not stream or not stream.enabled or stream.stream_type == StreamTypeEnum.RECORDING:
+                    continue
+
+                streams = 1
+                if not secondary:
+                    streams += len([bus_info for bus_info in getattr(device, "followers", [])
+                                    if bus_info in devices_by_bus_info])
+                measured = stats.get((device.bus_info, secondary))
+                # The stats cover every stream of the engine
+                measured_mbps = measured.bitrate_kbps / 1000 / streams if measured else None
+
+                allocated = device.can_set_bitrate(stream.encode_type)
+                if allocated:
+                    mbps = 0.0
+                elif measured_mbps is not None:
+                    mbps = measured_mbps
+                elif stream.encode_type == StreamEncodeTypeEnum.MJPG:
+                    fps = stream.interval.denominator / stream.interval.numerator
+                    mbps = stream.width * stream.height * fps * self.MJPEG_BITS_PER_PIXEL / 1_000_000
+                else:
+                    mbps = self.DEFAULT_H264_MBPS
+
+                units.append(_Unit(
+                    device=device,
+                    secondary=secondary,
+                    encode_type=stream.encode_type,
+                    priority=settings.priorities.get(device.bus_info, 1),
+                    streams=streams,
+                    mbps=mbps,
+                    allocated=allocated,
+                ))
+        return units
+
+    @staticmethod
+    def _allocate(units: List[_Unit], available: float, settings: TetherBudgetModel) -> bool:
+        """
+        Split the available bitrate in proportion to the priorities, within the bounds
+        Streams held at a bound leave the rest to the others. Returns True if even the minimum does not fit.
+        """
+        if len(units) == 0:
+            return False
+        (low, high) = (settings.min_mbps, max(settings.max_mbps, settings.min_mbps))
+        minimum = sum(low * unit.streams for unit in units)
+        if minimum >= available:
+            for unit in units:
+                unit.mbps = low
+            return minimum > available
+
+        def total(scale: float) -> float:
+            return sum(min(max(scale * unit.priority, low), high) * unit.streams for unit in units)
+
+        # The total grows with the scale, find the scale that uses the available bitrate
+        (lower, upper) = (0.0, high / max(min(unit.priority for unit in units), 1e-3))
+        if total(upper) <= available:
+            lower = upper
+        else:
+            for _ in range(50):
+                scale = (lower + upper) / 2
+                if total(scale) > available:
+                    upper = scale
+                else:
+                    lower = scale
+        for unit in units:
+            # Rounded down to the 0.1 Mbps step of the bitrate controls
+            unit.mbps = int(min(max(lower * unit.priority, low), high) * 10) / 10
+        return False
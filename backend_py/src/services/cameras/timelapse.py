@@ -0,0 +1,257 @@
+"""
+timelapse.py
+
+Interval capture of stills for long surveys, one MJPEG frame every interval written exactly as the camera produced it
+Frames come from the running stream when it captures MJPEG, otherwise the MJPEG node is only captured around each shot,
+so nothing is decoded or encoded and the camera idles between shots. Every shot is listed in a JSON lines manifest.
+"""
+
+import json
+import os
+import re
+import stat
+import threading
+import time
+import logging
+from datetime import datetime
+from typing import Callable, Optional
+
+from .stream_engines.frame_tap import FrameTap
+from .synchronized_camera import V4L2Camera, CopiedFrame
+from .pydantic_schemas import TimelapseRequestModel, TimelapseStatusModel
+from . import v4l2
+
+MANIFEST_NAME = "manifest.jsonl"
+
+
+def get_timelapse_dir() -> str:
+    timelapse_dir = os.path.join(os.getcwd(), "timelapses")
+    if not os.path.exists(timelapse_dir):
+        os.makedirs(timelapse_dir)
+        permissions = stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH
+        os.chmod(timelapse_dir, permissions)
+    return timelapse_dir
+
+
+class TimelapseCapture:
+    """
+    Captures a still every interval on its own thread, until stopped or the requested duration is over
+
+    Shots are scheduled at fixed times from the start, a shot that cannot keep up is skipped rather than delaying the
+    following ones. For short intervals the node stays open (at its slowest framerate) between shots, since reopening
+    it takes about as long as the interval.
+    """
+
+    # Intervals shorter than this keep the node open between shots
+    KEEP_OPEN_BELOW = 10
+    # Frames dropped after opening the node, while auto exposure settles
+    WARMUP_FRAMES = 5
+    FRAME_TIMEOUT = 3
+    # Longest a shot in progress keeps the node after release(), a frame and closing the node
+    RELEASE_TIMEOUT = FRAME_TIMEOUT + 2
+
+    def __init__(self, name: str, device_path: str, width: int, height: int, fps: int, request: TimelapseRequestModel,
+                 get_tap: Callable[[], Optional[FrameTap]], is_node_free: Callable[[], bool]) -> None:
+        """
+        get_tap returns the tap of whatever already captures the node (the running stream or the preview), if anything
+        is_node_free tells whether the node may be opened, i.e. no stream is configured on it
+        """
+        self.name = name
+        self.device_path = device_path
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.request = request
+        self._get_tap = get_tap
+        self._is_node_free = is_node_free
+        self.logger = logging.getLogger("dwe_os_2.cameras.TimelapseCapture")
+
+        prefix = re.sub(r"[^A-Za-z0-9._-]", "_", name)
+        self.directory = os.path.join(
+            get_timelapse_dir(), f"{prefix}_{datetime.now().strftime('%F-%H%M%S')}")
+
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._camera_lock = threading.Lock()
+        self._camera: Optional[V4L2Camera] = None
+        # Set to have the shot in progress close the node at its next frame, rather than waiting for it
+        self._release = threading.Event()
+        # Set while the node is closed, for a stream to wait on before opening it
+        self._closed = threading.Event()
+        self._closed.set()
+        self._started_at = time.time()
+        self._frames = 0
+        self._missed = 0
+        self._next_shot: Optional[float] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._write_manifest({
+            "device": self.name,
+            "width": self.width,
+            "height": self.height,
+            "interval_s": self.request.interval_s,
+            "started": round(self._started_at, 3),
+        })
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self, wait: bool = True):
+        """
+        Stop after the current shot, wait for it unless called from the event loop
+        """
+        self._stop.set()
+        thread = self._thread
+        if wait and thread and thread is not threading.current_thread():
+            thread.join(timeout=self.FRAME_TIMEOUT + 2)
+        self.release()
+
+    def release(self):
+        """
+        Close the node if it is open between shots, e.g. so a stream can use it
+        Never waits for a shot in progress (up to a warm-up and a capture), which closes the node at its next frame,
+        see wait_released()
+        """
+        self._release.set()
+        if not self._camera_lock.acquire(blocking=False):
+            return
+        try:
+            self._close_camera()
+        finally:
+            self._camera_lock.release()
+
+    def wait_released(self, timeout: float) -> bool:
+        """
+        Wait for the node to be closed after release(), returns False if it is still open after timeout
+        A shot in progress closes it at its next frame, within RELEASE_TIMEOUT
+        """
+        return self._closed.wait(timeout)
+
+    def _close_camera(self):
+        """
+        Called with the camera lock held
+        """
+        self._release.clear()
+        if self._camera:
+            self._camera.close()
+            self._camera = None
+        self._closed.set()
+
+    def status(self) -> TimelapseStatusModel:
+        next_shot = self._next_shot
+        return TimelapseStatusModel(
+            bus_info=self.name,
+            directory=self.directory,
+            interval_s=self.request.interval_s,
+            frames=self._frames,
+            missed=self._missed,
+            running=self.running,
+            started_at=self._started_at,
+            next_shot_in=round(max(next_shot - time.monotonic(), 0),
+                               3) if next_shot is not None and self.running else None,
+        )
+
+    def _run(self):
+        start = time.monotonic()
+        end = start + self.request.duration_s if self.request.duration_s else None
+        shot = 0
+        try:
+            while not self._stop.is_set():
+                self._next_shot = start + shot * self.request.interval_s
+                if end is not None and self._next_shot > end:
+                    break
+                if self._stop.wait(max(self._next_shot - time.monotonic(), 0)):
+                    break
+
+                taken_at = time.time()
+                (frame, error) = self._grab()
+                if frame is None:
+                    self._missed += 1
+                    self._write_manifest(
+                        {"time": round(taken_at, 3), "missed": error})
+                else:
+                    self._save(frame, taken_at)
+
+                # Skip the shots whose time already passed
+                shot = max(shot + 1, int((time.monotonic() -
+                           start) // self.request.interval_s) + 1)
+        finally:
+            self.release()
+            self.logger.info(
+                f"{self.name}: Timelapse finished, {self._frames} frames in {self.directory}")
+
+    def _grab(self):
+        """
+        Get one frame, returns (frame, None) or (None, reason)
+        """
+        tap = self._get_tap()
+        if tap:
+            # Someone else captures the node, share their frames
+            self.release()
+            tap.subscribe()
+            try:
+                (index, _) = tap.latest()
+                (_, frames) = tap.wait_for_frame(index, self.FRAME_TIMEOUT)
+            finally:
+                tap.unsubscribe()
+            return (frames[0], None) if frames else (None, "no frame from the running capture")
+
+        if not self._is_node_free():
+            self.release()
+            return (None, "node busy")
+
+        with self._camera_lock:
+            if self._release.is_set():
+                self._close_camera()
+            if not self._is_node_free():
+                # A stream was configured while waiting for the lock
+                return (None, "node busy")
+            camera = self._camera
+            if camera:
+                # Drop the frames that queued up since the last shot
+                while camera.grab_copied_frame(blocking=False) is not None:
+                    pass
+            else:
+                try:
+                    camera = V4L2Camera(
+                        self.device_path, self.width, self.height, self.fps, v4l2.V4L2_PIX_FMT_MJPEG)
+                except (OSError, AttributeError, RuntimeError) as e:
+                    self.logger.warning(
+                        f"Unable to open {self.device_path} for timelapse: {e}")
+                    return (None, "unable to open the node")
+                if camera.critical_error:
+                    return (None, "unable to open the node")
+                self._camera = camera
+                self._closed.clear()
+                for _ in range(self.WARMUP_FRAMES):
+                    camera.grab_copied_frame(timeout_s=self.FRAME_TIMEOUT)
+                    if self._release.is_set():
+                        self._close_camera()
+                        return (None, "node released")
+
+            frame = camera.grab_copied_frame(timeout_s=self.FRAME_TIMEOUT)
+            if self._release.is_set() or self.request.interval_s >= self.KEEP_OPEN_BELOW:
+                self._close_camera()
+        return (frame, None) if frame else (None, "no frame from the node")
+
+    def _save(self, frame: CopiedFrame, taken_at: float):
+        self._frames += 1
+        filename = f"{self._frames:06d}.jpg"
+        with open(os.path.join(self.directory, filename), "wb") as f:
+            f.write(frame.data)
+        entry = {"index": self._frames, "time": round(taken_at, 3),
+                 "timestamp_us": frame.timestamp_us, "file": filename}
+        if (frame.width, frame.height) != (self.width, self.height):
+            # Frames of a running stream have its resolution
+            entry["width"] = frame.width
+            entry["height"] = frame.height
+        self._write_manifest(entry)
+
+    def _write_manifest(self, entry: dict):
+        # One line per shot, appended right away so the manifest survives a power loss
+        with open(os.path.join(self.directory, MANIFEST_NAME), "a") as f:
+            f.write(json.dumps(entry, separators=(",", ":")) + "\n")
@@ -7,6 +7,7 @@ Handles loading saved prefs and updating the json when settings are modified
 
 import json
 from typing import Dict
+from pydantic import BaseModel
 from .pydantic_schemas import SavedPreferencesModel
 
 class PreferencesManager:
@@ -29,6 +30,24 @@ class PreferencesManager:
         self.settings = preferences
         self._save_settings()
 
+    def update(self, preferences: SavedPreferencesModel):
+        """
+        Save the fields set in preferences, keeping the stored value of the others (down to the fields of each section)
+        """
+        self.settings = self._merge(self.settings, preferences)
+        self._save_settings()
+
+    @classmethod
+    def _merge(cls, current: BaseModel, update: BaseModel) -> BaseModel:
+        values = {}
+        for name in update.model_fields_set:
+            (old, new) = (getattr(current, name), getattr(update, name))
+            if isinstance(new, BaseModel) and isinstance(old, type(new)):
+                values[name] = cls._merge(old, new)
+            else:
+                values[name] = new
+        return current.model_copy(update=values)
+
     def get_preferences(self):
         return self.settings
 
@@ -7,8 +7,12 @@ Includes schemas for saved preferences, like default stream endpoints
 
 from pydantic import BaseModel, Field
 from typing import Optional
-from ..cameras.pydantic_schemas import StreamEndpointModel
+from ..cameras.pydantic_schemas import StreamEndpointModel, SchedulingModel, BandwidthModel, TetherBudgetModel, AdaptiveBitrateModel
 
 class SavedPreferencesModel(BaseModel):
     default_stream: Optional[StreamEndpointModel] = StreamEndpointModel(host='192.168.2.1', port=5600)
     suggest_host: bool = True
+    scheduling: SchedulingModel = SchedulingModel()
+    bandwidth: BandwidthModel = BandwidthModel()
+    tether: TetherBudgetModel = TetherBudgetModel()
+    adaptive_bitrate: AdaptiveBitrateModel = AdaptiveBitrateModel()
@@ -0,0 +1,115 @@
+"""
+shutdown.py
+
+Coordinates a graceful shutdown of all subsystems
+Every subsystem stops in parallel (so recordings finalize their files at the same time), and whatever
+has not stopped by a single global deadline is force killed
+"""
+
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+
+@dataclass
+class ShutdownStep:
+    """
+    A subsystem to stop
+
+    Attributes:
+        name         name used in the report
+        stop         stops the subsystem gracefully, may block
+        kill         force stops the subsystem when stop misses the deadline, must not block
+    """
+    name: str
+    stop: Callable[[], None]
+    kill: Optional[Callable[[], None]] = None
+
+
+@dataclass
+class ShutdownStepResult:
+    """
+    Attributes:
+        name         name of the step
+        status       "stopped", "failed" or "killed"
+        duration     seconds until the step finished, or until it was killed
+        error        error raised by stop, if any
+    """
+    name: str
+    status: str
+    duration: float
+    error: Optional[str] = None
+
+
+class ShutdownCoordinator:
+
+    # Long enough for a recording to finalize its file (EOS)
+    DEADLINE = 12
+
+    def __init__(self, deadline: float = DEADLINE) -> None:
+        self.deadline = deadline
+        self.logger = logging.getLogger("dwe_os_2.ShutdownCoordinator")
+        self._steps: List[ShutdownStep] = []
+
+    def add_step(self, name: str, stop: Callable[[], None], kill: Optional[Callable[[], None]] = None):
+        self._steps.append(ShutdownStep(name, stop, kill))
+
+    def run(self) -> List[ShutdownStepResult]:
+        """
+        Run every step in parallel and force kill the ones left at the deadline, then flush the logs
+        """
+        start = time.monotonic()
+        results: dict[str, ShutdownStepResult] = {}
+        lock = threading.Lock()
+
+        def run_step(step: ShutdownStep):
+            try:
+                step.stop()
+                result = ShutdownStepResult(
+                    step.name, "stopped", time.monotonic() - start)
+            except Exception as e:
+                result = ShutdownStepResult(
+                    step.name, "failed", time.monotonic() - start, str(e))
+            with lock:
+                results.setdefault(step.name, result)
+
+        # Daemon threads, so a stuck step cannot keep the process alive
+        threads = [(step, threading.Thread(target=run_step, args=(step,), name=f"Shutdown {step.name}", daemon=True))
+                   for step in self._steps]
+        for (_, thread) in threads:
+            thread.start()
+        for (step, thread) in threads:
+            thread.join(timeout=max(self.deadline - (time.monotonic() - start), 0))
+            if not thread.is_alive():
+                continue
+            with lock:
+                results.setdefault(step.name, ShutdownStepResult(
+                    step.name, "killed", time.monotonic() - start))
+            if step.kill:
+                try:
+                    step.kill()
+                except Exception as e:
+                    self.logger.error(f"Unable to kill {step.name}: {e}")
+
+        report = [results[step.name] for step in self._steps]
+        for result in report:
+            message = f"Shutdown: {result.name} {result.status} after {result.duration:.2f}s"
+            if result.error:
+                message += f" ({result.error})"
+            if result.status == "stopped":
+                self.logger.info(message)
+            else:
+                self.logger.warning(message)
+        self.logger.info(
+            f"Shutdown completed in {time.monotonic() - start:.2f}s")
+
+        # Last, so the report above makes it to disk
+        for handler in logging.getLogger().handlers:
+            try:
+                handler.flush()
+            except Exception:
+                pass
+
+        return report
@@ -0,0 +1,82 @@
+"""
+io_mode_benchmark.py
+
+Measures the CPU time and capture-to-sink latency of each v4l2src io-mode on one device
+
+Works with a camera, or with a v4l2loopback device fed by a test pattern:
+
+    sudo modprobe v4l2loopback video_nr=42 exclusive_caps=1
+    gst-launch-1.0 videotestsrc is-live=true ! video/x-raw,width=1920,height=1080,framerate=30/1 ! jpegenc ! v4l2sink device=/dev/video42 &
+    python3 tools/io_mode_benchmark.py /dev/video42 --decode
+
+Latency is reported by the GStreamer latency tracer, from the source to the sink.
+"""
+
+import argparse
+import os
+import re
+import resource
+import subprocess
+import sys
+import time
+
+IO_MODES = ["auto", "mmap", "userptr", "dmabuf"]
+
+# e.g. 0:00:01.234 ... latency, src-element-id=(string)0x..., src=(string)src, sink-element-id=..., sink=(string)sink, time=(guint64)1234567, ts=...
+LATENCY_PATTERN = re.compile(r"\blatency, .*?time=\(guint64\)(\d+)")
+
+
+def run(device: str, mode: str, caps: str, decode: bool, buffers: int):
+    pipeline = f"v4l2src device={device} io-mode={mode} num-buffers={buffers} ! {caps}"
+    if decode:
+        pipeline += " ! jpegdec"
+    pipeline += " ! fakesink sync=false"
+
+    env = dict(os.environ, GST_TRACERS="latency",
+               GST_DEBUG="GST_TRACER:7", GST_DEBUG_NO_COLOR="1")
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.monotonic()
+    result = subprocess.run(["gst-launch-1.0", "-q", *pipeline.split(" ")],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, env=env)
+    elapsed = time.monotonic() - start
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    if result.returncode != 0:
+        return None
+
+    cpu = (after.ru_utime - before.ru_utime) + \
+        (after.ru_stime - before.ru_stime)
+    latencies = [int(match.group(1)) / 1_000_000
+                 for match in LATENCY_PATTERN.finditer(result.stderr)]
+    return (cpu / elapsed * 100, cpu / buffers * 1000, latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark v4l2src io-modes")
+    parser.add_argument("device")
+    parser.add_argument("--format", default="image/jpeg",
+                        help="media type of the device output")
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--buffers", type=int, default=300)
+    parser.add_argument("--decode", action="store_true",
+                        help="decode the frames with jpegdec, as software H.264 streams do")
+    args = parser.parse_args()
+
+    caps = f"{args.format},width={args.width},height={args.height},framerate={args.fps}/1"
+    print(f"{'io-mode':<10}{'CPU %':>8}{'CPU ms/frame':>14}{'latency ms (avg)':>18}{'latency ms (max)':>18}")
+    for mode in IO_MODES:
+        measured = run(args.device, mode, caps, args.decode, args.buffers)
+        if measured is None:
+            print(f"{mode:<10}{'not supported':>8}")
+            continue
+        (cpu_percent, cpu_per_frame, latencies) = measured
+        average = sum(latencies) / len(latencies) if latencies else float("nan")
+        maximum = max(latencies) if latencies else float("nan")
+        print(f"{mode:<10}{cpu_percent:>8.1f}{cpu_per_frame:>14.2f}{average:>18.2f}{maximum:>18.2f}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
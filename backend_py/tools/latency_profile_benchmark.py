@@ -0,0 +1,88 @@
+"""
+latency_profile_benchmark.py
+
+Measures the latency each latency profile adds between capture and display, on one camera
+
+The stream is built by the same pipeline builder the server uses, but instead of leaving over UDP it is depayloaded,
+decoded and sunk in the same process, so the GStreamer latency tracer can time every frame from v4l2src to the sink.
+Network, sensor readout and display latency are not included, see docs/latency-profiles.md for measuring those.
+
+    cd backend_py
+    python3 -m tools.latency_profile_benchmark /dev/video2 --encode H264 --width 1920 --height 1080 --fps 30
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+from src.services.cameras.pydantic_schemas import LatencyProfileEnum, StreamEncodeTypeEnum, StreamTypeEnum, IntervalModel
+from src.services.cameras.stream_engines.stream import Stream
+from src.services.cameras.stream_engines.gstreamer_stream_engine import GStreamerPipelineBuilder
+from src.services.cameras.stream_engines.latency_profiles import get_latency_profile
+
+# e.g. ... latency, src-element-id=(string)0x..., src=(string)src, sink-element-id=..., sink=(string)sink, time=(guint64)1234567, ts=...
+LATENCY_PATTERN = re.compile(r"\blatency, .*?time=\(guint64\)(\d+)")
+
+RECEIVERS = {
+    StreamEncodeTypeEnum.MJPG: "rtpjpegdepay ! jpegdec",
+    StreamEncodeTypeEnum.H264: "rtph264depay ! h264parse ! avdec_h264",
+    StreamEncodeTypeEnum.SOFTWARE_H264: "rtph264depay ! h264parse ! avdec_h264",
+}
+
+
+def measure(stream: Stream, buffers: int):
+    profile = get_latency_profile(stream.latency_profile)
+    # Without endpoints the builder ends the stream with a fakesink, which is replaced by the receiver
+    sender = GStreamerPipelineBuilder.build(stream)
+    assert sender.endswith(" ! fakesink")
+    pipeline = sender.replace("v4l2src ", f"v4l2src num-buffers={buffers} ", 1).removesuffix(" ! fakesink") + \
+        f" ! {RECEIVERS[stream.encode_type]} ! fakesink sync={'true' if profile.sink_sync else 'false'}"
+
+    env = dict(os.environ, GST_TRACERS="latency",
+               GST_DEBUG="GST_TRACER:7", GST_DEBUG_NO_COLOR="1")
+    result = subprocess.run(["gst-launch-1.0", "-q", *pipeline.split(" ")],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, env=env)
+    if result.returncode != 0:
+        return None
+    latencies = sorted(int(match.group(1)) / 1_000_000
+                       for match in LATENCY_PATTERN.finditer(result.stderr))
+    # The first frames include the pipeline start
+    return latencies[len(latencies) // 10:] if len(latencies) > 10 else latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the latency profiles on a camera")
+    parser.add_argument("device")
+    parser.add_argument("--encode", default="MJPG",
+                        choices=[encode_type.value for encode_type in StreamEncodeTypeEnum])
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--buffers", type=int, default=300)
+    args = parser.parse_args()
+
+    print(f"{'profile':<20}{'median ms':>12}{'p95 ms':>10}{'max ms':>10}")
+    for profile in LatencyProfileEnum:
+        stream = Stream(
+            device_path=args.device,
+            encode_type=StreamEncodeTypeEnum(args.encode),
+            stream_type=StreamTypeEnum.UDP,
+            width=args.width,
+            height=args.height,
+            interval=IntervalModel(numerator=1, denominator=args.fps),
+            latency_profile=profile,
+        )
+        latencies = measure(stream, args.buffers)
+        if not latencies:
+            print(f"{profile.value:<20}{'failed':>12}")
+            continue
+        median = latencies[len(latencies) // 2]
+        p95 = latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+        print(f"{profile.value:<20}{median:>12.1f}{p95:>10.1f}{latencies[-1]:>10.1f}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
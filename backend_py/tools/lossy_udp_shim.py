@@ -0,0 +1,117 @@
+"""
+lossy_udp_shim.py
+
+Relays UDP between a local port and a target while dropping, delaying and reordering packets, to test streams over a
+bad link on localhost. Packets are relayed both ways (SRT acknowledgements and retransmission requests go back to the sender).
+
+    # Receiver: SRT listener on 9001, decoded and displayed
+    gst-launch-1.0 srtsrc uri="srt://:9001?mode=listener&latency=200" ! tsdemux ! h264parse ! avdec_h264 ! autovideosink sync=false
+    # Shim: 5 % loss and 40 +/- 10 ms of delay between port 9000 and the receiver
+    python3 tools/lossy_udp_shim.py 9000 127.0.0.1:9001 --loss 5 --delay 40 --jitter 10
+    # Then stream SRT as a caller to 127.0.0.1:9000
+"""
+
+import argparse
+import heapq
+import random
+import select
+import socket
+import sys
+import time
+
+
+class LossyRelay:
+    def __init__(self, listen_port: int, target: tuple, loss: float, burst: int, delay_ms: float, jitter_ms: float) -> None:
+        # Faces the sender, which is whoever sent the last packet to the listen port
+        self.front = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.front.bind(("127.0.0.1", listen_port))
+        # Faces the target
+        self.back = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.back.bind(("127.0.0.1", 0))
+        self.target = target
+        self.sender = None
+
+        self.loss = loss / 100
+        self.burst = burst
+        self.delay = delay_ms / 1000
+        self.jitter = jitter_ms / 1000
+
+        # (send time, order, socket, data, address)
+        self._pending = []
+        self._order = 0
+        self._dropping = 0
+        self.counts = {"relayed": 0, "dropped": 0}
+
+    def run(self):
+        last_report = time.monotonic()
+        while True:
+            now = time.monotonic()
+            timeout = max(self._pending[0][0] - now,
+                          0) if self._pending else 1
+            (readable, _, _) = select.select(
+                [self.front, self.back], [], [], timeout)
+            for sock in readable:
+                (data, address) = sock.recvfrom(65536)
+                if sock is self.front:
+                    self.sender = address
+                    self._schedule(self.back, data, self.target)
+                elif self.sender:
+                    self._schedule(self.front, data, self.sender)
+
+            now = time.monotonic()
+            while self._pending and self._pending[0][0] <= now:
+                (_, _, sock, data, address) = heapq.heappop(self._pending)
+                sock.sendto(data, address)
+
+            if now - last_report >= 5:
+                print(
+                    f"relayed {self.counts['relayed']}, dropped {self.counts['dropped']}", flush=True)
+                last_report = now
+
+    def _schedule(self, sock: socket.socket, data: bytes, address: tuple):
+        # Losses come in bursts of up to burst packets, as on a radio link
+        if self._dropping == 0 and random.random() < self.loss:
+            self._dropping = random.randint(1, self.burst)
+        if self._dropping > 0:
+            self._dropping -= 1
+            self.counts["dropped"] += 1
+            return
+
+        # Jitter larger than the packet interval reorders packets
+        delay = max(self.delay + random.uniform(-self.jitter, self.jitter), 0)
+        self._order += 1
+        heapq.heappush(self._pending, (time.monotonic() +
+                       delay, self._order, sock, data, address))
+        self.counts["relayed"] += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Relay UDP through a simulated lossy link")
+    parser.add_argument("listen_port", type=int)
+    parser.add_argument("target", help="host:port to relay to")
+    parser.add_argument("--loss", type=float, default=1,
+                        help="chance of starting a loss, in percent")
+    parser.add_argument("--burst", type=int, default=1,
+                        help="most packets lost in a row")
+    parser.add_argument("--delay", type=float, default=0,
+                        help="one-way delay in milliseconds")
+    parser.add_argument("--jitter", type=float, default=0,
+                        help="random variation of the delay in milliseconds")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    (host, port) = args.target.rsplit(":", 1)
+    relay = LossyRelay(args.listen_port, (host, int(port)), args.loss,
+                       max(args.burst, 1), args.delay, args.jitter)
+    print(
+        f"Relaying 127.0.0.1:{args.listen_port} <-> {host}:{port}", flush=True)
+    try:
+        relay.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -94,6 +94,12 @@ sudo apt-get install build-essential libdbus-glib-1-dev libdbus-1-dev libpython3
 echo "Installing GStreamer dependencies..."
 sudo apt-get install -y libglib2.0-dev libgstreamer1.0-dev libgstreamer-plugins-base1.0-dev gstreamer1.0-tools gstreamer1.0-x gstreamer1.0-plugins-base gstreamer1.0-plugins-good gstreamer1.0-plugins-bad gstreamer1.0-libav gstreamer1.0-plugins-ugly libimage-exiftool-perl
 
+# For the RTSP server (PyGObject + gst-rtsp-server)
+sudo apt-get install -y libgirepository1.0-dev libcairo2-dev gir1.2-gst-rtsp-server-1.0
+
+# For SRT streams (srt-live-transmit)
+sudo apt-get install -y srt-tools
+
 
 # Attempt to install ttyd through apt. If it fails, download from GitHub
 echo "Installing ttyd..."